@@ -6,17 +6,14 @@
 
 import streamlit as st
 import pandas as pd
-import sqlite3
+from data_access import load_orders
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import plotly.figure_factory as ff
 from datetime import datetime, timedelta
 import numpy as np
-from scipy import stats
-import seaborn as sns
-from sklearn.linear_model import LinearRegression
-from sklearn.preprocessing import StandardScaler
+# Модели sklearn импортируются внутри функций вкладок: импорт sklearn занимает
+# больше секунды и не должен задерживать первую отрисовку дашборда
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -70,48 +67,19 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-@st.cache_data(ttl=300)
 def load_data():
     """Загрузка данных из базы данных"""
     try:
-        conn = sqlite3.connect('orimex_orders.db')
-        
-        query = '''
-        SELECT 
-            o.id,
-            o.order_date,
-            o.quantity,
-            o.amount,
-            c.head_contractor,
-            c.buyer,
-            c.manager,
-            c.region,
-            p.name as product_name,
-            p.characteristics,
-            p.category
-        FROM orders o
-        JOIN contractors c ON o.contractor_id = c.id
-        JOIN products p ON o.product_id = p.id
-        WHERE o.amount IS NOT NULL AND o.amount > 0
-        '''
-        
-        df = pd.read_sql_query(query, conn)
-        df['order_date'] = pd.to_datetime(df['order_date'])
-        df['month'] = df['order_date'].dt.to_period('M')
-        df['week'] = df['order_date'].dt.to_period('W')
-        df['day_of_week'] = df['order_date'].dt.day_name()
-        df['quarter'] = df['order_date'].dt.to_period('Q')
-        
-        conn.close()
-        return df
+        return load_orders(time_columns=('month', 'week', 'day_of_week', 'quarter'))
         
     except Exception as e:
         st.error(f"Ошибка загрузки данных: {e}")
         return pd.DataFrame()
 
-@st.cache_data
-def get_advanced_stats(df):
-    """Расширенная статистика"""
+@st.cache_data(max_entries=16)
+def get_advanced_stats(_df, data_key):
+    """Расширенная статистика (data_key - токен данных и фильтры, ключ кеша вместо хеша _df)"""
+    df = _df
     if df.empty:
         return {}
     
@@ -211,7 +179,7 @@ def create_advanced_time_series(df):
     )
     
     # 5. По дням недели
-    dow_stats = df.groupby('day_of_week')['amount'].sum().reindex([
+    dow_stats = df.groupby('day_of_week', observed=True)['amount'].sum().reindex([
         'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'
     ])
     
@@ -298,6 +266,7 @@ def create_correlation_heatmap(df):
 
 def create_sales_forecast(df):
     """Прогнозирование продаж"""
+    from sklearn.linear_model import LinearRegression
     
     # Подготовка данных для прогноза
     daily_sales = df.groupby('order_date')['amount'].sum().reset_index()
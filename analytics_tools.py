@@ -13,6 +13,7 @@ from plotly.subplots import make_subplots
 import numpy as np
 from datetime import datetime, timedelta
 import json
+from data_access import load_daily_agg, load_orders, query_orders
 
 # Настройка страницы
 st.set_page_config(
@@ -24,21 +25,7 @@ st.set_page_config(
 def load_data():
     """Загрузка данных"""
     try:
-        conn = sqlite3.connect('orimex_orders.db')
-        query = '''
-        SELECT 
-            o.id, o.order_date, o.quantity, o.amount,
-            c.head_contractor, c.buyer, c.manager, c.region,
-            p.name as product_name, p.characteristics, p.category
-        FROM orders o
-        JOIN contractors c ON o.contractor_id = c.id
-        JOIN products p ON o.product_id = p.id
-        WHERE o.amount IS NOT NULL AND o.amount > 0
-        '''
-        df = pd.read_sql_query(query, conn)
-        df['order_date'] = pd.to_datetime(df['order_date'])
-        conn.close()
-        return df
+        return load_orders()
     except Exception as e:
         st.error(f"Ошибка загрузки: {e}")
         return pd.DataFrame()
@@ -478,9 +465,15 @@ def create_real_time_monitor():
     """Мониторинг в реальном времени"""
     st.header("📡 Мониторинг в реальном времени")
     
-    df = load_data()
-    if df.empty:
+    # Дневные итоги по менеджерам из куба вместо сканирования всех заказов
+    try:
+        manager_daily = load_daily_agg(by=('manager',))
+    except Exception as e:
+        st.error(f"Ошибка загрузки: {e}")
+        return
+    if manager_daily.empty:
         return
+    daily = manager_daily.groupby('order_date')[['orders', 'amount']].sum().reset_index()
     
     # Автообновление
     auto_refresh = st.checkbox("🔄 Автообновление (каждые 30 сек)")
@@ -489,21 +482,22 @@ def create_real_time_monitor():
         st.rerun()
     
     # Последние данные
-    latest_date = df['order_date'].max()
-    today_data = df[df['order_date'].dt.date == latest_date.date()]
+    latest_date = daily['order_date'].max()
+    today_totals = daily[daily['order_date'] == latest_date].iloc[0]
+    today_managers = manager_daily[manager_daily['order_date'] == latest_date]
     
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
         st.metric(
             "💰 Продажи сегодня",
-            f"{today_data['amount'].sum():,.0f} ₽",
-            f"{len(today_data)} заказов"
+            f"{today_totals['amount']:,.0f} ₽",
+            f"{int(today_totals['orders'])} заказов"
         )
     
     with col2:
-        avg_today = today_data['amount'].mean() if len(today_data) > 0 else 0
-        avg_overall = df['amount'].mean()
+        avg_today = today_totals['amount'] / today_totals['orders']
+        avg_overall = daily['amount'].sum() / daily['orders'].sum()
         change = (avg_today - avg_overall) / avg_overall * 100 if avg_overall > 0 else 0
         st.metric(
             "📊 Средний чек сегодня", 
@@ -512,18 +506,18 @@ def create_real_time_monitor():
         )
     
     with col3:
-        if len(today_data) > 0:
-            top_manager_today = today_data.groupby('manager')['amount'].sum().idxmax()
-            top_amount = today_data.groupby('manager')['amount'].sum().max()
-            st.metric(
-                "👨‍💼 Топ менеджер сегодня",
-                top_manager_today[:15] + "..." if len(top_manager_today) > 15 else top_manager_today,
-                f"{top_amount:,.0f} ₽"
-            )
-        else:
-            st.metric("👨‍💼 Топ менеджер сегодня", "Нет данных", "0 ₽")
+        manager_amounts = today_managers.set_index('manager')['amount']
+        top_manager_today = manager_amounts.idxmax()
+        top_amount = manager_amounts.max()
+        st.metric(
+            "👨‍💼 Топ менеджер сегодня",
+            top_manager_today[:15] + "..." if len(top_manager_today) > 15 else top_manager_today,
+            f"{top_amount:,.0f} ₽"
+        )
     
     with col4:
+        # Товаров в кубе нет: заказы последнего дня отбираются в SQLite
+        today_data = query_orders(filters={'start_date': latest_date.date(), 'end_date': latest_date.date()})
         if len(today_data) > 0:
             top_product_today = today_data.groupby('product_name')['amount'].sum().idxmax()
             st.metric(
@@ -535,7 +529,7 @@ def create_real_time_monitor():
             st.metric("🏆 Топ товар сегодня", "Нет данных", "0 ₽")
     
     # График в реальном времени
-    last_7_days = df[df['order_date'] >= (latest_date - timedelta(days=7))]
+    last_7_days = daily[daily['order_date'] >= (latest_date - timedelta(days=7))]
     daily_trend = last_7_days.groupby(last_7_days['order_date'].dt.date)['amount'].sum().reset_index()
     
     fig = px.line(
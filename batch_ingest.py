@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Параллельная загрузка нескольких выгрузок TDSheet (по одной на филиал) в SQLite
+
+Файлы разбираются и очищаются в пуле процессов (ProcessPoolExecutor),
+нормализованные пачки заказов передаются через очередь единственному
+процессу-писателю, который владеет соединением с orimex_orders.db.
+Благодаря одному писателю не возникает ошибок "database is locked".
+Если писатель аварийно завершается, разбор прерывается, а файлы, которые
+он не успел записать, получают ошибку в итогах загрузки.
+
+Запуск:
+    python batch_ingest.py "выгрузки/*.csv" --db orimex_orders.db --workers 4
+"""
+
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from queue import Empty, Full
+
+from csv_to_db import (
+    DimensionCache, create_tables, discard_staged_orders, file_md5, get_file_layout, is_file_ingested,
+    merge_staged_orders, normalize_frame, parse_date_columns, read_csv_chunks, refresh_daily_agg,
+    register_ingested_file, show_database_stats, stage_order_batch
+)
+from db_connections import connect_writer
+from orders_snapshot import write_snapshot
+
+logger = logging.getLogger(__name__)
+
+def collect_csv_files(source):
+    """Список CSV файлов: каталог, glob-шаблон или путь к одному файлу"""
+    if os.path.isdir(source):
+        return sorted(glob.glob(os.path.join(source, '*.csv')))
+    return sorted(glob.glob(source))
+
+def export_source(csv_file_path):
+    """
+    Источник заказов выгрузки филиала - имя файла без расширения
+
+    Очередная выгрузка филиала под тем же именем заменяет его заказы за свои даты,
+    заказы других филиалов с тем же ключом сохраняются (см. merge_staged_orders).
+    """
+    return os.path.splitext(os.path.basename(csv_file_path))[0]
+
+# Период, с которым ожидающие очередей процессы проверяют, жив ли писатель
+QUEUE_POLL_SECONDS = 1.0
+
+# Очередь к писателю и признак его аварийного завершения в процессах пула
+# (передаются через initializer)
+_batch_queue = None
+_writer_failed = None
+
+def _init_worker(queue, writer_failed):
+    global _batch_queue, _writer_failed
+    _batch_queue = queue
+    _writer_failed = writer_failed
+
+def _send_to_writer(message):
+    """Отправка пачки писателю; если писатель завершился, разбор файла прерывается"""
+    while True:
+        if _writer_failed.is_set():
+            # Отправленное уже никто не прочитает: процесс пула не должен ждать очередь при выходе
+            _batch_queue.cancel_join_thread()
+            raise RuntimeError("процесс записи завершился, разбор прерван")
+        try:
+            _batch_queue.put(message, timeout=QUEUE_POLL_SECONDS)
+            return
+        except Full:
+            continue
+
+def parse_file(csv_file_path, chunksize, layout):
+    """
+    Разбор одного файла в процессе пула
+
+    layout - разметка файла (get_file_layout), определенная в основном процессе.
+    Пачки по chunksize строк нормализуются и отправляются писателю по мере готовности,
+    после последней пачки отправляется признак конца файла (batch = None).
+    Возвращает статистику разбора файла (время разбора без ожидания очереди).
+    """
+    started = time.perf_counter()
+    waited = 0.0
+    file_hash = file_md5(csv_file_path)
+
+    rows = 0
+    orders = 0
+    for chunk in read_csv_chunks(csv_file_path, chunksize, layout):
+        batch = normalize_frame(chunk, layout)
+        rows += batch['stats']['rows']
+        orders += batch['stats']['orders']
+
+        put_started = time.perf_counter()
+        _send_to_writer((csv_file_path, file_hash, batch))
+        waited += time.perf_counter() - put_started
+
+    _send_to_writer((csv_file_path, file_hash, None))
+
+    return {
+        'file': csv_file_path,
+        'rows': rows,
+        'orders': orders,
+        'parse_seconds': time.perf_counter() - started - waited,
+    }
+
+def write_batches(db_path, queue, results, layouts):
+    """
+    Процесс-писатель: единственное соединение с БД
+
+    Читает пачки из очереди до сигнала None и накапливает ячейки каждого файла
+    (stage_order_batch); повторы ключа из разных пачек суммируются, поэтому
+    результат не зависит от chunksize. После последней пачки файла его ячейки
+    переносятся в orders (merge_staged_orders, источник - export_source)
+    в одной транзакции с регистрацией файла в ingested_files.
+    После ошибки пачки накопленные ячейки файла отбрасываются, а его остальные
+    пачки пропускаются: файл не попадает в orders частично.
+    Уже загруженные файлы (или копии файла из этого запуска) пропускаются.
+    Дневной куб daily_agg пересчитывается в той же транзакции за измененные даты.
+    В очередь results кладет статистику записи по каждому файлу.
+    """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    conn = connect_writer(db_path)
+    cursor = conn.cursor()
+    create_tables(cursor)
+    dimensions = DimensionCache()
+    dimensions.sync(cursor)
+    conn.commit()
+
+    written = {}
+    skipped_hashes = set()
+    owners = {}
+
+    while True:
+        message = queue.get()
+        if message is None:
+            break
+
+        csv_file_path, file_hash, batch = message
+        stats = written.setdefault(csv_file_path, {
+            'orders_written': 0, 'orders_removed': 0, 'write_seconds': 0.0, 'skipped': False
+        })
+
+        if file_hash not in owners:
+            owners[file_hash] = csv_file_path
+            if is_file_ingested(cursor, file_hash):
+                logger.warning(f"Файл {csv_file_path} уже был обработан ранее! Пропускаем загрузку.")
+                skipped_hashes.add(file_hash)
+
+        # Файл уже есть в БД или это копия файла, который загружается в этом запуске
+        if file_hash in skipped_hashes or owners[file_hash] != csv_file_path:
+            stats['skipped'] = True
+            continue
+
+        # Пачки файла после ошибки не записываются
+        if 'error' in stats:
+            continue
+
+        started = time.perf_counter()
+        try:
+            if batch is None:
+                export_dates = [date for _, date in parse_date_columns(layouts[csv_file_path]['date_columns'])]
+                merged = merge_staged_orders(cursor, file_hash, export_source(csv_file_path), export_dates)
+                refresh_daily_agg(cursor, merged['dates'])
+                register_ingested_file(cursor, file_hash, csv_file_path)
+                conn.commit()
+                stats['orders_written'] = merged['changed']
+                stats['orders_removed'] = merged['removed']
+            else:
+                stage_order_batch(cursor, batch, file_hash, dimensions)
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при записи пачки из {csv_file_path}: {e}")
+            conn.rollback()
+            dimensions.sync(cursor)
+            discard_staged_orders(cursor, file_hash)
+            conn.commit()
+            stats['error'] = str(e)
+        stats['write_seconds'] += time.perf_counter() - started
+
+    show_database_stats(cursor)
+    conn.close()
+    results.put(written)
+
+def wait_for_writer(writer, queue, results):
+    """
+    Отправка писателю сигнала конца и ожидание его статистики
+
+    Возвращает статистику записи или None, если писатель завершился, не отдав ее.
+    """
+    while writer.is_alive():
+        try:
+            queue.put(None, timeout=QUEUE_POLL_SECONDS)
+            break
+        except Full:
+            continue
+
+    while True:
+        try:
+            return results.get(timeout=QUEUE_POLL_SECONDS)
+        except Empty:
+            if writer.is_alive():
+                continue
+        # Статистика могла прийти между ожиданием и проверкой
+        try:
+            return results.get(timeout=QUEUE_POLL_SECONDS)
+        except Empty:
+            return None
+
+def writer_failure_stats(files, db_path, exitcode):
+    """
+    Статистика записи после аварийного завершения писателя
+
+    Файлы, успевшие зарегистрироваться в ingested_files, загружены полностью
+    (перенос ячеек и регистрация - одна транзакция); остальные - ошибка.
+    """
+    error = f"процесс записи завершился с кодом {exitcode}"
+    logger.error(f"Ошибка при записи файлов: {error}")
+
+    conn = connect_writer(db_path)
+    try:
+        cursor = conn.cursor()
+        ingested = {path for path in files if is_file_ingested(cursor, file_md5(path))}
+    finally:
+        conn.close()
+
+    written = {}
+    for path in files:
+        written[path] = {'orders_written': 0, 'orders_removed': 0, 'write_seconds': 0.0, 'skipped': False}
+        if path not in ingested:
+            written[path]['error'] = error
+    return written
+
+def ingest_files(source, db_path='orimex_orders.db', max_workers=None, chunksize=50000):
+    """
+    Параллельная загрузка CSV файлов из каталога или по glob-шаблону
+
+    Возвращает список со статистикой по каждому файлу (строки, заказы, время, строк/сек).
+    """
+    files = collect_csv_files(source)
+    if not files:
+        logger.warning(f"CSV файлы не найдены: {source}")
+        return []
+
+    logger.info(f"Найдено файлов: {len(files)}")
+    started = time.perf_counter()
+
+    # Разметка определяется один раз в основном процессе до запуска писателя;
+    # для известных форматов выгрузок она берется из БД
+    conn = connect_writer(db_path)
+    cursor = conn.cursor()
+    create_tables(cursor)
+    layouts = {path: get_file_layout(path, cursor) for path in files}
+    conn.commit()
+    conn.close()
+
+    # Ограниченная очередь: разборщики не уходят далеко вперед писателя
+    queue = multiprocessing.Queue(maxsize=max(4, 2 * (max_workers or os.cpu_count() or 1)))
+    results = multiprocessing.Queue()
+
+    writer_failed = multiprocessing.Event()
+
+    writer = multiprocessing.Process(target=write_batches, args=(db_path, queue, results, layouts))
+    writer.start()
+
+    report = {}
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(queue, writer_failed)) as pool:
+        futures = {pool.submit(parse_file, path, chunksize, layouts[path]): path for path in files}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=QUEUE_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = futures[future]
+                try:
+                    report[path] = future.result()
+                except Exception as e:
+                    logger.error(f"Ошибка при разборе файла {path}: {e}")
+                    report[path] = {'file': path, 'rows': 0, 'orders': 0, 'parse_seconds': 0.0, 'error': str(e)}
+
+            # Писатель завершается только по сигналу конца, до него - это сбой:
+            # разборщики, ждущие места в очереди, прерываются
+            if not writer.is_alive():
+                writer_failed.set()
+
+    written = wait_for_writer(writer, queue, results)
+    writer.join()
+    if written is None:
+        written = writer_failure_stats(files, db_path, writer.exitcode)
+
+    # Колоночный снимок для дашбордов; ошибка снимка не отменяет загрузку
+    if any(stats.get('orders_written') or stats.get('orders_removed') for stats in written.values()):
+        try:
+            write_snapshot(db_path)
+        except Exception as e:
+            logger.warning(f"Не удалось записать снимок заказов: {e}")
+
+    total_seconds = time.perf_counter() - started
+
+    summary = []
+    for path in files:
+        stats = dict(report[path])
+        stats.update(written.get(path, {'orders_written': 0, 'orders_removed': 0, 'write_seconds': 0.0, 'skipped': False}))
+        stats['rows_per_sec'] = stats['rows'] / stats['parse_seconds'] if stats['parse_seconds'] > 0 else 0.0
+        summary.append(stats)
+
+    logger.info("=== ИТОГИ ПАРАЛЛЕЛЬНОЙ ЗАГРУЗКИ ===")
+    for stats in summary:
+        status = 'пропущен' if stats['skipped'] else stats.get('error', 'ok')
+        logger.info(
+            f"{os.path.basename(stats['file'])}: строк {stats['rows']:,}, заказов {stats['orders_written']:,}, "
+            f"удалено {stats['orders_removed']:,}, "
+            f"разбор {stats['parse_seconds']:.2f} с ({stats['rows_per_sec']:,.0f} строк/с), "
+            f"запись {stats['write_seconds']:.2f} с, статус: {status}"
+        )
+    logger.info(f"Всего файлов: {len(files)}, общее время: {total_seconds:.2f} с")
+
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Параллельная загрузка выгрузок TDSheet в SQLite")
+    parser.add_argument('source', help="Каталог с CSV файлами или glob-шаблон")
+    parser.add_argument('--db', default='orimex_orders.db', help="Путь к базе данных")
+    parser.add_argument('--workers', type=int, default=None, help="Количество процессов разбора")
+    parser.add_argument('--chunksize', type=int, default=50000, help="Размер пачки строк")
+    args = parser.parse_args()
+
+    summary = ingest_files(args.source, args.db, args.workers, args.chunksize)
+    if summary and not any(stats.get('error') for stats in summary):
+        print("✅ Файлы успешно загружены!")
+    else:
+        print("❌ Ошибка при загрузке файлов")
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Замер скорости загрузки CSV в SQLite (строк/сек) в разных режимах
+
+Каждый прогон выполняется в новую временную базу данных:
+    обычный        - настройки SQLite по умолчанию
+    bulk           - режим массовой загрузки (WAL, synchronous=OFF, кеш страниц)
+    bulk+индексы   - массовая загрузка с перестроением вторичных индексов
+
+Для каждого режима замеряется общее время parse_csv_to_database и время этапов:
+read (хеш и чтение CSV), clean (длинный формат и очистка чисел),
+dimensions (контрагенты и продукты), insert (запись заказов), other (остальное).
+
+Без пути к CSV генерируется синтетическая выгрузка TDSheet заданного размера.
+
+Запуск:
+    python benchmark_ingest.py "Заказы Оримэкс - TDSheet.csv" --repeat 3
+    python benchmark_ingest.py --rows 20000 --days 60 --json results.json
+    python benchmark_ingest.py --rows 20000 --days 60 --baseline results.json
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from csv_to_db import parse_csv_to_database
+
+MODES = {
+    'обычный': {},
+    'bulk': {'bulk_load': True},
+    'bulk+индексы': {'bulk_load': True, 'rebuild_indexes': True},
+}
+
+STAGES = ['read', 'clean', 'dimensions', 'insert']
+
+NBSP = '\u00a0'
+
+def format_number(value, decimals=2):
+    """Число в формате выгрузки 1С: пробел-NBSP между тысячами, запятая в дробной части"""
+    text = f"{value:,.{decimals}f}".replace(',', NBSP).replace('.', ',')
+    if decimals and text.endswith(',' + '0' * decimals):
+        text = text[:-(decimals + 1)]
+    return text
+
+def generate_tdsheet(csv_file_path, rows=10000, days=30, start=date(2025, 1, 1), fill_rate=0.3, seed=0):
+    """
+    Генерация синтетической выгрузки TDSheet
+
+    Структура как у реального файла: строка с датами (дата, пустая колонка, ...),
+    строка "Количество заказов"/"Сумма заказов", группировочные строки головных
+    контрагентов без покупателя, строки "Итого" по контрагенту и общий итог.
+    Суммы пишутся с NBSP-разделителем тысяч и запятой, поэтому попадают в кавычки.
+
+    rows - примерное количество строк данных (с группировками и итогами), days - количество дат,
+    fill_rate - доля заполненных ячеек. Возвращает количество записанных строк данных.
+    """
+    rng = random.Random(seed)
+    dates = [(start + timedelta(days=i)).strftime('%d.%m.%Y') for i in range(days)]
+
+    header = ['Головной контрагент', '', '', 'Покупатель', 'Менеджер', '', 'Регион',
+              'Номенклатура', 'Характеристика', 'Категория']
+    for date_str in dates:
+        header += [date_str, '']
+    header += ['Итого', '', '']
+    subheader = [''] * 10 + ['Количество заказов', 'Сумма заказов'] * (days + 1) + ['']
+
+    managers = [f"Менеджер {i}" for i in range(1, 13)]
+    regions = [f"Регион {i}" for i in range(1, 9)]
+    categories = [f"Категория {i}" for i in range(1, 16)]
+    products = [
+        (f"Товар {i}", f"Характеристика {i % 7}" if i % 5 else '', categories[i % len(categories)])
+        for i in range(1, 1201)
+    ]
+
+    written = 0
+    with open(csv_file_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerow(subheader)
+
+        grand_quantity = np.zeros(days)
+        grand_amount = np.zeros(days)
+        contractor = 0
+        while written < rows:
+            contractor += 1
+            head = f"Контрагент {contractor}"
+            buyers = [f"Покупатель {contractor}-{i}" for i in range(1, rng.randint(1, 4) + 1)]
+            manager = rng.choice(managers)
+            region = rng.choice(regions)
+
+            # Группировочная строка головного контрагента (без покупателя и товара)
+            writer.writerow([head] + [''] * (len(header) - 1))
+            written += 1
+
+            group_quantity = np.zeros(days)
+            group_amount = np.zeros(days)
+            for _ in range(min(rng.randint(5, 60), rows - written)):
+                name, characteristics, category = rng.choice(products)
+                row = [head, '', '', rng.choice(buyers), manager, '', region, name, characteristics, category]
+                total_quantity = 0
+                total_amount = 0.0
+                for day in range(days):
+                    if rng.random() < fill_rate:
+                        quantity = rng.randint(1, 2500)
+                        amount = round(quantity * rng.uniform(15, 900), 2)
+                        row += [format_number(quantity, 0), format_number(amount)]
+                        total_quantity += quantity
+                        total_amount += amount
+                        group_quantity[day] += quantity
+                        group_amount[day] += amount
+                    else:
+                        row += ['', '']
+                row += [format_number(total_quantity, 0), format_number(total_amount), '']
+                writer.writerow(row)
+                written += 1
+
+            # Строка итогов по контрагенту
+            row = [f"Итого {head}", '', '', '', '', '', '', '', '', '']
+            for day in range(days):
+                row += [format_number(group_quantity[day], 0), format_number(group_amount[day])]
+            row += [format_number(group_quantity.sum(), 0), format_number(group_amount.sum()), '']
+            writer.writerow(row)
+            written += 1
+            grand_quantity += group_quantity
+            grand_amount += group_amount
+
+        row = ['Итого', '', '', '', '', '', '', '', '', '']
+        for day in range(days):
+            row += [format_number(grand_quantity[day], 0), format_number(grand_amount[day])]
+        row += [format_number(grand_quantity.sum(), 0), format_number(grand_amount.sum()), '']
+        writer.writerow(row)
+        written += 1
+
+    return written
+
+def count_data_rows(csv_file_path):
+    """Количество строк данных в выгрузке (без двух строк заголовка)"""
+    with open(csv_file_path, 'r', encoding='utf-8') as f:
+        return max(sum(1 for _ in f) - 2, 0)
+
+def run_once(csv_file_path, options, engine='vectorized', chunksize=None):
+    """Один прогон загрузки в новую БД, возвращает (секунды, число заказов, время этапов)"""
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'benchmark.db')
+        started = time.perf_counter()
+        if not parse_csv_to_database(csv_file_path, db_path, engine=engine, chunksize=chunksize,
+                                     timings=timings, **options):
+            raise RuntimeError(f"Загрузка завершилась с ошибкой: {options}")
+        seconds = time.perf_counter() - started
+
+        conn = sqlite3.connect(db_path)
+        orders = conn.execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+        conn.close()
+
+    stages = {stage: timings.get(stage, 0.0) for stage in STAGES}
+    stages['other'] = max(seconds - sum(stages.values()), 0.0)
+    return seconds, orders, stages
+
+def benchmark(csv_file_path, repeat=3, engine='vectorized', chunksize=None, modes=None):
+    """
+    Замер режимов загрузки
+
+    Для каждого режима берется лучший из repeat прогонов.
+    Возвращает список словарей: режим, секунды, строк/сек, заказов/сек, время этапов.
+    """
+    rows = count_data_rows(csv_file_path)
+    results = []
+    for mode in modes or MODES:
+        runs = [run_once(csv_file_path, MODES[mode], engine, chunksize) for _ in range(repeat)]
+        seconds, orders, stages = min(runs, key=lambda run: run[0])
+        results.append({
+            'mode': mode,
+            'rows': rows,
+            'orders': orders,
+            'seconds': round(seconds, 4),
+            'rows_per_sec': round(rows / seconds, 1),
+            'orders_per_sec': round(orders / seconds, 1),
+            'stages': {stage: round(value, 4) for stage, value in stages.items()},
+        })
+    return results
+
+def compare_with_baseline(report, baseline, tolerance=0.15):
+    """
+    Сравнение с предыдущим отчетом
+
+    Возвращает список режимов, где строк/сек упало больше чем на tolerance
+    """
+    previous = {result['mode']: result for result in baseline.get('results', [])}
+    regressions = []
+    for result in report['results']:
+        old = previous.get(result['mode'])
+        if not old or not old.get('rows_per_sec'):
+            continue
+        change = result['rows_per_sec'] / old['rows_per_sec'] - 1
+        result['baseline_rows_per_sec'] = old['rows_per_sec']
+        result['change'] = round(change, 4)
+        if change < -tolerance:
+            regressions.append(result['mode'])
+    return regressions
+
+def print_report(report):
+    """Таблица результатов в консоль"""
+    dataset = report['dataset']
+    results = report['results']
+    print(f"Файл: {dataset['file']}, строк данных: {dataset['rows']:,}, заказов: {results[0]['orders']:,}")
+    print(
+        f"{'Режим':<14} {'Время, с':>9} {'Строк/с':>10} {'Заказов/с':>11} "
+        + ' '.join(f"{stage:>10}" for stage in STAGES + ['other'])
+        + f" {'К базе':>8}"
+    )
+    for result in results:
+        change = f"{result['change']:+.0%}" if 'change' in result else '-'
+        print(
+            f"{result['mode']:<14} {result['seconds']:>9.2f} {result['rows_per_sec']:>10,.0f} "
+            f"{result['orders_per_sec']:>11,.0f} "
+            + ' '.join(f"{result['stages'][stage]:>10.2f}" for stage in STAGES + ['other'])
+            + f" {change:>8}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замер скорости загрузки CSV в SQLite")
+    parser.add_argument('csv', nargs='?', help="Путь к выгрузке TDSheet (без него генерируется синтетическая)")
+    parser.add_argument('--rows', type=int, default=20000, help="Строк в синтетической выгрузке")
+    parser.add_argument('--days', type=int, default=60, help="Дат в синтетической выгрузке")
+    parser.add_argument('--seed', type=int, default=0, help="Зерно генератора")
+    parser.add_argument('--repeat', type=int, default=3, help="Количество прогонов каждого режима")
+    parser.add_argument('--engine', default='vectorized', choices=['vectorized', 'rows'], help="Способ обработки")
+    parser.add_argument('--chunksize', type=int, default=None, help="Потоковый режим с пачками по N строк")
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=None, help="Замеряемые режимы")
+    parser.add_argument('--json', help="Сохранить результаты в JSON файл")
+    parser.add_argument('--baseline', help="JSON предыдущего замера для поиска регрессий")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="Допустимое падение строк/сек (доля)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_file_path = args.csv
+        if not csv_file_path:
+            csv_file_path = os.path.join(tmp, f"tdsheet_{args.rows}x{args.days}.csv")
+            generate_tdsheet(csv_file_path, args.rows, args.days, seed=args.seed)
+
+        # Логи загрузки не должны влиять на замер
+        logging.disable(logging.WARNING)
+        results = benchmark(csv_file_path, args.repeat, args.engine, args.chunksize, args.modes)
+        logging.disable(logging.NOTSET)
+
+        report = {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'environment': {
+                'python': platform.python_version(),
+                'pandas': pd.__version__,
+                'numpy': np.__version__,
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+            },
+            'dataset': {
+                'file': args.csv or 'synthetic',
+                'rows': results[0]['rows'],
+                'days': args.days if not args.csv else None,
+                'seed': args.seed if not args.csv else None,
+                'bytes': os.path.getsize(csv_file_path),
+            },
+            'engine': args.engine,
+            'chunksize': args.chunksize,
+            'repeat': args.repeat,
+            'results': results,
+        }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_with_baseline(report, json.load(f), args.tolerance)
+        report['regressions'] = regressions
+
+    print_report(report)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены: {args.json}")
+
+    if regressions:
+        print(f"❌ Падение скорости больше {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Замер холодного старта дашбордов: время импорта и время первой отрисовки
+
+Каждый замер выполняется в новом процессе Python, поэтому кеши Streamlit
+и модулей пустые, как после перезапуска дашборда:
+    импорт         - python -X importtime -c "import <дашборд>": общее время
+                     импорта и собственное время тяжелых пакетов (pandas, plotly,
+                     sklearn, scipy...), по выводу -X importtime
+    отрисовка      - первый полный прогон скрипта через streamlit AppTest
+                     (загрузка данных и все вкладки), без учета импорта streamlit
+
+Дашборды читают orimex_orders.db из текущего каталога, поэтому замер
+отрисовки запускается в каталоге --data-dir.
+
+Запуск:
+    python benchmark_startup.py
+    python benchmark_startup.py dashboard.py enhanced_dashboard.py --repeat 5 --json startup.json
+    python benchmark_startup.py --data-dir /data/orimex --baseline startup.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+
+DASHBOARDS = [
+    'dashboard.py',
+    'advanced_dashboard.py',
+    'super_dashboard.py',
+    'analytics_tools.py',
+    'enhanced_dashboard.py',
+    'ultimate_dashboard.py',
+    'mega_dashboard.py',
+]
+
+# Пакеты, собственное время импорта которых выводится в отчете
+HEAVY_PACKAGES = ['streamlit', 'pandas', 'numpy', 'pyarrow', 'plotly', 'scipy', 'sklearn', 'seaborn']
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Выполняется в отдельном процессе: первый прогон дашборда через AppTest
+RENDER_SCRIPT = '''
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+started = time.perf_counter()
+at = AppTest.from_file(sys.argv[1], default_timeout=float(sys.argv[2])).run()
+seconds = time.perf_counter() - started
+print(json.dumps({'seconds': seconds, 'exceptions': [e.message for e in at.exception]}))
+'''
+
+def parse_importtime(stderr):
+    """
+    Разбор вывода -X importtime
+
+    Строки вида "import time: self [us] | cumulative | imported package".
+    Возвращает (общее время в секундах, собственное время по корневым пакетам в секундах).
+    Собственное время пакета не зависит от того, какой модуль импортировал его первым.
+    """
+    total = 0
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        self_us = int(fields[0])
+        name = fields[2].strip()
+        total += self_us
+        root = name.split('.')[0]
+        packages[root] = packages.get(root, 0) + self_us
+    return total / 1e6, {name: value / 1e6 for name, value in packages.items()}
+
+def measure_import(script, data_dir):
+    """Импорт дашборда в новом процессе, возвращает (секунды, время пакетов, ошибка)"""
+    module = os.path.splitext(os.path.basename(script))[0]
+    env = dict(os.environ, PYTHONPATH=PACKAGE_DIR)
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=data_dir, env=env, capture_output=True, text=True
+    )
+    seconds, packages = parse_importtime(completed.stderr)
+    error = None
+    if completed.returncode != 0:
+        error = completed.stderr.strip().splitlines()[-1]
+    return seconds, packages, error
+
+def measure_render(script, data_dir, timeout=300):
+    """Первая отрисовка дашборда в новом процессе, возвращает (секунды, исключения)"""
+    env = dict(os.environ, PYTHONPATH=PACKAGE_DIR)
+    completed = subprocess.run(
+        [sys.executable, '-c', RENDER_SCRIPT, os.path.join(PACKAGE_DIR, script), str(timeout)],
+        cwd=data_dir, env=env, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        return None, [completed.stderr.strip().splitlines()[-1]]
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    return result['seconds'], result['exceptions']
+
+def benchmark(scripts, data_dir, repeat=3, render=True, timeout=300):
+    """
+    Замер дашбордов
+
+    Для каждого дашборда берется лучший из repeat прогонов импорта и отрисовки.
+    Возвращает список словарей: дашборд, время импорта, время пакетов, время отрисовки, ошибки.
+    """
+    results = []
+    for script in scripts:
+        imports = [measure_import(script, data_dir) for _ in range(repeat)]
+        import_seconds, packages, import_error = min(imports, key=lambda run: run[0])
+        result = {
+            'dashboard': script,
+            'import_seconds': round(import_seconds, 4),
+            'packages': {name: round(packages.get(name, 0.0), 4) for name in HEAVY_PACKAGES},
+            'import_error': import_error,
+        }
+
+        if render:
+            renders = [measure_render(script, data_dir, timeout) for _ in range(repeat)]
+            finished = [run for run in renders if run[0] is not None]
+            render_seconds, exceptions = min(finished, key=lambda run: run[0]) if finished else renders[0]
+            result['render_seconds'] = round(render_seconds, 4) if render_seconds is not None else None
+            result['exceptions'] = [message[:200] for message in exceptions]
+
+        results.append(result)
+    return results
+
+def compare_with_baseline(report, baseline, tolerance=0.15):
+    """
+    Сравнение с предыдущим отчетом
+
+    Возвращает список дашбордов, где импорт или первая отрисовка замедлились больше чем на tolerance
+    """
+    previous = {result['dashboard']: result for result in baseline.get('results', [])}
+    regressions = []
+    for result in report['results']:
+        old = previous.get(result['dashboard'])
+        if not old:
+            continue
+        for key in ('import_seconds', 'render_seconds'):
+            if not old.get(key) or result.get(key) is None:
+                continue
+            change = result[key] / old[key] - 1
+            result[f'{key}_change'] = round(change, 4)
+            if change > tolerance and result['dashboard'] not in regressions:
+                regressions.append(result['dashboard'])
+    return regressions
+
+def print_report(report):
+    """Таблица результатов в консоль"""
+    print(f"Каталог данных: {report['data_dir']}, прогонов: {report['repeat']}")
+    print(
+        f"{'Дашборд':<24} {'Импорт, с':>10} {'Отрисовка, с':>13} "
+        + ' '.join(f"{name:>9}" for name in HEAVY_PACKAGES)
+        + f" {'К базе':>8}  Ошибки"
+    )
+    for result in report['results']:
+        render_seconds = result.get('render_seconds')
+        render = f"{render_seconds:>13.2f}" if render_seconds is not None else f"{'-':>13}"
+        changes = [result[key] for key in ('import_seconds_change', 'render_seconds_change') if key in result]
+        change = f"{max(changes):+.0%}" if changes else '-'
+        errors = [result['import_error']] if result['import_error'] else result.get('exceptions', [])
+        print(
+            f"{result['dashboard']:<24} {result['import_seconds']:>10.2f} {render} "
+            + ' '.join(f"{result['packages'][name]:>9.2f}" for name in HEAVY_PACKAGES)
+            + f" {change:>8}  {'; '.join(message.splitlines()[0][:80] for message in errors)}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замер холодного старта дашбордов")
+    parser.add_argument('dashboards', nargs='*', default=DASHBOARDS, help="Файлы дашбордов")
+    parser.add_argument('--data-dir', default=os.getcwd(), help="Каталог с orimex_orders.db")
+    parser.add_argument('--repeat', type=int, default=3, help="Количество прогонов каждого дашборда")
+    parser.add_argument('--no-render', action='store_true', help="Только время импорта")
+    parser.add_argument('--timeout', type=float, default=300, help="Предельное время отрисовки, с")
+    parser.add_argument('--json', help="Сохранить результаты в JSON файл")
+    parser.add_argument('--baseline', help="JSON предыдущего замера для поиска регрессий")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="Допустимое замедление (доля)")
+    args = parser.parse_args()
+
+    data_dir = os.path.abspath(args.data_dir)
+    results = benchmark(args.dashboards, data_dir, args.repeat, not args.no_render, args.timeout)
+
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'data_dir': data_dir,
+        'db_bytes': os.path.getsize(os.path.join(data_dir, 'orimex_orders.db'))
+        if os.path.exists(os.path.join(data_dir, 'orimex_orders.db')) else None,
+        'repeat': args.repeat,
+        'results': results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_with_baseline(report, json.load(f), args.tolerance)
+        report['regressions'] = regressions
+
+    print_report(report)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены: {args.json}")
+
+    if regressions:
+        print(f"❌ Замедление старта больше {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
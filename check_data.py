@@ -4,15 +4,15 @@
 Скрипт для быстрой проверки данных в базе
 """
 
-import sqlite3
 import pandas as pd
 from datetime import datetime
+from db_connections import connect_reader
 
 def check_database():
     """Быстрая проверка содержимого базы данных"""
     
     try:
-        conn = sqlite3.connect('orimex_orders.db')
+        conn = connect_reader('orimex_orders.db')
         
         print("🔍 ПРОВЕРКА БАЗЫ ДАННЫХ ОРИМЭКС")
         print("=" * 50)
@@ -2,19 +2,55 @@
 # -*- coding: utf-8 -*-
 """
 Скрипт для конвертации CSV файла с заказами Оримэкс в SQLite базу данных
+
+Запуск:
+    python csv_to_db.py "Заказы Оримэкс - TDSheet.csv" --db orimex_orders.db
+    python csv_to_db.py --repair-shifted-products --dry-run
 """
 
+import argparse
 import pandas as pd
 import sqlite3
 import numpy as np
 from datetime import datetime
 import re
+import os
+import csv
+import json
+import time
+import hashlib
 import logging
+from contextlib import contextmanager
+
+from db_connections import connect_writer
+from orders_snapshot import write_snapshot
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+@contextmanager
+def stage_timer(timings, stage):
+    """Накопление времени этапа загрузки в словаре timings (None - без замера)"""
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
+def timed_chunks(chunks, timings):
+    """Итерация по пачкам с учетом времени чтения (для потокового режима)"""
+    iterator = iter(chunks)
+    while True:
+        with stage_timer(timings, 'read'):
+            chunk = next(iterator, None)
+        if chunk is None:
+            return
+        yield chunk
+
 def clean_numeric_value(value, debug=False):
     """Очистка числовых значений от пробелов и кавычек"""
     if pd.isna(value) or value == '' or value is None:
@@ -63,89 +99,353 @@ def clean_numeric_value(value, debug=False):
         logger.warning(f"Не удалось преобразовать в число: '{original_value}' -> '{cleaned}'")
         return None
 
-def parse_csv_to_database(csv_file_path, db_path='orimex_orders.db'):
+# Шаблоны очистки чисел (те же правила, что в clean_numeric_value):
+# кавычки и все пробелы, включая неразрывный и тонкий, и десятичная запятая с 1-2 цифрами в конце
+NUMERIC_JUNK_PATTERN = '[" \u00A0\u2009]'
+DECIMAL_COMMA_PATTERN = r',(\d{1,2})$'
+# Простое десятичное число: такие строки преобразуются без обращения к float()
+PLAIN_NUMBER_PATTERN = r'-?\d+(\.\d+)?'
+
+def _plain_numbers(text):
+    """Маска строк-простых чисел и их значения (NaN для остальных)"""
+    plain = text.str.fullmatch(PLAIN_NUMBER_PATTERN).to_numpy(dtype=bool)
+    numbers = np.full(len(text), np.nan)
+    if plain.any():
+        numbers[plain] = text[plain].astype(float).to_numpy()
+    return plain, numbers
+
+def parse_numeric_array(values):
+    """
+    Пакетный разбор числовых значений (те же правила, что в clean_numeric_value)
+    
+    Принимает массив/Series сырых значений, возвращает (numbers, failed):
+    numbers - массив float64 (NaN для пустых и нераспознанных значений),
+    failed - маска непустых значений, которые не удалось преобразовать в число.
+    Простые числа разбираются без очистки, float() вызывается только для
+    редких значений вида '1e3' или 'inf', не подходящих под шаблон.
+    """
+    series = pd.Series(values, dtype=object)
+    numbers = np.full(len(series), np.nan)
+    failed = np.zeros(len(series), dtype=bool)
+    
+    present = series.notna().to_numpy()
+    if not present.any():
+        return numbers, failed
+    
+    text = series[present].astype(str)
+    plain, parsed = _plain_numbers(text)
+    
+    # Очистка нужна только значениям, которые не разобрались как есть
+    dirty = ~plain
+    if dirty.any():
+        cleaned = text[dirty].str.replace(NUMERIC_JUNK_PATTERN, '', regex=True).str.strip()
+        # Последняя запятая - десятичный разделитель, остальные - разделители тысяч
+        cleaned = cleaned.str.replace(DECIMAL_COMMA_PATTERN, r'.\1', regex=True).str.replace(',', '', regex=False)
+        cleaned_plain, cleaned_numbers = _plain_numbers(cleaned)
+        
+        rest = ~cleaned_plain & (cleaned != '').to_numpy()
+        cleaned_failed = np.zeros(len(cleaned), dtype=bool)
+        for position, value in zip(np.flatnonzero(rest), cleaned[rest].tolist()):
+            try:
+                cleaned_numbers[position] = float(value)
+            except ValueError:
+                cleaned_failed[position] = True
+        
+        parsed[dirty] = cleaned_numbers
+        not_parsed = np.zeros(len(text), dtype=bool)
+        not_parsed[dirty] = cleaned_failed
+        failed[present] = not_parsed
+    
+    numbers[present] = parsed
+    return numbers, failed
+
+def log_numeric_failures(failed_values, context=''):
+    """Одно сообщение о всех нераспознанных числах вместо сообщения на каждое значение"""
+    if not len(failed_values):
+        return
+    examples = pd.Series(failed_values, dtype=object).value_counts().head(5)
+    examples = ', '.join(f"'{value}' x{times}" for value, times in examples.items())
+    logger.warning(f"Не удалось преобразовать в число {len(failed_values)} значений{context}, например: {examples}")
+
+def parse_numeric_columns(df, positions):
+    """
+    Пакетный разбор числовых колонок таблицы по их позициям
+    
+    Возвращает (numbers, failed, raw) формы (строки, позиции);
+    позиции за пределами таблицы дают NaN.
+    """
+    raw = np.full((len(df), len(positions)), None, dtype=object)
+    present = [k for k, position in enumerate(positions) if position < df.shape[1]]
+    if present:
+        raw[:, present] = df.iloc[:, [positions[k] for k in present]].to_numpy(dtype=object)
+    numbers, failed = parse_numeric_array(raw.ravel())
+    return numbers.reshape(raw.shape), failed.reshape(raw.shape), raw
+
+def file_md5(file_path, block_size=1024 * 1024):
+    """MD5 файла, вычисляемый по блокам (без чтения файла в память целиком)"""
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def read_csv_chunks(csv_file_path, chunksize, layout):
+    """
+    Потоковое чтение CSV пачками по chunksize строк за один проход по файлу
+    
+    Колонки адресуются по позициям из разметки, поэтому заголовок не используется;
+    все значения читаются как строки, чтобы типы не зависели от пачки.
+    """
+    return pd.read_csv(
+        csv_file_path,
+        encoding='utf-8',
+        header=None,
+        skiprows=layout['header_rows'],
+        dtype=str,
+        chunksize=chunksize
+    )
+
+# Возможные позиции колонок измерений, если их нет в заголовке (см. detect_columns)
+DIMENSION_POSITIONS = {
+    'buyer': [3, 4, 5],
+    'manager': [4, 5, 6],
+    'region': [6, 7, 8],
+    'product_name': [7, 8, 9],
+    'characteristics': [8, 9, 10],
+    'category': [9, 10, 11],
+}
+
+CONTRACTOR_COLUMNS = ['head_contractor', 'buyer', 'manager', 'region']
+PRODUCT_COLUMNS = ['product_name', 'characteristics', 'category']
+
+# Названия колонок измерений в заголовке выгрузки (начало текста ячейки, без учета регистра)
+HEADER_NAMES = {
+    'head_contractor': ('головной контрагент',),
+    'buyer': ('покупатель',),
+    'manager': ('менеджер',),
+    'region': ('регион',),
+    'product_name': ('номенклатура', 'товар'),
+    'characteristics': ('характеристика',),
+    'category': ('категория',),
+}
+
+DATE_HEADER_PATTERN = re.compile(r'\d{2}\.\d{2}\.\d{4}')
+
+def read_header_rows(csv_file_path, count=2):
+    """Первые строки файла, разобранные модулем csv (запятые в кавычках не ломают колонки)"""
+    with open(csv_file_path, 'r', encoding='utf-8', newline='') as f:
+        return [row for _, row in zip(range(count), csv.reader(f))]
+
+def layout_fingerprint(header_rows, first_date):
+    """
+    Отпечаток формата выгрузки: заголовки колонок измерений и позиция первой даты
+    
+    Сами даты в отпечаток не входят, поэтому выгрузки одного формата
+    за разные периоды имеют одинаковый отпечаток.
+    """
+    prefix = [[cell.strip().lower() for cell in row[:first_date]] for row in header_rows]
+    payload = json.dumps([prefix, first_date], ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def parse_header_layout(header_rows):
+    """
+    Разметка по строкам заголовка: колонки дат, число строк заголовка и отпечаток
+    
+    Структура: Дата, пустая колонка, следующая дата, пустая колонка...
+    Под каждой датой во второй строке: "Количество заказов", "Сумма заказов"
+    """
+    first_line = header_rows[0] if header_rows else []
+    date_columns = [
+        (i, cell.strip()) for i, cell in enumerate(first_line)
+        if DATE_HEADER_PATTERN.match(cell.strip())
+    ]
+    first_date = date_columns[0][0] if date_columns else len(first_line)
+    return {
+        # Если даты есть в заголовке, под ними идет строка "Количество/Сумма заказов"
+        'header_rows': 2 if date_columns else 1,
+        'date_columns': date_columns,
+        'fingerprint': layout_fingerprint(header_rows, first_date),
+        'columns': None,
+    }
+
+def detect_columns(csv_file_path, header_rows, layout, sample_rows=1000):
+    """
+    Определение позиций колонок измерений
+    
+    Сначала по названиям в заголовке, затем для ненайденных ролей - по образцу
+    данных: берется первая непустая колонка из возможных позиций (DIMENSION_POSITIONS),
+    не занятая другой ролью и расположенная до колонок дат.
+    """
+    first_date = layout['date_columns'][0][0] if layout['date_columns'] else max(map(len, header_rows), default=0)
+    columns = {}
+    for role, names in HEADER_NAMES.items():
+        for position in range(first_date):
+            cells = [row[position].strip().lower() for row in header_rows if position < len(row)]
+            if position not in columns.values() and any(cell.startswith(names) for cell in cells):
+                columns[role] = position
+                break
+    
+    missing = [role for role in HEADER_NAMES if role not in columns]
+    if not missing:
+        return columns
+    
+    with open(csv_file_path, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        sample = [row for _, row in zip(range(layout['header_rows'] + sample_rows), reader)]
+    sample = sample[layout['header_rows']:]
+    
+    def filled(position):
+        return any(position < len(row) and row[position].strip() for row in sample)
+    
+    for role in missing:
+        candidates = [
+            position for position in DIMENSION_POSITIONS.get(role, [0])
+            if position < first_date and position not in columns.values()
+        ]
+        chosen = next((position for position in candidates if filled(position)), None)
+        if chosen is None and candidates:
+            chosen = candidates[0]
+        if chosen is not None:
+            columns[role] = chosen
+    
+    logger.info(f"Колонки определены по образцу данных для: {', '.join(missing)}")
+    return columns
+
+def get_file_layout(csv_file_path, cursor=None):
+    """
+    Разметка файла: колонки дат из заголовка и позиции колонок измерений
+    
+    Позиции измерений сохраняются в таблице file_layouts по отпечатку формата
+    и при повторных загрузках того же формата не определяются заново.
+    """
+    header_rows = read_header_rows(csv_file_path)
+    layout = parse_header_layout(header_rows)
+    
+    if cursor is not None:
+        cursor.execute("SELECT columns FROM file_layouts WHERE fingerprint = ?", (layout['fingerprint'],))
+        row = cursor.fetchone()
+        if row:
+            layout['columns'] = json.loads(row[0])
+            logger.info(f"Формат выгрузки известен ({layout['fingerprint'][:12]}), колонки: {layout['columns']}")
+            return layout
+    
+    layout['columns'] = detect_columns(csv_file_path, header_rows, layout)
+    logger.info(f"Определен формат выгрузки ({layout['fingerprint'][:12]}), колонки: {layout['columns']}")
+    
+    if cursor is not None:
+        cursor.execute(
+            "INSERT OR REPLACE INTO file_layouts (fingerprint, columns) VALUES (?, ?)",
+            (layout['fingerprint'], json.dumps(layout['columns']))
+        )
+    return layout
+
+# Источник заказов общей выгрузки (parse_csv_to_database);
+# batch_ingest загружает выгрузки филиалов с источником по имени файла
+DEFAULT_SOURCE = 'main'
+
+def parse_csv_to_database(csv_file_path, db_path='orimex_orders.db', engine='vectorized', chunksize=None,
+                          bulk_load=False, rebuild_indexes=False, timings=None, source=DEFAULT_SOURCE):
     """
     Парсинг CSV файла и создание нормализованной базы данных
+    
+    engine='vectorized' - векторная обработка всей таблицы (process_data_frame),
+    engine='rows' - построчная обработка (process_data_rows).
+    При ошибке векторной обработки автоматически используется построчная.
+    
+    Ячейки файла накапливаются во временной таблице (stage_orders) и переносятся
+    в orders одним шагом вместе с регистрацией файла (merge_staged_orders):
+    записываются только новые и измененные ячейки, заказы источника за даты
+    выгрузки, которых в ней больше нет, удаляются. Прерванная загрузка
+    не оставляет в orders ничего.
+    
+    chunksize - потоковый режим: файл читается один раз пачками по chunksize строк,
+    каждая пачка обрабатывается отдельно, в памяти Python не держится весь файл.
+    Повторы ключа заказа из разных пачек суммируются так же, как внутри пачки,
+    поэтому заказы в БД совпадают с загрузкой файла целиком.
+    
+    bulk_load - режим массовой загрузки (WAL, synchronous=OFF, большой кеш страниц),
+    после загрузки прежние настройки восстанавливаются.
+    rebuild_indexes - удалить вторичные индексы заказов на время переноса ячеек
+    в orders и построить их заново сразу после него (имеет смысл для больших файлов).
+    
+    source - выгрузка, к которой относятся заказы файла (см. ensure_natural_key):
+    повторная выгрузка того же источника заменяет его заказы за свои даты.
+    
+    timings - словарь, в который записывается время этапов векторной загрузки
+    в секундах: read, clean, dimensions, insert (см. benchmark_ingest.py).
     """
     logger.info(f"Начинаем обработку файла: {csv_file_path}")
     
     # Вычисляем хеш файла для предотвращения дублирования
-    import hashlib
-    with open(csv_file_path, 'rb') as f:
-        file_hash = hashlib.md5(f.read()).hexdigest()
+    with stage_timer(timings, 'read'):
+        file_hash = file_md5(csv_file_path)
     logger.info(f"Хеш файла: {file_hash}")
     
-    # Читаем CSV файл
-    try:
-        # Читаем первые несколько строк для понимания структуры
-        df_header = pd.read_csv(csv_file_path, nrows=2, encoding='utf-8')
-        logger.info(f"Заголовки файла: {df_header.columns.tolist()}")
-        
-        # Проверяем, есть ли даты в заголовках
-        has_dates = any('2025' in str(col) for col in df_header.columns)
-        logger.info(f"Найдены даты в заголовках: {has_dates}")
-        
-        if has_dates:
-            # Если есть даты в заголовках, пропускаем первые 2 строки
-            df = pd.read_csv(csv_file_path, skiprows=2, encoding='utf-8', low_memory=False)
-        else:
-            # Если дат нет, читаем весь файл
-            df = pd.read_csv(csv_file_path, encoding='utf-8', low_memory=False)
-            
-        logger.info(f"Загружено строк данных: {len(df)}")
-        
-        # Если загружено мало строк, попробуем другой подход
-        if len(df) < 1000:
-            logger.warning(f"Загружено мало строк ({len(df)}), пробуем другой подход...")
-            # Пробуем читать без пропуска строк
-            df_alt = pd.read_csv(csv_file_path, encoding='utf-8', low_memory=False)
-            logger.info(f"Альтернативное чтение: {len(df_alt)} строк")
-            
-            # Если альтернативное чтение дало больше строк, используем его
-            if len(df_alt) > len(df):
-                df = df_alt
-                logger.info("Используем альтернативное чтение")
-        
-    except Exception as e:
-        logger.error(f"Ошибка при чтении CSV файла: {e}")
-        return False
-    
-    # Создаем соединение с базой данных
-    conn = sqlite3.connect(db_path)
+    # Создаем соединение с базой данных (писатель в режиме WAL: дашборды читают не блокируясь)
+    conn = connect_writer(db_path)
     cursor = conn.cursor()
+    saved_pragmas = begin_bulk_load(cursor) if bulk_load else None
     
     try:
         # Создаем таблицы
         create_tables(cursor)
         
-        # Проверяем, не был ли уже обработан этот файл
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE file_hash = ?", (file_hash,))
-        existing_records = cursor.fetchone()[0]
-        if existing_records > 0:
+        # Кеш ключей контрагентов и продуктов, общий для всех загрузок в эту БД
+        dimensions = get_dimension_cache(db_path)
+        dimensions.sync(cursor)
+        conn.commit()
+        
+        # Проверяем, не был ли уже полностью загружен этот файл
+        if is_file_ingested(cursor, file_hash):
             logger.warning(f"Файл с хешем {file_hash} уже был обработан ранее! Пропускаем загрузку.")
-            conn.close()
             return True
         
-        # Получаем названия колонок из первых двух строк исходного файла
-        with open(csv_file_path, 'r', encoding='utf-8') as f:
-            first_line = f.readline().strip().split(',')
-            second_line = f.readline().strip().split(',')
+        # Разметка файла: строки заголовка, колонки дат и измерений
+        layout = get_file_layout(csv_file_path, cursor)
+        conn.commit()
+        logger.info(f"Найдено дат: {len(layout['date_columns'])}")
+        
+        # Читаем CSV файл
+        if chunksize:
+            logger.info(f"Потоковое чтение пачками по {chunksize} строк")
+            chunks = timed_chunks(read_csv_chunks(csv_file_path, chunksize, layout), timings)
+        else:
+            with stage_timer(timings, 'read'):
+                try:
+                    df = pd.read_csv(
+                        csv_file_path, encoding='utf-8', header=None,
+                        skiprows=layout['header_rows'], dtype=str
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка при чтении CSV файла: {e}")
+                    return False
+            logger.info(f"Загружено строк данных: {len(df)}")
+            chunks = [df]
+        
+        # Обрабатываем строки данных (в потоковом режиме - пачка за пачкой)
+        totals = {}
+        for chunk_number, chunk in enumerate(chunks, 1):
+            stats = process_chunk(chunk, cursor, layout, file_hash, dimensions, engine, timings)
+            for key, value in (stats or {}).items():
+                totals[key] = totals.get(key, 0) + value
+            
+            if chunksize:
+                conn.commit()
+                logger.info(f"Пачка {chunk_number}: {len(chunk)} строк, заказов: {(stats or {}).get('orders', '-')}")
         
-        # Определяем колонки с датами (начиная с 11-й колонки)
-        # Структура: Дата, пустая колонка, следующая дата, пустая колонка...
-        # Под каждой датой в строке 2: "Количество заказов", "Сумма заказов"
-        # Исключаем последние 2 колонки (Итого)
-        date_columns = []
-        for i in range(10, len(first_line)-3, 2):  # Исключаем последние 3 колонки (Итого + 2 колонки данных)
-            if i < len(first_line):
-                date_str = first_line[i].strip()
-                if re.match(r'\d{2}\.\d{2}\.\d{4}', date_str):
-                    date_columns.append((i, date_str))
+        if totals:
+            log_processing_summary(totals)
         
-        logger.info(f"Найдено дат: {len(date_columns)}")
+        # Ячейки файла переносятся в orders только после обработки всех пачек,
+        # в одной транзакции с пересчетом куба и регистрацией файла
+        export_dates = [date for _, date in parse_date_columns(layout['date_columns'])]
+        with stage_timer(timings, 'insert'):
+            merged = merge_staged_orders(cursor, file_hash, source, export_dates, rebuild_indexes)
         
-        # Обрабатываем каждую строку данных
-        process_data_rows(df, cursor, date_columns, file_hash)
+        # Дневной куб пересчитывается за даты, где заказы изменились
+        # (при rebuild_indexes индексы уже построены заново)
+        refresh_daily_agg(cursor, merged['dates'])
+        register_ingested_file(cursor, file_hash, csv_file_path)
         
         # Сохраняем изменения
         conn.commit()
@@ -157,12 +457,51 @@ def parse_csv_to_database(csv_file_path, db_path='orimex_orders.db'):
     except Exception as e:
         logger.error(f"Ошибка при создании базы данных: {e}")
         conn.rollback()
+        # Откаченные ключи не должны остаться в кеше
+        get_dimension_cache(db_path).clear()
         return False
     finally:
+        # Безопасные настройки восстанавливаются и после ошибки
+        # (удаленные индексы возвращает откат транзакции переноса)
+        if saved_pragmas:
+            end_bulk_load(cursor, saved_pragmas)
         conn.close()
     
+    # Колоночный снимок для дашбордов; ошибка снимка не отменяет загрузку
+    try:
+        write_snapshot(db_path)
+    except Exception as e:
+        logger.warning(f"Не удалось записать снимок заказов: {e}")
+    
     return True
 
+def process_chunk(df, cursor, layout, file_hash, dimensions, engine='vectorized', timings=None):
+    """
+    Обработка пачки строк выбранным способом
+    
+    Векторная обработка выполняется внутри точки сохранения: при ошибке
+    ее изменения откатываются и пачка обрабатывается построчно.
+    Возвращает статистику векторной обработки (None для построчной).
+    """
+    if engine != 'vectorized':
+        process_data_rows(df, cursor, layout, file_hash)
+        # Построчный путь создает ключи в обход кеша
+        dimensions.sync(cursor)
+        return None
+    
+    cursor.execute('SAVEPOINT vectorized_load')
+    try:
+        stats = process_data_frame(df, cursor, layout, file_hash, dimensions, timings)
+        cursor.execute('RELEASE SAVEPOINT vectorized_load')
+        return stats
+    except Exception as e:
+        logger.warning(f"Векторная обработка не удалась ({e}), переходим к построчной обработке")
+        cursor.execute('ROLLBACK TO SAVEPOINT vectorized_load')
+        cursor.execute('RELEASE SAVEPOINT vectorized_load')
+        process_data_rows(df, cursor, layout, file_hash)
+        dimensions.sync(cursor)
+        return None
+
 def create_tables(cursor):
     """Создание таблиц базы данных"""
     
@@ -189,8 +528,8 @@ def create_tables(cursor):
     )
     ''')
     
-    # Таблица заказов
-    cursor.execute('''
+    # Таблица заказов (source - выгрузка, из которой пришел заказ, см. ensure_natural_key)
+    cursor.execute(f'''
         CREATE TABLE IF NOT EXISTS orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             contractor_id INTEGER,
@@ -199,74 +538,478 @@ def create_tables(cursor):
             quantity REAL,
             amount REAL,
             file_hash TEXT,
+            source TEXT NOT NULL DEFAULT '{DEFAULT_SOURCE}',
             FOREIGN KEY (contractor_id) REFERENCES contractors (id),
             FOREIGN KEY (product_id) REFERENCES products (id)
         )
     ''')
     
     # Индексы для ускорения запросов
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_date ON orders (order_date)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_contractor ON orders (contractor_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_product ON orders (product_id)')
+    create_order_indexes(cursor)
+    
+    # Естественный ключ заказа: одна ячейка выгрузки = одна запись своего источника
+    ensure_natural_key(cursor)
+    
+    # Реестр полностью загруженных файлов
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'ingested_files'")
+    registry_exists = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ingested_files (
+        file_hash TEXT PRIMARY KEY,
+        file_name TEXT,
+        loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    if not registry_exists:
+        # Файлы, загруженные до появления реестра
+        cursor.execute('''
+        INSERT OR IGNORE INTO ingested_files (file_hash)
+        SELECT DISTINCT file_hash FROM orders WHERE file_hash IS NOT NULL
+        ''')
+    
+    # Разметка форматов выгрузок (позиции колонок измерений по отпечатку заголовка)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS file_layouts (
+        fingerprint TEXT PRIMARY KEY,
+        columns TEXT,
+        detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    
+    # Дневной куб для временных рядов дашбордов (после всех миграций заказов)
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'daily_agg'")
+    cube_exists = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_agg (
+        order_date DATE,
+        manager TEXT,
+        region TEXT,
+        category TEXT,
+        orders INTEGER,
+        quantity REAL,
+        amount REAL,
+        amount_sq REAL,
+        PRIMARY KEY (order_date, manager, region, category)
+    )
+    ''')
+    if not cube_exists:
+        refresh_daily_agg(cursor)
+
+# Итоги заказов за день по менеджеру, региону и категории для куба daily_agg.
+# Заказы уже уникальны по (source, order_date, contractor_id, product_id), поэтому куб
+# хранится на уровне измерений, по которым строятся временные ряды дашбордов.
+# amount_sq (сумма квадратов) нужна для дисперсии суммы заказа.
+DAILY_AGG_SOURCE_QUERY = '''
+SELECT
+    o.order_date,
+    COALESCE(c.manager, '') AS manager,
+    COALESCE(c.region, '') AS region,
+    COALESCE(p.category, '') AS category,
+    COUNT(*) AS orders,
+    SUM(o.quantity) AS quantity,
+    SUM(o.amount) AS amount,
+    SUM(o.amount * o.amount) AS amount_sq
+FROM orders o
+JOIN contractors c ON o.contractor_id = c.id
+JOIN products p ON o.product_id = p.id
+WHERE o.amount IS NOT NULL AND o.amount > 0 {condition}
+GROUP BY o.order_date, 2, 3, 4
+'''
+
+def refresh_daily_agg(cursor, dates=None):
+    """
+    Пересчет дневного куба daily_agg
+    
+    dates - даты заказов (YYYY-MM-DD), затронутые загрузкой; None - полный пересчет.
+    Итоги каждой даты пересчитываются по orders целиком, поэтому измененные
+    и удаленные заказы учитываются так же, как новые.
+    """
+    if dates is None:
+        cursor.execute("DELETE FROM daily_agg")
+        cursor.execute("INSERT INTO daily_agg " + DAILY_AGG_SOURCE_QUERY.format(condition=''))
+        logger.info("Дневной куб daily_agg пересчитан полностью")
+        return
+    
+    dates = sorted(set(dates))
+    if not dates:
+        return
+    
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS daily_agg_dates (order_date TEXT PRIMARY KEY)")
+    cursor.execute("DELETE FROM daily_agg_dates")
+    cursor.executemany("INSERT INTO daily_agg_dates VALUES (?)", [(date,) for date in dates])
+    cursor.execute("DELETE FROM daily_agg WHERE order_date IN (SELECT order_date FROM daily_agg_dates)")
+    cursor.execute("INSERT INTO daily_agg " + DAILY_AGG_SOURCE_QUERY.format(
+        condition="AND o.order_date IN (SELECT order_date FROM daily_agg_dates)"
+    ))
+    logger.info(f"Дневной куб daily_agg обновлен за дат: {len(dates)}")
+
+# Продукты, у которых характеристика совпадает с категорией (см. repair_shifted_products)
+SHIFTED_PRODUCTS_CONDITION = "characteristics = category AND category <> ''"
+
+def repair_shifted_products(cursor, dry_run=False):
+    """
+    Исправление продуктов, загруженных до определения разметки файла
+    
+    Раньше при пустой характеристике в нее попадало значение следующей колонки
+    (категории). Такие продукты сводятся к ключу с пустой характеристикой,
+    их заказы переносятся; при совпадении ключа заказа остается более новая запись.
+    Совпадение характеристики с категорией бывает и в правильных данных, поэтому
+    исправление не запускается автоматически (python csv_to_db.py --repair-shifted-products).
+    
+    dry_run - только посчитать, ничего не меняя.
+    Возвращает число затронутых продуктов и их заказов.
+    """
+    cursor.execute(f"SELECT COUNT(*) FROM products WHERE {SHIFTED_PRODUCTS_CONDITION}")
+    products = cursor.fetchone()[0]
+    cursor.execute(
+        f"SELECT COUNT(*) FROM orders WHERE product_id IN (SELECT id FROM products WHERE {SHIFTED_PRODUCTS_CONDITION})"
+    )
+    orders = cursor.fetchone()[0]
+    if dry_run or not products:
+        return products, orders
+    
+    cursor.execute(f'''
+    INSERT OR IGNORE INTO products (name, characteristics, category)
+    SELECT name, '', category FROM products
+    WHERE {SHIFTED_PRODUCTS_CONDITION}
+    ''')
+    cursor.execute('''
+    CREATE TEMP TABLE product_repair AS
+    SELECT shifted.id AS old_id, fixed.id AS new_id
+    FROM products shifted
+    JOIN products fixed
+        ON fixed.name = shifted.name AND fixed.characteristics = '' AND fixed.category = shifted.category
+    WHERE shifted.characteristics = shifted.category AND shifted.category <> ''
+    ''')
+    
+    # Из пары заказов с одинаковым ключом удаляется более старый
+    cursor.execute('''
+    DELETE FROM orders WHERE id IN (
+        SELECT MIN(shifted.id, fixed.id)
+        FROM orders shifted
+        JOIN product_repair r ON shifted.product_id = r.old_id
+        JOIN orders fixed
+            ON fixed.product_id = r.new_id
+            AND fixed.source = shifted.source
+            AND fixed.contractor_id = shifted.contractor_id
+            AND fixed.order_date = shifted.order_date
+    )
+    ''')
+    cursor.execute('''
+    UPDATE orders SET product_id = (SELECT new_id FROM product_repair WHERE old_id = orders.product_id)
+    WHERE product_id IN (SELECT old_id FROM product_repair)
+    ''')
+    cursor.execute("DELETE FROM products WHERE id IN (SELECT old_id FROM product_repair)")
+    cursor.execute("DROP TABLE product_repair")
+    
+    # Удаленные дубли меняют итоги дней
+    refresh_daily_agg(cursor)
+    logger.info(f"Исправлено продуктов со сдвинутой характеристикой: {products}, их заказов: {orders}")
+    return products, orders
+
+def repair_database(db_path='orimex_orders.db', dry_run=False):
+    """Запуск repair_shifted_products для БД (команда обслуживания)"""
+    conn = connect_writer(db_path)
+    cursor = conn.cursor()
+    try:
+        create_tables(cursor)
+        products, orders = repair_shifted_products(cursor, dry_run)
+        conn.commit()
+    finally:
+        conn.close()
+    
+    if products and not dry_run:
+        get_dimension_cache(db_path).clear()
+        try:
+            write_snapshot(db_path)
+        except Exception as e:
+            logger.warning(f"Не удалось записать снимок заказов: {e}")
+    return products, orders
+
+# Вторичные индексы заказов (уникальный индекс естественного ключа сюда не входит:
+# он нужен для переноса ячеек в orders и не удаляется при массовой загрузке)
+ORDER_INDEXES = {
+    'idx_orders_date': 'order_date',
+    'idx_orders_contractor': 'contractor_id',
+    'idx_orders_product': 'product_id',
+}
+
+def create_order_indexes(cursor):
+    """Создание вторичных индексов заказов"""
+    for name, column in ORDER_INDEXES.items():
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON orders ({column})')
+
+def drop_order_indexes(cursor):
+    """Удаление вторичных индексов заказов на время массовой загрузки"""
+    for name in ORDER_INDEXES:
+        cursor.execute(f'DROP INDEX IF EXISTS {name}')
+    logger.info("Вторичные индексы заказов удалены до конца загрузки")
 
-def process_data_rows(df, cursor, date_columns, file_hash):
-    """Обработка строк данных"""
+# Настройки соединения на время массовой загрузки.
+# synchronous=OFF допустим: загрузка идемпотентна (upsert + реестр файлов)
+# и после сбоя файл можно просто загрузить повторно.
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'OFF',
+    'cache_size': -262144,  # 256 МБ
+    'temp_store': 'MEMORY',
+}
+
+def begin_bulk_load(cursor):
+    """
+    Включение режима массовой загрузки
+    
+    Возвращает прежние значения настроек для end_bulk_load
+    """
+    saved = {}
+    for name, value in BULK_LOAD_PRAGMAS.items():
+        saved[name] = cursor.execute(f'PRAGMA {name}').fetchone()[0]
+        cursor.execute(f'PRAGMA {name} = {value}')
+    logger.info(f"Режим массовой загрузки: {BULK_LOAD_PRAGMAS}")
+    return saved
+
+def end_bulk_load(cursor, saved):
+    """Восстановление настроек соединения после массовой загрузки"""
+    for name, value in saved.items():
+        try:
+            cursor.execute(f'PRAGMA {name} = {value}')
+        except sqlite3.Error as e:
+            # Например, журнал нельзя переключить, пока БД открыта другим соединением
+            logger.warning(f"Не удалось восстановить PRAGMA {name} = {value}: {e}")
+    logger.info("Настройки базы данных после массовой загрузки восстановлены")
+
+def ensure_natural_key(cursor):
+    """
+    Уникальный индекс заказов по (source, contractor_id, product_id, order_date)
+    
+    source - выгрузка, из которой пришел заказ (общая выгрузка или филиал):
+    ключи разных выгрузок могут совпадать, их заказы хранятся отдельно.
+    В существующей БД заказам без источника назначается DEFAULT_SOURCE, а дубли
+    ключа объединяются: остается последняя загруженная запись ключа, в нее
+    суммируются количества и суммы всех записей ключа из того же файла.
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'idx_orders_source_key'")
+    if cursor.fetchone():
+        return
+    
+    cursor.execute("PRAGMA table_info(orders)")
+    if 'source' not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE orders ADD COLUMN source TEXT NOT NULL DEFAULT '{DEFAULT_SOURCE}'")
+    
+    cursor.execute('''
+    UPDATE orders SET
+        quantity = (
+            SELECT SUM(d.quantity) FROM orders d
+            WHERE d.source IS orders.source AND d.contractor_id IS orders.contractor_id
+                AND d.product_id IS orders.product_id AND d.order_date IS orders.order_date
+                AND d.file_hash IS orders.file_hash
+        ),
+        amount = (
+            SELECT SUM(d.amount) FROM orders d
+            WHERE d.source IS orders.source AND d.contractor_id IS orders.contractor_id
+                AND d.product_id IS orders.product_id AND d.order_date IS orders.order_date
+                AND d.file_hash IS orders.file_hash
+        )
+    WHERE id IN (
+        SELECT MAX(id) FROM orders GROUP BY source, contractor_id, product_id, order_date HAVING COUNT(*) > 1
+    )
+    ''')
+    
+    cursor.execute('''
+    DELETE FROM orders WHERE id NOT IN (
+        SELECT MAX(id) FROM orders GROUP BY source, contractor_id, product_id, order_date
+    )
+    ''')
+    if cursor.rowcount > 0:
+        logger.info(f"Удалено дублей заказов: {cursor.rowcount}")
+    
+    # Прежний ключ без источника
+    cursor.execute("DROP INDEX IF EXISTS idx_orders_natural_key")
+    cursor.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_source_key
+    ON orders (source, contractor_id, product_id, order_date)
+    ''')
+
+def is_file_ingested(cursor, file_hash):
+    """Был ли файл с таким хешем полностью загружен"""
+    cursor.execute("SELECT 1 FROM ingested_files WHERE file_hash = ?", (file_hash,))
+    return cursor.fetchone() is not None
+
+def register_ingested_file(cursor, file_hash, file_name=None):
+    """Отметить файл как полностью загруженный"""
+    cursor.execute(
+        "INSERT OR REPLACE INTO ingested_files (file_hash, file_name) VALUES (?, ?)",
+        (file_hash, os.path.basename(file_name) if file_name else None)
+    )
+
+# Ячейки загружаемого файла накапливаются во временной таблице соединения
+# и переносятся в orders одним шагом после чтения всего файла (merge_staged_orders).
+# Повторы ключа внутри файла суммируются, в том числе из разных пачек, поэтому
+# результат не зависит от размера пачки. Сумма NULL, только если суммы нет
+# ни в одной из строк (как sum(min_count=1)).
+STAGED_ORDERS_TABLE_SQL = '''
+CREATE TEMP TABLE IF NOT EXISTS staged_orders (
+    file_hash TEXT,
+    contractor_id INTEGER,
+    product_id INTEGER,
+    order_date DATE,
+    quantity REAL,
+    amount REAL,
+    PRIMARY KEY (file_hash, contractor_id, product_id, order_date)
+)
+'''
+
+STAGE_ORDER_SQL = '''
+INSERT INTO staged_orders (file_hash, contractor_id, product_id, order_date, quantity, amount)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (file_hash, contractor_id, product_id, order_date) DO UPDATE SET
+    quantity = staged_orders.quantity + excluded.quantity,
+    amount = COALESCE(staged_orders.amount + excluded.amount, staged_orders.amount, excluded.amount)
+'''
+
+# Даты, на которых ячейки файла добавляют или меняют заказы источника
+CHANGED_DATES_SQL = '''
+SELECT DISTINCT s.order_date
+FROM staged_orders s
+LEFT JOIN orders o
+    ON o.source = ? AND o.contractor_id = s.contractor_id
+    AND o.product_id = s.product_id AND o.order_date = s.order_date
+WHERE s.file_hash = ? AND (o.id IS NULL OR o.quantity IS NOT s.quantity OR o.amount IS NOT s.amount)
+'''
+
+# Заказы источника за даты выгрузки, которых в ней больше нет
+STALE_ORDERS_SQL = '''
+SELECT o.id, o.order_date
+FROM orders o
+WHERE o.source = ? AND o.order_date IN (SELECT order_date FROM export_dates)
+    AND NOT EXISTS (
+        SELECT 1 FROM staged_orders s
+        WHERE s.file_hash = ? AND s.contractor_id = o.contractor_id
+            AND s.product_id = o.product_id AND s.order_date = o.order_date
+    )
+'''
+
+# Перенос ячеек файла в orders. Неизмененная ячейка не переписывается (условие
+# WHERE), поэтому повторная загрузка выгрузки записывает только разницу,
+# а rowcount - число добавленных и измененных заказов. Заказ помечается
+# хешем файла, который последним изменил его значение.
+MERGE_STAGED_ORDERS_SQL = '''
+INSERT INTO orders (source, contractor_id, product_id, order_date, quantity, amount, file_hash)
+SELECT ?, contractor_id, product_id, order_date, quantity, amount, file_hash
+FROM staged_orders WHERE file_hash = ?
+ORDER BY rowid
+ON CONFLICT (source, contractor_id, product_id, order_date) DO UPDATE SET
+    quantity = excluded.quantity,
+    amount = excluded.amount,
+    file_hash = excluded.file_hash
+WHERE orders.quantity IS NOT excluded.quantity OR orders.amount IS NOT excluded.amount
+'''
+
+def stage_orders(cursor, orders, file_hash):
+    """
+    Добавление заказов пачки к накопленным ячейкам файла
+    
+    orders - DataFrame с колонками contractor_id, product_id, order_date, quantity, amount.
+    Повторы ключа внутри пачки суммируются, с ячейками этого же файла из прежних
+    пачек - тоже (STAGE_ORDER_SQL). В orders ничего не пишется до merge_staged_orders.
+    """
+    key = ['contractor_id', 'product_id', 'order_date']
+    if orders.duplicated(key).any():
+        orders = orders.groupby(key, sort=False, as_index=False)[['quantity', 'amount']].sum(min_count=1)
+    
+    amounts = [None if np.isnan(value) else value for value in orders['amount'].tolist()]
+    cursor.execute(STAGED_ORDERS_TABLE_SQL)
+    cursor.executemany(STAGE_ORDER_SQL, zip(
+        [file_hash] * len(amounts), orders['contractor_id'].tolist(), orders['product_id'].tolist(),
+        orders['order_date'].tolist(), orders['quantity'].tolist(), amounts
+    ))
+
+def discard_staged_orders(cursor, file_hash):
+    """Удаление накопленных ячеек файла (например, после ошибки записи его пачки)"""
+    cursor.execute(STAGED_ORDERS_TABLE_SQL)
+    cursor.execute("DELETE FROM staged_orders WHERE file_hash = ?", (file_hash,))
+
+def merge_staged_orders(cursor, file_hash, source, export_dates, rebuild_indexes=False):
+    """
+    Перенос накопленных ячеек файла в orders
+    
+    Выгрузка - полное состояние своего источника (source) за свои даты (export_dates):
+    новые ячейки добавляются, измененные обновляются, неизмененные не переписываются,
+    а заказы источника за эти даты, которых в выгрузке больше нет (ячейка очищена
+    или строка удалена), удаляются. Другие даты и другие источники не затрагиваются.
+    rebuild_indexes - вставка без вторичных индексов с их построением сразу после нее.
+    Выполняется в транзакции вызывающего кода, вместе с регистрацией файла.
+    
+    Возвращает словарь: cells (ячеек в файле), changed (добавлено или изменено),
+    removed (удалено), dates (даты изменений для refresh_daily_agg).
+    """
+    cursor.execute(STAGED_ORDERS_TABLE_SQL)
+    cursor.execute("SELECT COUNT(*) FROM staged_orders WHERE file_hash = ?", (file_hash,))
+    cells = cursor.fetchone()[0]
+    
+    cursor.execute(CHANGED_DATES_SQL, (source, file_hash))
+    dates = {row[0] for row in cursor.fetchall()}
+    
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS export_dates (order_date TEXT PRIMARY KEY)")
+    cursor.execute("DELETE FROM export_dates")
+    cursor.executemany("INSERT OR IGNORE INTO export_dates VALUES (?)", [(date,) for date in export_dates])
+    cursor.execute(STALE_ORDERS_SQL, (source, file_hash))
+    stale = cursor.fetchall()
+    dates.update(order_date for _, order_date in stale)
+    
+    if rebuild_indexes:
+        drop_order_indexes(cursor)
+    cursor.execute(MERGE_STAGED_ORDERS_SQL, (source, file_hash))
+    changed = max(cursor.rowcount, 0)
+    if rebuild_indexes:
+        create_order_indexes(cursor)
+    
+    cursor.executemany("DELETE FROM orders WHERE id = ?", [(order_id,) for order_id, _ in stale])
+    discard_staged_orders(cursor, file_hash)
+    
+    logger.info(
+        f"Выгрузка {source}: ячеек {cells}, добавлено или изменено {changed}, "
+        f"без изменений {cells - changed}, удалено отсутствующих в выгрузке {len(stale)}"
+    )
+    return {'cells': cells, 'changed': changed, 'removed': len(stale), 'dates': sorted(dates)}
+
+def _row_text(row, position):
+    """Значение ячейки строки в виде текста ('' для пустых и отсутствующих колонок)"""
+    if position is None or position >= len(row) or pd.isna(row.iloc[position]):
+        return ''
+    value = str(row.iloc[position])
+    return value if value.strip() else ''
+
+def process_data_rows(df, cursor, layout, file_hash):
+    """
+    Обработка строк данных (построчный путь)
+    
+    Правила те же, что до появления векторной обработки: строка за строкой,
+    clean_numeric_value и разбор даты для каждой ячейки, get_or_create_* для
+    каждой строки. Позиции колонок берутся из разметки файла, ячейки
+    накапливаются в staged_orders (STAGE_ORDER_SQL), как и у векторной обработки.
+    """
     
     processed_count = 0
     skipped_empty = 0
     skipped_total = 0
     
+    date_columns = layout['date_columns']
+    columns = layout['columns']
+    cursor.execute(STAGED_ORDERS_TABLE_SQL)
+    
     for index, row in df.iterrows():
         if index % 1000 == 0:
             logger.info(f"Обработано строк: {index}, добавлено записей: {processed_count}")
         
-        # Извлекаем основную информацию
-        # Определяем индексы колонок динамически
-        head_contractor = str(row.iloc[0]) if pd.notna(row.iloc[0]) else ''
-        
-        # Ищем колонку с покупателем (может быть на разных позициях)
-        buyer = ''
-        manager = ''
-        region = ''
-        product_name = ''
-        characteristics = ''
-        category = ''
-        
-        # Проверяем разные возможные позиции для buyer
-        for i in [3, 4, 5]:
-            if i < len(row) and pd.notna(row.iloc[i]) and str(row.iloc[i]).strip():
-                buyer = str(row.iloc[i])
-                break
-        
-        # Проверяем разные возможные позиции для manager
-        for i in [4, 5, 6]:
-            if i < len(row) and pd.notna(row.iloc[i]) and str(row.iloc[i]).strip():
-                manager = str(row.iloc[i])
-                break
-        
-        # Проверяем разные возможные позиции для region
-        for i in [6, 7, 8]:
-            if i < len(row) and pd.notna(row.iloc[i]) and str(row.iloc[i]).strip():
-                region = str(row.iloc[i])
-                break
-        
-        # Проверяем разные возможные позиции для product_name
-        for i in [7, 8, 9]:
-            if i < len(row) and pd.notna(row.iloc[i]) and str(row.iloc[i]).strip():
-                product_name = str(row.iloc[i])
-                break
-        
-        # Проверяем разные возможные позиции для characteristics
-        for i in [8, 9, 10]:
-            if i < len(row) and pd.notna(row.iloc[i]) and str(row.iloc[i]).strip():
-                characteristics = str(row.iloc[i])
-                break
-        
-        # Проверяем разные возможные позиции для category
-        for i in [9, 10, 11]:
-            if i < len(row) and pd.notna(row.iloc[i]) and str(row.iloc[i]).strip():
-                category = str(row.iloc[i])
-                break
+        # Извлекаем основную информацию по позициям колонок из разметки
+        head_contractor = _row_text(row, columns.get('head_contractor'))
+        buyer = _row_text(row, columns.get('buyer'))
+        manager = _row_text(row, columns.get('manager'))
+        region = _row_text(row, columns.get('region'))
+        product_name = _row_text(row, columns.get('product_name'))
+        characteristics = _row_text(row, columns.get('characteristics'))
+        category = _row_text(row, columns.get('category'))
         
         # Пропускаем пустые строки и строки итогов
         if not any([head_contractor, buyer, product_name]) or not head_contractor.strip() or not buyer.strip() or not product_name.strip():
@@ -290,7 +1033,6 @@ def process_data_rows(df, cursor, date_columns, file_hash):
                 # Преобразуем дату
                 order_date = datetime.strptime(date_str, '%d.%m.%Y').date()
                 
-
                 # В CSV структура: дата, пустая колонка, следующая дата...
                 # В данных: количество в той же колонке что и дата, сумма в следующей
                 quantity = None
@@ -310,10 +1052,9 @@ def process_data_rows(df, cursor, date_columns, file_hash):
                 
                 # Добавляем заказ только если есть данные о количестве
                 if quantity is not None and quantity > 0:
-                    cursor.execute('''
-                    INSERT INTO orders (contractor_id, product_id, order_date, quantity, amount, file_hash)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                    ''', (contractor_id, product_id, order_date, quantity, amount, file_hash))
+                    cursor.execute(STAGE_ORDER_SQL, (
+                        file_hash, contractor_id, product_id, order_date.isoformat(), quantity, amount
+                    ))
                     
             except (ValueError, IndexError) as e:
                 continue  # Пропускаем некорректные данные
@@ -326,6 +1067,254 @@ def process_data_rows(df, cursor, date_columns, file_hash):
     logger.info(f"Пропущено пустых: {skipped_empty}")
     logger.info(f"Пропущено итогов: {skipped_total}")
 
+def _text_column(df, position):
+    """Колонка в виде строк; NaN, пустые строки и отсутствующие колонки заменяются на None"""
+    text = pd.Series(None, index=df.index, dtype=object)
+    if position is None or position >= df.shape[1]:
+        return text
+
+    column = df.iloc[:, position]
+    present = column.notna()
+    text[present] = column[present].astype(str)
+    return text.where(text.str.strip().fillna('') != '')
+
+def extract_dimensions(df, columns):
+    """
+    Векторное извлечение контрагента и номенклатуры для всех строк
+
+    columns - позиции колонок измерений из разметки файла (см. get_file_layout).
+    Возвращает DataFrame с колонками измерений, маску непустых строк и маску строк итогов
+    """
+    dimensions = pd.DataFrame(index=df.index)
+    for name in CONTRACTOR_COLUMNS + PRODUCT_COLUMNS:
+        dimensions[name] = _text_column(df, columns.get(name))
+    dimensions = dimensions.fillna('').astype(object)
+
+    not_empty = (
+        (dimensions['head_contractor'].str.strip() != '') &
+        (dimensions['buyer'] != '') &
+        (dimensions['product_name'] != '')
+    )
+    is_total = (
+        dimensions['product_name'].str.lower().str.contains('итого', regex=False) |
+        dimensions['head_contractor'].str.lower().str.contains('итого', regex=False)
+    )
+
+    return dimensions, not_empty, is_total
+
+def parse_date_columns(date_columns):
+    """Разбор заголовков дат (один раз на колонку, а не на каждую ячейку)"""
+    parsed = []
+    for col_index, date_str in date_columns:
+        try:
+            parsed.append((col_index, datetime.strptime(date_str, '%d.%m.%Y').date().isoformat()))
+        except ValueError:
+            continue
+    return parsed
+
+def melt_order_cells(df, date_columns):
+    """
+    Перевод пар колонок количество/сумма под каждой датой в длинный формат
+
+    Возвращает позиции строк, даты заказов, количества и суммы (NaN для пустых)
+    и число нераспознанных числовых значений.
+    Порядок записей - строка за строкой, дата за датой, как в построчной обработке.
+    """
+    n_rows, n_columns = df.shape
+    dates = parse_date_columns([(i, d) for i, d in date_columns if i < n_columns])
+    if not dates or n_rows == 0:
+        empty = np.array([], dtype=float)
+        return np.array([], dtype=np.int64), np.array([], dtype=object), empty, empty, 0
+
+    # Количество находится в колонке даты, сумма - в следующей колонке
+    positions = [i for i, _ in dates]
+    numbers, failed, raw = parse_numeric_columns(df, positions + [i + 1 for i in positions])
+    quantity = numbers[:, :len(dates)].ravel()
+    amount = numbers[:, len(dates):].ravel()
+    log_numeric_failures(raw[failed])
+
+    row_positions = np.repeat(np.arange(n_rows), len(dates))
+    order_dates = np.tile(np.array([d for _, d in dates], dtype=object), n_rows)
+
+    return row_positions, order_dates, quantity, amount, int(failed.sum())
+
+# Колонки ключей UNIQUE в таблицах измерений
+DIMENSION_TABLES = {
+    'contractors': ('head_contractor', 'buyer', 'manager', 'region'),
+    'products': ('name', 'characteristics', 'category'),
+}
+
+class DimensionCache:
+    """
+    Кеш ключей контрагентов и продуктов в памяти процесса
+    
+    Словари {ключ UNIQUE -> id} загружаются из БД один раз и затем
+    дочитываются только новыми записями. Новые ключи создаются пакетно
+    через INSERT OR IGNORE с одним запросом на получение их id.
+    """
+    
+    def __init__(self):
+        self.keys = {table: {} for table in DIMENSION_TABLES}
+        self.max_ids = {table: 0 for table in DIMENSION_TABLES}
+    
+    def clear(self):
+        """Сброс кеша (например, после отката транзакции)"""
+        for table in DIMENSION_TABLES:
+            self.keys[table].clear()
+            self.max_ids[table] = 0
+    
+    def _load(self, cursor, table, since_id=0):
+        """Загрузка ключей с id больше since_id"""
+        columns = DIMENSION_TABLES[table]
+        cursor.execute(f"SELECT id, {', '.join(columns)} FROM {table} WHERE id > ?", (since_id,))
+        keys = self.keys[table]
+        for row in cursor.fetchall():
+            keys[tuple(row[1:])] = row[0]
+            self.max_ids[table] = max(self.max_ids[table], row[0])
+    
+    def sync(self, cursor):
+        """Сверка кеша с БД: дочитывает новые записи или перезагружает таблицу целиком"""
+        for table in DIMENSION_TABLES:
+            cursor.execute(f"SELECT COUNT(*), COALESCE(MAX(id), 0) FROM {table}")
+            count, max_id = cursor.fetchone()
+            if count == len(self.keys[table]) and max_id == self.max_ids[table]:
+                continue
+            
+            if max_id >= self.max_ids[table]:
+                self._load(cursor, table, since_id=self.max_ids[table])
+            if count != len(self.keys[table]) or max_id != self.max_ids[table]:
+                # Записи удалялись или БД была пересоздана
+                self.keys[table].clear()
+                self.max_ids[table] = 0
+                self._load(cursor, table)
+    
+    def resolve(self, cursor, table, keys):
+        """Получить id для списка ключей (кортежей), создавая отсутствующие пакетом"""
+        cache = self.keys[table]
+        missing = list(dict.fromkeys(key for key in keys if key not in cache))
+        
+        if missing:
+            columns = DIMENSION_TABLES[table]
+            cursor.executemany(
+                f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                missing
+            )
+            self._load(cursor, table, since_id=self.max_ids[table])
+            
+            # Ключи, которые уже были в БД, но не попали в кеш
+            conditions = ' AND '.join(f"{column} = ?" for column in columns)
+            for key in missing:
+                if key not in cache:
+                    cursor.execute(f"SELECT id FROM {table} WHERE {conditions}", key)
+                    cache[key] = cursor.fetchone()[0]
+        
+        return [cache[key] for key in keys]
+
+# Кеши по пути к БД, живут между вызовами parse_csv_to_database в одном процессе
+_dimension_caches = {}
+
+def get_dimension_cache(db_path):
+    """Кеш ключей измерений для указанной БД"""
+    return _dimension_caches.setdefault(os.path.abspath(db_path), DimensionCache())
+
+def normalize_frame(df, layout, timings=None):
+    """
+    Нормализация пачки строк без обращения к БД
+    
+    Возвращает словарь:
+        contractors, products - уникальные ключи измерений в порядке появления
+        contractor_index, product_index - номер ключа для каждого заказа
+        order_date, quantity, amount - данные заказов (amount = NaN, если суммы нет)
+        stats - статистика обработки (см. log_processing_summary)
+    """
+    df = df.reset_index(drop=True)
+    with stage_timer(timings, 'dimensions'):
+        row_dimensions, not_empty, is_total = extract_dimensions(df, layout['columns'])
+        
+        # Пропускаем пустые строки и строки итогов
+        valid = (not_empty & ~is_total).to_numpy()
+        rows = df[valid].reset_index(drop=True)
+        row_dimensions = row_dimensions[valid].reset_index(drop=True)
+        
+        # Каждый уникальный контрагент и продукт разрешается один раз, в порядке появления
+        contractor_codes, contractor_keys = pd.factorize(
+            pd.Series(list(row_dimensions[CONTRACTOR_COLUMNS].itertuples(index=False, name=None)), dtype=object)
+        )
+        product_codes, product_keys = pd.factorize(
+            pd.Series(list(row_dimensions[PRODUCT_COLUMNS].itertuples(index=False, name=None)), dtype=object)
+        )
+    
+    with stage_timer(timings, 'clean'):
+        row_positions, order_dates, quantity, amount, bad_numbers = melt_order_cells(rows, layout['date_columns'])
+    
+    # Добавляем заказ только если есть данные о количестве
+    keep = quantity > 0
+    row_positions = row_positions[keep]
+    
+    return {
+        'contractors': list(contractor_keys),
+        'products': list(product_keys),
+        'contractor_index': contractor_codes[row_positions],
+        'product_index': product_codes[row_positions],
+        'order_date': order_dates[keep],
+        'quantity': quantity[keep],
+        'amount': amount[keep],
+        'stats': {
+            'rows': len(df),
+            'records': len(rows),
+            'orders': int(keep.sum()),
+            'unique_orders': int((~pd.DataFrame({
+                'contractor': contractor_codes[row_positions],
+                'product': product_codes[row_positions],
+                'order_date': order_dates[keep],
+            }).duplicated()).sum()),
+            'skipped_empty': int((~not_empty).sum()),
+            'skipped_total': int((not_empty & is_total).sum()),
+            'bad_numbers': bad_numbers,
+        },
+    }
+
+def stage_order_batch(cursor, batch, file_hash, dimensions, timings=None):
+    """Запись нормализованной пачки: разрешение ключей измерений и накопление ячеек файла"""
+    with stage_timer(timings, 'dimensions'):
+        contractor_ids = np.array(dimensions.resolve(cursor, 'contractors', batch['contractors']), dtype=np.int64)
+        product_ids = np.array(dimensions.resolve(cursor, 'products', batch['products']), dtype=np.int64)
+    
+    with stage_timer(timings, 'insert'):
+        orders = pd.DataFrame({
+            'contractor_id': contractor_ids[batch['contractor_index']],
+            'product_id': product_ids[batch['product_index']],
+            'order_date': batch['order_date'],
+            'quantity': batch['quantity'],
+            'amount': batch['amount'],
+        })
+        stage_orders(cursor, orders, file_hash)
+
+def process_data_frame(df, cursor, layout, file_hash, dimensions=None, timings=None):
+    """
+    Векторная обработка данных: измерения, длинный формат и пакетное накопление ячеек файла
+    
+    Возвращает статистику обработки (см. log_processing_summary)
+    """
+    if dimensions is None:
+        dimensions = DimensionCache()
+        dimensions.sync(cursor)
+    
+    batch = normalize_frame(df, layout, timings)
+    stage_order_batch(cursor, batch, file_hash, dimensions, timings)
+    return dict(batch['stats'])
+
+def log_processing_summary(stats):
+    """Итоги векторной обработки"""
+    logger.info("=== ИТОГИ ОБРАБОТКИ ===")
+    logger.info(f"Всего строк обработано: {stats['rows']}")
+    logger.info(f"Добавлено записей: {stats['records']}")
+    logger.info(f"Заказов в файле: {stats['orders']}")
+    logger.info(f"Повторов ключа объединено: {stats['orders'] - stats['unique_orders']}")
+    logger.info(f"Пропущено пустых: {stats['skipped_empty']}")
+    logger.info(f"Пропущено итогов: {stats['skipped_total']}")
+    logger.info(f"Нераспознанных чисел: {stats.get('bad_numbers', 0)}")
+
 def get_or_create_contractor(cursor, head_contractor, buyer, manager, region):
     """Получить или создать контрагента"""
     cursor.execute('''
@@ -393,10 +1382,20 @@ def show_database_stats(cursor):
     logger.info(f"Период: {date_range[0]} - {date_range[1]}")
 
 if __name__ == "__main__":
-    csv_file = "Заказы Оримэкс - TDSheet.csv"
+    parser = argparse.ArgumentParser(description="Загрузка выгрузки TDSheet в SQLite")
+    parser.add_argument('csv_file', nargs='?', default="Заказы Оримэкс - TDSheet.csv", help="CSV файл выгрузки")
+    parser.add_argument('--db', default='orimex_orders.db', help="Путь к базе данных")
+    parser.add_argument('--repair-shifted-products', action='store_true',
+                        help="Вместо загрузки исправить продукты, у которых характеристика равна категории")
+    parser.add_argument('--dry-run', action='store_true', help="Только показать, сколько записей будет исправлено")
+    args = parser.parse_args()
     
-    if parse_csv_to_database(csv_file):
+    if args.repair_shifted_products:
+        products, orders = repair_database(args.db, args.dry_run)
+        action = "Будет исправлено" if args.dry_run else "Исправлено"
+        print(f"🔧 {action} продуктов: {products}, их заказов: {orders}")
+    elif parse_csv_to_database(args.csv_file, args.db):
         print("✅ База данных успешно создана!")
-        print("📁 Файл: orimex_orders.db")
+        print(f"📁 Файл: {args.db}")
     else:
         print("❌ Ошибка при создании базы данных")
@@ -6,7 +6,7 @@
 
 import streamlit as st
 import pandas as pd
-import sqlite3
+from data_access import data_token, filters_key, load_daily_agg, load_orders
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
@@ -44,45 +44,19 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-@st.cache_data
 def load_data():
     """Загрузка данных из базы данных"""
     try:
-        conn = sqlite3.connect('orimex_orders.db')
-        
-        # Основной запрос с джойнами
-        query = '''
-        SELECT 
-            o.id,
-            o.order_date,
-            o.quantity,
-            o.amount,
-            c.head_contractor,
-            c.buyer,
-            c.manager,
-            c.region,
-            p.name as product_name,
-            p.characteristics,
-            p.category
-        FROM orders o
-        JOIN contractors c ON o.contractor_id = c.id
-        JOIN products p ON o.product_id = p.id
-        WHERE o.amount IS NOT NULL AND o.amount > 0
-        '''
-        
-        df = pd.read_sql_query(query, conn)
-        df['order_date'] = pd.to_datetime(df['order_date'])
-        
-        conn.close()
-        return df
+        return load_orders()
         
     except Exception as e:
         st.error(f"Ошибка загрузки данных: {e}")
         return pd.DataFrame()
 
-@st.cache_data
-def get_summary_stats(df):
-    """Получение сводной статистики"""
+@st.cache_data(max_entries=16)
+def get_summary_stats(_df, data_key):
+    """Получение сводной статистики (data_key - ключ кеша вместо хеша _df)"""
+    df = _df
     if df.empty:
         return {}
     
@@ -96,13 +70,9 @@ def get_summary_stats(df):
         'date_range': (df['order_date'].min(), df['order_date'].max())
     }
 
-def create_time_series_chart(df):
-    """Создание графика временных рядов"""
-    daily_stats = df.groupby('order_date').agg({
-        'amount': 'sum',
-        'quantity': 'sum',
-        'id': 'count'
-    }).reset_index()
+def create_time_series_chart(daily):
+    """Создание графика временных рядов по дневным итогам (load_daily_agg)"""
+    daily_stats = daily[['order_date', 'amount', 'quantity', 'orders']].copy()
     daily_stats.columns = ['date', 'total_amount', 'total_quantity', 'order_count']
     
     fig = make_subplots(
@@ -265,8 +235,15 @@ def main():
     # Применение фильтров
     filtered_df = df.copy()
     
+    # Те же фильтры для дневного куба временных рядов
+    cube_filters = {
+        'regions': [selected_region] if selected_region != 'Все' else None,
+        'categories': [selected_category] if selected_category != 'Все' else None,
+    }
+    
     if len(date_range) == 2:
         start_date, end_date = date_range
+        cube_filters.update(start_date=start_date, end_date=end_date)
         filtered_df = filtered_df[
             (filtered_df['order_date'].dt.date >= start_date) & 
             (filtered_df['order_date'].dt.date <= end_date)
@@ -279,7 +256,7 @@ def main():
         filtered_df = filtered_df[filtered_df['category'] == selected_category]
     
     # Основные метрики
-    stats = get_summary_stats(filtered_df)
+    stats = get_summary_stats(filtered_df, (data_token(), filters_key(cube_filters)))
     
     if stats:
         col1, col2, col3, col4 = st.columns(4)
@@ -308,13 +285,14 @@ def main():
     with tab1:
         st.subheader("Динамика заказов во времени")
         if not filtered_df.empty:
-            fig_time = create_time_series_chart(filtered_df)
+            daily = load_daily_agg(filters=cube_filters)
+            fig_time = create_time_series_chart(daily)
             st.plotly_chart(fig_time, width='stretch')
             
             # Дополнительная статистика по месяцам
-            monthly_stats = filtered_df.groupby(filtered_df['order_date'].dt.to_period('M')).agg({
+            monthly_stats = daily.groupby(daily['order_date'].dt.to_period('M')).agg({
                 'amount': 'sum',
-                'id': 'count'
+                'orders': 'sum'
             }).reset_index()
             monthly_stats['order_date'] = monthly_stats['order_date'].astype(str)
             monthly_stats.columns = ['Месяц', 'Сумма заказов', 'Количество заказов']
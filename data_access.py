@@ -0,0 +1,1016 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Общий доступ к данным заказов для всех дашбордов
+
+Таблица заказов (колоночный снимок orders_snapshot или JOIN по базе) загружается
+один раз на процесс и хранится в общем кеше с единообразными типами колонок.
+По запросу текстовые колонки контрагентов и номенклатуры отдаются как pandas
+Categorical (коды + словарь значений): меньше памяти и быстрее groupby/isin.
+Кеш сверяется с версией файла БД, поэтому после загрузки данных в любом
+процессе (любом порту лаунчера) заказы перечитываются при следующем обращении.
+invalidate_orders_cache() - единая точка сброса кеша после загрузки данных.
+
+Функции анализа с st.cache_data получают DataFrame параметром с _ (Streamlit
+его не хеширует), а ключом кеша служат data_token() и filters_key() -
+смена данных меняет токен, поэтому TTL для таких кешей не нужен.
+
+query_orders() отбирает заказы по фильтрам боковой панели на стороне SQLite
+(параметризованное условие по индексированным колонкам orders), а сводка для
+боковой панели (период, итоги, значения фильтров) считается агрегатными запросами,
+поэтому полная история загружается только там, где она действительно нужна.
+Если полная история уже загружена, смена фильтров обслуживается
+инвертированным индексом в памяти (FilterIndex) без обращения к базе.
+
+Временные ряды читаются из дневного куба daily_agg (load_daily_agg), который
+csv_to_db поддерживает при каждой загрузке, вместо группировки сырых заказов.
+"""
+
+import functools
+import os
+import pickle
+import threading
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from db_connections import close_readers, read_connection
+from orders_snapshot import ORDERS_QUERY, TEXT_COLUMNS, read_snapshot
+
+DB_PATH = 'orimex_orders.db'
+
+BASE_COLUMNS = ['id', 'order_date', 'quantity', 'amount'] + TEXT_COLUMNS
+
+REQUIRED_TABLES = ['orders', 'contractors', 'products']
+
+# Заказы без JOIN: текстовые колонки собираются по кодам из таблиц измерений
+ORDER_FACTS_QUERY = '''
+SELECT o.id, o.order_date, o.quantity, o.amount, o.contractor_id, o.product_id
+FROM orders o
+WHERE o.amount IS NOT NULL AND o.amount > 0
+'''
+
+DIMENSION_QUERIES = {
+    'contractor_id': 'SELECT id, head_contractor, buyer, manager, region FROM contractors',
+    'product_id': 'SELECT id, name AS product_name, characteristics, category FROM products',
+}
+
+# Фильтры по значениям измерений: ключ фильтра -> (колонка orders, таблица, колонка таблицы)
+FILTER_COLUMNS = {
+    'regions': ('contractor_id', 'contractors', 'region'),
+    'contractors': ('contractor_id', 'contractors', 'head_contractor'),
+    'managers': ('contractor_id', 'contractors', 'manager'),
+    'categories': ('product_id', 'products', 'category'),
+}
+
+# Итоги по заказам для боковой панели
+SUMMARY_QUERY = '''
+SELECT MIN(order_date), MAX(order_date), COUNT(*), SUM(amount), MAX(amount), MAX(quantity)
+FROM orders
+WHERE amount IS NOT NULL AND amount > 0
+'''
+
+# Значения измерений, по которым есть заказы
+ACTIVE_DIMENSION_QUERIES = {
+    'contractors': '''
+        SELECT head_contractor, manager, region FROM contractors c
+        WHERE EXISTS (SELECT 1 FROM orders o WHERE o.contractor_id = c.id AND o.amount > 0)
+    ''',
+    'products': '''
+        SELECT name AS product_name, category FROM products p
+        WHERE EXISTS (SELECT 1 FROM orders o WHERE o.product_id = p.id AND o.amount > 0)
+    ''',
+}
+
+# Количество заказов по контрагенту и категории за всю историю
+CONTRACTOR_CATEGORY_QUERY = '''
+SELECT c.head_contractor, p.category, COUNT(*) AS orders
+FROM orders o
+JOIN contractors c ON o.contractor_id = c.id
+JOIN products p ON o.product_id = p.id
+WHERE o.amount IS NOT NULL AND o.amount > 0
+GROUP BY c.head_contractor, p.category
+'''
+
+# Сколько последних отфильтрованных выборок хранить в кеше
+FILTERED_CACHE_SIZE = 4
+
+# Сколько агрегатов (сводки, дневные итоги с разными фильтрами) хранить в кеше
+AGGREGATE_CACHE_SIZE = 32
+
+# Сколько индексов детального анализа (drilldown_index) хранить в кеше
+DRILLDOWN_CACHE_SIZE = 8
+
+# Бюджет памяти кеша результатов анализа (memoize_analysis), байт
+ANALYSIS_CACHE_BYTES = 256 * 1024 ** 2
+
+# Фильтры, применимые к дневному кубу: ключ фильтра -> колонка daily_agg
+CUBE_FILTER_COLUMNS = {
+    'regions': 'region',
+    'managers': 'manager',
+    'categories': 'category',
+}
+
+# Измерения дневного куба
+CUBE_DIMENSIONS = ['manager', 'region', 'category']
+
+# Дневные итоги из куба с разбивкой по измерениям {columns}
+DAILY_AGG_QUERY = '''
+SELECT order_date{columns}, SUM(orders) AS orders, SUM(quantity) AS quantity,
+       SUM(amount) AS amount, SUM(amount_sq) AS amount_sq
+FROM daily_agg
+{where}
+GROUP BY order_date{columns}
+ORDER BY order_date{columns}
+'''
+
+# Периоды свертки дневного ряда (DailyRollup) в порядке укрупнения
+ROLLUP_PERIODS = ('День', 'Неделя', 'Месяц', 'Квартал', 'Год')
+
+# Метрики сравнения периодов (PeriodComparison): колонка итогов -> (колонка заказов, агрегат)
+PERIOD_METRICS = {
+    'amount': ('amount', 'sum'),
+    'orders': ('id', 'size'),
+    'average': ('amount', 'mean'),
+    'buyers': ('buyer', 'nunique'),
+    'contractors': ('head_contractor', 'nunique'),
+}
+
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Производные колонки даты, которые дашборды запрашивают через time_columns.
+# Функции применяются к уникальным датам (derive_time_column), не к каждой строке
+TIME_COLUMNS = {
+    'month': lambda dates: dates.dt.to_period('M'),
+    'week': lambda dates: dates.dt.to_period('W'),
+    'quarter': lambda dates: dates.dt.to_period('Q'),
+    'day_of_week': lambda dates: pd.Categorical(dates.dt.day_name(), categories=DAY_NAMES),
+    'hour': lambda dates: dates.dt.hour.astype('int8'),
+    'is_weekend': lambda dates: dates.dt.dayofweek >= 5,
+}
+
+# Кеш заказов: (абсолютный путь к БД, categorical) -> (версия БД, DataFrame)
+_orders_cache = {}
+_cache_lock = threading.RLock()
+
+# Кеш отфильтрованных выборок: (путь, categorical, условие, параметры) -> (версия БД, DataFrame)
+_filtered_cache = {}
+
+# Индексы фильтров по заказам из общего кеша: (путь, categorical) -> (версия БД, FilterIndex)
+_index_cache = {}
+
+# Индексы детального анализа: (data_key, колонки) -> DrillDownIndex
+_drilldown_cache = {}
+
+# Кеш агрегатов (сводка, основные категории): (путь, имя) -> (версия БД, результат)
+_aggregate_cache = {}
+
+# Кеш результатов анализа: (модуль, функция, data_key, параметры) -> результат в pickle
+_analysis_cache = {}
+_analysis_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+# Кеши Streamlit, которые сбрасываются вместе с кешем заказов
+_dependent_caches = []
+
+def data_version(db_path=DB_PATH):
+    """Версия данных: время изменения и размер файла БД и его WAL-журнала"""
+    version = []
+    for path in (db_path, db_path + '-wal'):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        else:
+            version.append(None)
+    return tuple(version)
+
+def missing_tables(db_path=DB_PATH, tables=REQUIRED_TABLES):
+    """Список отсутствующих в БД таблиц (по умолчанию - необходимых дашбордам)"""
+    if not os.path.exists(db_path):
+        return list(tables)
+    with read_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        table_names = {row[0] for row in cursor.fetchall()}
+    return [table for table in tables if table not in table_names]
+
+def read_dimension_orders(conn, where='', params=()):
+    """
+    Заказы с текстовыми колонками Categorical, собранными из таблиц измерений
+
+    Значения каждой колонки измерения кодируются один раз по таблице contractors
+    или products, коды заказов берутся по contractor_id/product_id без JOIN
+    и без хеширования строк. Заказы без контрагента или продукта отбрасываются (как в JOIN).
+    where и params - дополнительное условие из build_order_filter.
+    """
+    query = ORDER_FACTS_QUERY + (f"AND {where}\n" if where else '')
+    orders = pd.read_sql_query(query, conn, params=list(params))
+    columns = {column: orders[column] for column in ('id', 'order_date', 'quantity', 'amount')}
+    found = np.ones(len(orders), dtype=bool)
+
+    for key, query in DIMENSION_QUERIES.items():
+        dimension = pd.read_sql_query(query, conn)
+        positions = pd.Index(dimension['id']).get_indexer(orders[key])
+        found &= positions >= 0
+        for column in dimension.columns[1:]:
+            codes, categories = pd.factorize(dimension[column].fillna(''), sort=True)
+            columns[column] = pd.Categorical.from_codes(codes[positions], categories)
+
+    df = pd.DataFrame(columns)
+    if not found.all():
+        df = df[found].reset_index(drop=True)
+    return df
+
+def as_category(values):
+    """Текстовая колонка как Categorical с отсортированным словарем без пропусков и лишних значений"""
+    values = values.astype('category')
+    if values.isna().any():
+        if '' not in values.cat.categories:
+            values = values.cat.add_categories([''])
+        values = values.fillna('')
+    values = values.cat.remove_unused_categories()
+    if not values.cat.categories.is_monotonic_increasing:
+        values = values.cat.reorder_categories(sorted(values.cat.categories))
+    return values
+
+def read_orders(db_path=DB_PATH, categorical=False, where='', params=()):
+    """
+    Чтение заказов без кеша: колоночный снимок, если он актуален, иначе запрос к базе
+
+    Типы колонок одинаковы для обоих источников (и для пустой выборки): id - int64,
+    order_date - datetime64[ns], quantity и amount - float, текстовые колонки - строки без пропусков
+    или (categorical=True) Categorical с отсортированным словарем.
+    where и params - условие отбора из build_order_filter (выполняется в SQLite).
+    """
+    if not os.path.exists(db_path):
+        raise FileNotFoundError(f"База данных не найдена: {db_path}")
+
+    df = None if where else read_snapshot(db_path, categorical=categorical)
+    if df is None:
+        with read_connection(db_path) as conn:
+            if categorical:
+                df = read_dimension_orders(conn, where, params)
+            else:
+                query = ORDERS_QUERY + (f"AND {where}\n" if where else '')
+                df = pd.read_sql_query(query, conn, params=list(params))
+
+    df['id'] = df['id'].astype('int64')
+    df['order_date'] = pd.to_datetime(df['order_date']).astype('datetime64[ns]')
+    df['quantity'] = df['quantity'].astype(float)
+    df['amount'] = df['amount'].astype(float)
+    for column in TEXT_COLUMNS:
+        if categorical:
+            df[column] = as_category(df[column])
+        else:
+            df[column] = df[column].fillna('').astype(str)
+    return df[BASE_COLUMNS]
+
+def load_orders(db_path=DB_PATH, time_columns=(), categorical=False):
+    """
+    Заказы из общего кеша процесса
+
+    time_columns - производные колонки даты из TIME_COLUMNS (month, week, quarter,
+    day_of_week, hour, is_weekend); они вычисляются один раз на версию данных.
+    categorical=True - текстовые колонки как Categorical (для группировок по ним
+    нужен observed=True, иначе pandas < 3 выводит пустые группы).
+    Возвращается новый DataFrame с выбранными колонками: добавление в него
+    колонок не затрагивает общий кеш.
+    """
+    key = (os.path.abspath(db_path), categorical)
+    version = data_version(db_path)
+
+    with _cache_lock:
+        cached = _orders_cache.get(key)
+        if cached is None or cached[0] != version:
+            cached = (version, read_orders(db_path, categorical))
+            _orders_cache[key] = cached
+
+        return select_columns(cached[1], time_columns)
+
+def derive_time_column(dates, column):
+    """
+    Производная колонка даты из TIME_COLUMNS
+
+    Значения вычисляются один раз на уникальную дату (дней в истории на порядки
+    меньше, чем заказов) и раскладываются по строкам выборкой по кодам дат:
+    Period и названия дней не создаются для каждой строки, day_of_week
+    хранится как Categorical (1 байт на строку), hour - как int8.
+    """
+    codes, unique_dates = pd.factorize(dates, use_na_sentinel=False)
+    values = pd.Series(TIME_COLUMNS[column](pd.Series(unique_dates)))
+    return pd.Series(values.array.take(codes), index=dates.index, name=column)
+
+def select_columns(df, time_columns=()):
+    """
+    Базовые колонки и производные колонки даты
+
+    Производные колонки вычисляются при первом запросе и сохраняются в df
+    (общем кеше заказов), поэтому дашборды, которые их не запрашивают, за них не платят.
+    """
+    for column in time_columns:
+        if column not in df.columns:
+            df[column] = derive_time_column(df['order_date'], column)
+    return df[BASE_COLUMNS + list(time_columns)]
+
+def build_order_filter(filters):
+    """
+    Условие WHERE с параметрами по фильтрам боковой панели
+
+    filters - словарь: start_date и end_date (date), regions, contractors, managers,
+    categories (списки значений), min_amount и min_quantity. Пустые значения не фильтруют.
+    Условия строятся по индексированным колонкам orders (order_date, contractor_id,
+    product_id), значения измерений отбираются подзапросами к contractors/products.
+    Возвращает (условие, параметры); условие пустое, если фильтров нет.
+    """
+    conditions = []
+    params = []
+
+    if filters.get('start_date'):
+        conditions.append('o.order_date >= ?')
+        params.append(filters['start_date'].isoformat())
+    if filters.get('end_date'):
+        conditions.append('o.order_date < ?')
+        params.append((filters['end_date'] + timedelta(days=1)).isoformat())
+
+    dimension_conditions = {}
+    for name, (key, table, column) in FILTER_COLUMNS.items():
+        values = list(filters.get(name) or [])
+        if values:
+            placeholders = ', '.join('?' * len(values))
+            dimension_conditions.setdefault((key, table), []).append((f"{column} IN ({placeholders})", values))
+
+    for (key, table), items in dimension_conditions.items():
+        subquery_where = ' AND '.join(condition for condition, _ in items)
+        conditions.append(f"o.{key} IN (SELECT id FROM {table} WHERE {subquery_where})")
+        for _, values in items:
+            params.extend(values)
+
+    if filters.get('min_amount'):
+        conditions.append('o.amount >= ?')
+        params.append(filters['min_amount'])
+    if filters.get('min_quantity'):
+        conditions.append('o.quantity >= ?')
+        params.append(filters['min_quantity'])
+
+    return ' AND '.join(conditions), params
+
+class FilterIndex:
+    """
+    Инвертированный индекс фильтров боковой панели по DataFrame заказов
+
+    Для каждой колонки фильтра (FILTER_COLUMNS) позиции строк сгруппированы
+    по значению: один стабильный argsort кодов и границы групп, то есть
+    список позиций на значение. Даты хранятся отсортированным массивом
+    с позициями строк, период отбирается двумя searchsorted.
+    Фильтры объединяются побитовым И над булевой маской,
+    строки материализуются один раз в конце.
+    """
+
+    def __init__(self, df):
+        self.df = df[BASE_COLUMNS]
+        self.size = len(df)
+        position_type = np.int32 if self.size < np.iinfo(np.int32).max else np.int64
+
+        dates = df['order_date'].to_numpy()
+        if pd.Index(dates).is_monotonic_increasing:
+            self.date_positions = None
+            self.sorted_dates = dates
+        else:
+            self.date_positions = np.argsort(dates, kind='stable').astype(position_type)
+            self.sorted_dates = dates[self.date_positions]
+
+        self.postings = {}
+        for name, (_, _, column) in FILTER_COLUMNS.items():
+            codes, values = pd.factorize(df[column])
+            positions = np.argsort(codes, kind='stable').astype(position_type)
+            bounds = np.searchsorted(codes[positions], np.arange(len(values) + 1))
+            self.postings[name] = (pd.Index(values), positions, bounds)
+
+    def date_mask(self, start_date=None, end_date=None):
+        """Маска строк периода [start_date, end_date] по отсортированным датам"""
+        start = np.searchsorted(self.sorted_dates, np.datetime64(start_date, 'ns')) if start_date else 0
+        if end_date:
+            end = np.searchsorted(self.sorted_dates, np.datetime64(end_date + timedelta(days=1), 'ns'))
+        else:
+            end = self.size
+
+        mask = np.zeros(self.size, dtype=bool)
+        if self.date_positions is None:
+            mask[start:end] = True
+        else:
+            mask[self.date_positions[start:end]] = True
+        return mask
+
+    def value_mask(self, name, values):
+        """Маска строк, у которых колонка фильтра name принимает одно из values"""
+        index, positions, bounds = self.postings[name]
+        mask = np.zeros(self.size, dtype=bool)
+        for code in index.get_indexer(list(values)):
+            if code >= 0:
+                mask[positions[bounds[code]:bounds[code + 1]]] = True
+        return mask
+
+    def mask(self, filters):
+        """Маска строк по словарю фильтров (те же ключи и правила, что у build_order_filter)"""
+        mask = np.ones(self.size, dtype=bool)
+        if filters.get('start_date') or filters.get('end_date'):
+            mask &= self.date_mask(filters.get('start_date'), filters.get('end_date'))
+        for name in FILTER_COLUMNS:
+            if filters.get(name):
+                mask &= self.value_mask(name, filters[name])
+        if filters.get('min_amount'):
+            mask &= self.df['amount'].to_numpy() >= filters['min_amount']
+        if filters.get('min_quantity'):
+            mask &= self.df['quantity'].to_numpy() >= filters['min_quantity']
+        return mask
+
+    def select(self, filters):
+        """Заказы, подходящие под фильтры, в порядке исходного DataFrame"""
+        return self.df.take(np.flatnonzero(self.mask(filters))).reset_index(drop=True)
+
+class DrillDownIndex:
+    """
+    Индекс строк выборки по значениям ключевых колонок для детального анализа
+
+    Коды значений колонок (factorize) объединяются в один код строки,
+    один стабильный argsort дает позиции строк, сгруппированные по коду.
+    Строки значения (или префикса колонок: все товары контрагента в индексе
+    по контрагенту и товару) - непрерывный отрезок, который находится двумя
+    searchsorted, поэтому выборка стоит O(k) от числа строк значения,
+    а не маску по всем строкам.
+    """
+
+    def __init__(self, df, columns):
+        self.df = df
+        self.columns = tuple(columns)
+        codes = np.zeros(len(df), dtype=np.int64)
+        self.values = []
+        for column in self.columns:
+            column_codes, uniques = pd.factorize(df[column], use_na_sentinel=False)
+            codes = codes * len(uniques) + column_codes
+            self.values.append(pd.Index(uniques))
+        self.positions = np.argsort(codes, kind='stable')
+        self.codes = codes[self.positions]
+
+    def rows(self, *values):
+        """Позиции строк (по возрастанию) со значениями values первых колонок индекса"""
+        code = 0
+        for index, value in zip(self.values, values):
+            try:
+                location = index.get_loc(value)
+            except KeyError:
+                return self.positions[:0]
+            code = code * len(index) + location
+        span = int(np.prod([len(index) for index in self.values[len(values):]]))
+        start, end = np.searchsorted(self.codes, [code * span, (code + 1) * span])
+        return np.sort(self.positions[start:end])
+
+    def select(self, *values):
+        """Строки выборки со значениями values, в порядке исходного DataFrame"""
+        return self.df.take(self.rows(*values))
+
+def orders_filter_index(db_path=DB_PATH, categorical=False):
+    """
+    Индекс фильтров по полным заказам из общего кеша процесса
+
+    Строится один раз на версию данных и только если полные заказы уже
+    загружены (load_orders); иначе None, и выборка выполняется в SQLite.
+    """
+    key = (os.path.abspath(db_path), categorical)
+    version = data_version(db_path)
+
+    with _cache_lock:
+        orders = _orders_cache.get(key)
+        if orders is None or orders[0] != version:
+            return None
+        cached = _index_cache.get(key)
+        if cached is None or cached[0] != version:
+            cached = (version, FilterIndex(orders[1]))
+            _index_cache[key] = cached
+        return cached[1]
+
+class InteractionMatrix:
+    """
+    Разреженная матрица взаимодействий двух колонок (например, менеджер × контрагент)
+
+    Строки и столбцы - коды значений колонок (factorize с сортировкой, порядок
+    как у groupby), в ячейке - сумма колонки values и количество строк заказов.
+    Хранятся только непустые ячейки (scipy.sparse CSR), поэтому память растет
+    с числом пар, а не с произведением числа строк на число столбцов.
+    distinct - колонка, различные значения которой считаются в каждой ячейке
+    (например, покупатели пары). Топ пар и покрытие считаются по разреженной
+    форме, в плотный вид переводится только небольшой срез (тепловая карта).
+    """
+
+    def __init__(self, df, row_column, column_column, values='amount', distinct=None):
+        from scipy import sparse
+
+        self.row_column = row_column
+        self.column_column = column_column
+        self.values_column = values
+        row_codes, rows = pd.factorize(df[row_column], sort=True)
+        column_codes, columns = pd.factorize(df[column_column], sort=True)
+        self.rows = pd.Index(rows)
+        self.columns = pd.Index(columns)
+        shape = (len(self.rows), len(self.columns))
+
+        # Итоги ячеек одной группировкой по номеру ячейки (строка * число столбцов + столбец):
+        # номера отсортированы, то есть идут в порядке CSR, а суммы совпадают с groupby
+        valid = (row_codes >= 0) & (column_codes >= 0)
+        cells = row_codes[valid].astype(np.int64) * shape[1] + column_codes[valid]
+        totals = pd.Series(df[values].to_numpy(dtype=float)[valid]).groupby(cells).agg(['sum', 'size'])
+        entry_cells = totals.index.to_numpy()
+        self.entry_rows = entry_cells // shape[1]
+        indices = entry_cells % shape[1]
+        indptr = np.searchsorted(self.entry_rows, np.arange(shape[0] + 1))
+        self.sums = sparse.csr_matrix((totals['sum'].to_numpy(), indices, indptr), shape=shape)
+        self.counts = sparse.csr_matrix((totals['size'].to_numpy(dtype=np.int64), indices, indptr), shape=shape)
+
+        self.distinct_column = distinct
+        self.distinct_counts = None
+        if distinct is not None:
+            value_codes, values_index = pd.factorize(df[distinct])
+            value_codes = value_codes[valid]
+            has_value = value_codes >= 0
+            pairs = np.unique(cells[has_value] * len(values_index) + value_codes[has_value])
+            cell_ids, cell_counts = np.unique(pairs // len(values_index), return_counts=True)
+            self.distinct_counts = np.zeros(len(entry_cells), dtype=np.int64)
+            self.distinct_counts[np.searchsorted(entry_cells, cell_ids)] = cell_counts
+
+    def entries(self, positions=None):
+        """Непустые ячейки (все или по номерам positions) в длинном формате: строка, столбец, сумма, count[, distinct]"""
+        if positions is None:
+            positions = np.arange(self.counts.nnz)
+        entries = pd.DataFrame({
+            self.row_column: self.rows.take(self.entry_rows[positions]),
+            self.column_column: self.columns.take(self.counts.indices[positions]),
+            self.values_column: self.sums.data[positions],
+            'count': self.counts.data[positions],
+        })
+        if self.distinct_counts is not None:
+            entries[self.distinct_column] = self.distinct_counts[positions]
+        return entries
+
+    def top(self, k):
+        """k непустых ячеек с наибольшей суммой, по убыванию суммы (без сортировки всех ячеек)"""
+        data = self.sums.data
+        positions = np.arange(len(data))
+        if k < len(data):
+            positions = np.argpartition(-data, k - 1)[:k]
+        return self.entries(positions[np.argsort(-data[positions], kind='stable')])
+
+    def row_coverage(self):
+        """Покрытие строк: сколько столбцов у каждой строки (например, контрагентов у менеджера)"""
+        return pd.Series(np.diff(self.counts.indptr), index=self.rows)
+
+    def column_coverage(self):
+        """Покрытие столбцов: сколько строк у каждого столбца (например, менеджеров у покупателя)"""
+        return pd.Series(np.bincount(self.counts.indices, minlength=len(self.columns)), index=self.columns)
+
+class PeriodComparison:
+    """
+    Итоги заказов по набору периодов для сравнения (два периода, MoM, YoY)
+
+    periods - {название: (начало, конец)}, даты включительно, периоды могут
+    пересекаться. Даты сортируются один раз, строки каждого периода - отрезок
+    отсортированного массива (два searchsorted); строки всех периодов собираются
+    в одну таблицу с колонкой period, и все метрики PERIOD_METRICS по всем
+    периодам считаются одной группировкой (totals). Внутри периода строки идут
+    в исходном порядке, как при отборе по маске.
+    """
+
+    def __init__(self, df, periods):
+        self.names = list(periods)
+        dates = df['order_date'].to_numpy()
+        order = None if pd.Index(dates).is_monotonic_increasing else np.argsort(dates, kind='stable')
+        sorted_dates = dates if order is None else dates[order]
+
+        parts = []
+        for start_date, end_date in periods.values():
+            start = np.searchsorted(sorted_dates, np.datetime64(pd.Timestamp(start_date)))
+            end = np.searchsorted(sorted_dates, np.datetime64(pd.Timestamp(end_date) + pd.Timedelta(days=1)))
+            parts.append(np.arange(start, end) if order is None else np.sort(order[start:end]))
+
+        self.rows = df.take(np.concatenate(parts) if parts else np.array([], dtype=np.int64))
+        self.rows.insert(0, 'period', pd.Categorical.from_codes(
+            np.repeat(np.arange(len(parts)), [len(part) for part in parts]), categories=self.names
+        ))
+
+    def totals(self, by=(), metrics=None):
+        """
+        Длинная таблица итогов: period, [by], метрики (по умолчанию все PERIOD_METRICS:
+        amount, orders, average, buyers, contractors)
+
+        Без by - по строке на каждый период, включая периоды без заказов.
+        """
+        metrics = list(metrics or PERIOD_METRICS)
+        totals = self.rows.groupby(['period', *by], observed=True).agg(
+            **{metric: PERIOD_METRICS[metric] for metric in metrics}
+        )
+        if not by:
+            totals = totals.reindex(pd.CategoricalIndex(self.names, categories=self.names, name='period'))
+            for column in ('amount', 'orders', 'buyers', 'contractors'):
+                if column in totals:
+                    totals[column] = totals[column].fillna(0)
+            totals = totals.astype({
+                column: 'int64' for column in ('orders', 'buyers', 'contractors') if column in totals
+            })
+        return totals.reset_index()
+
+    def pivot(self, by, metric='amount'):
+        """Метрика в разрезе by: строки - значения by, колонки - периоды (NaN, если в периоде нет заказов)"""
+        table = self.totals(by, [metric]).set_index([*by, 'period'])[metric].unstack('period').sort_index()
+        table.columns = pd.Index(table.columns.astype(str))
+        return table.reindex(columns=self.names)
+
+    def compare(self, pairs, by=()):
+        """
+        Сравнение периодов парами (период, база), например каждый месяц с тем же месяцем год назад
+
+        Возвращает длинную таблицу: period, base, [by], metric, value, base_value, change
+        (изменение к базе, %). Отсутствующие в периоде значения сумм и количеств - 0.
+        """
+        long = self.totals(by).melt(id_vars=['period', *by], var_name='metric', value_name='value')
+        long['period'] = long['period'].astype(str)
+        long['metric'] = pd.Categorical(long['metric'], categories=list(PERIOD_METRICS))
+        pairs = pd.DataFrame(list(pairs), columns=['period', 'base']).rename_axis('pair').reset_index()
+        current = pairs.merge(long, on='period')
+        base = pairs.merge(long.rename(columns={'period': 'base', 'value': 'base_value'}), on='base')
+        # Внешнее соединение сортирует ключи: порядок пар, затем by и метрики
+        table = current.merge(base, on=['pair', 'period', 'base', *by, 'metric'], how='outer')
+
+        additive = table['metric'] != 'average'
+        for column in ('value', 'base_value'):
+            table.loc[additive, column] = table.loc[additive, column].fillna(0)
+        change = (table['value'] - table['base_value']) / table['base_value'] * 100
+        table['change'] = change.replace([np.inf, -np.inf], np.nan)
+        return table.drop(columns='pair')
+
+def month_periods(start_date, end_date):
+    """Календарные месяцы, пересекающиеся с [start_date, end_date]: {'ГГГГ-ММ': (первый день, последний день)}"""
+    months = pd.period_range(pd.Timestamp(start_date), pd.Timestamp(end_date), freq='M')
+    return {str(month): (month.start_time.date(), month.end_time.date()) for month in months}
+
+def monthly_comparison(start_date, end_date, months=12):
+    """
+    Каждый месяц диапазона в паре с месяцем на months раньше (YoY - 12, MoM - 1)
+
+    Возвращает (периоды для PeriodComparison, пары для compare).
+    """
+    periods = month_periods(start_date, end_date)
+    pairs = []
+    for name in list(periods):
+        base = pd.Period(name, freq='M') - months
+        periods.setdefault(str(base), (base.start_time.date(), base.end_time.date()))
+        pairs.append((name, str(base)))
+    return periods, pairs
+
+def drilldown_index(df, columns, data_key):
+    """
+    DrillDownIndex выборки df по колонкам columns
+
+    Строится один раз на data_key (токен данных и сигнатура фильтров, как у
+    memoize_analysis) и хранится без копирования выборки; последние
+    DRILLDOWN_CACHE_SIZE индексов кешируются до сброса кеша заказов.
+    """
+    key = (data_key, tuple(columns))
+    with _cache_lock:
+        index = _drilldown_cache.pop(key, None)
+        if index is None:
+            index = DrillDownIndex(df, columns)
+        _drilldown_cache[key] = index
+        while len(_drilldown_cache) > DRILLDOWN_CACHE_SIZE:
+            del _drilldown_cache[next(iter(_drilldown_cache))]
+        return index
+
+def query_orders(db_path=DB_PATH, filters=None, time_columns=(), categorical=False):
+    """
+    Заказы, подходящие под фильтры
+
+    Без фильтров возвращает полный DataFrame из общего кеша (load_orders).
+    Если полные заказы уже в кеше, отбор выполняется по индексу в памяти
+    (FilterIndex), иначе - на стороне SQLite.
+    Последние FILTERED_CACHE_SIZE выборок кешируются до изменения версии БД,
+    поэтому перезапуск страницы без смены фильтров не обращается к базе.
+    """
+    where, params = build_order_filter(filters or {})
+    if not where:
+        return load_orders(db_path, time_columns, categorical)
+
+    key = (os.path.abspath(db_path), categorical, where, tuple(params))
+    version = data_version(db_path)
+
+    with _cache_lock:
+        cached = _filtered_cache.pop(key, None)
+        if cached is None or cached[0] != version:
+            index = orders_filter_index(db_path, categorical)
+            if index is not None:
+                cached = (version, index.select(filters))
+            else:
+                cached = (version, read_orders(db_path, categorical, where, params))
+        _filtered_cache[key] = cached
+        while len(_filtered_cache) > FILTERED_CACHE_SIZE:
+            del _filtered_cache[next(iter(_filtered_cache))]
+
+        return select_columns(cached[1], time_columns)
+
+def cached_aggregate(name, db_path, reader):
+    """Результат reader(db_path), кешированный до изменения версии БД"""
+    key = (os.path.abspath(db_path), name)
+    version = data_version(db_path)
+
+    with _cache_lock:
+        cached = _aggregate_cache.pop(key, None)
+        if cached is None or cached[0] != version:
+            cached = (version, reader(db_path))
+        _aggregate_cache[key] = cached
+        while len(_aggregate_cache) > AGGREGATE_CACHE_SIZE:
+            del _aggregate_cache[next(iter(_aggregate_cache))]
+        return cached[1]
+
+def read_orders_summary(db_path=DB_PATH):
+    """Итоги по заказам и значения фильтров без загрузки заказов"""
+    with read_connection(db_path) as conn:
+        min_date, max_date, records, revenue, max_amount, max_quantity = conn.execute(SUMMARY_QUERY).fetchone()
+        contractors = pd.read_sql_query(ACTIVE_DIMENSION_QUERIES['contractors'], conn).fillna('')
+        products = pd.read_sql_query(ACTIVE_DIMENSION_QUERIES['products'], conn).fillna('')
+
+    return {
+        'min_date': pd.Timestamp(min_date),
+        'max_date': pd.Timestamp(max_date),
+        'records': records,
+        'revenue': revenue or 0.0,
+        'max_amount': max_amount or 0.0,
+        'max_quantity': max_quantity or 0.0,
+        'regions': sorted(contractors['region'].unique().tolist()),
+        'categories': sorted(products['category'].unique().tolist()),
+        'contractors': sorted(contractors['head_contractor'].unique().tolist()),
+        'managers': sorted(contractors['manager'].unique().tolist()),
+        'products': products['product_name'].nunique(),
+    }
+
+def orders_summary(db_path=DB_PATH):
+    """
+    Сводка по заказам для боковой панели (кешируется до изменения версии БД)
+
+    Словарь: min_date, max_date, records, revenue, max_amount, max_quantity,
+    списки значений фильтров regions, categories, contractors, managers
+    и количество товаров products.
+    """
+    return cached_aggregate('summary', db_path, read_orders_summary)
+
+def read_contractor_main_categories(db_path=DB_PATH):
+    """Основная категория каждого контрагента: категория с наибольшим числом заказов"""
+    with read_connection(db_path) as conn:
+        counts = pd.read_sql_query(CONTRACTOR_CATEGORY_QUERY, conn)
+
+    counts = counts.sort_values(['head_contractor', 'orders', 'category'], ascending=[True, False, True])
+    return counts.drop_duplicates('head_contractor')[['head_contractor', 'category']].reset_index(drop=True)
+
+def contractor_main_categories(db_path=DB_PATH):
+    """Основные категории контрагентов за всю историю (кешируются до изменения версии БД)"""
+    return cached_aggregate('main_categories', db_path, read_contractor_main_categories)
+
+def read_max_order_id(db_path=DB_PATH):
+    """Наибольший id заказа (0 для пустой таблицы)"""
+    with read_connection(db_path) as conn:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+
+def data_token(db_path=DB_PATH):
+    """
+    Токен версии данных для ключей кешей анализа: версия файла БД и max(orders.id)
+
+    Меняется после любой записи в БД, поэтому кешированные функции могут
+    принимать DataFrame без хеширования (параметр с _ в st.cache_data)
+    и получать токен вместе с параметрами фильтров (filters_key).
+    """
+    return data_version(db_path), cached_aggregate('max_order_id', db_path, read_max_order_id)
+
+def filters_key(filters):
+    """Хешируемая сигнатура фильтров: нормализованное условие и параметры build_order_filter"""
+    where, params = build_order_filter(filters or {})
+    return where, tuple(params)
+
+def register_dependent_cache(func):
+    """Регистрация функции с кешем Streamlit (st.cache_data) для сброса вместе с заказами"""
+    _dependent_caches.append(func)
+    return func
+
+def cube_supports(filters):
+    """Применимы ли фильтры к дневному кубу (нет фильтров по контрагентам и порогов суммы/количества)"""
+    return not any(filters.get(name) for name in ('contractors', 'min_amount', 'min_quantity'))
+
+def build_cube_filter(filters):
+    """Условие WHERE с параметрами для куба daily_agg: период, регионы, менеджеры, категории"""
+    conditions = []
+    params = []
+
+    if filters.get('start_date'):
+        conditions.append('order_date >= ?')
+        params.append(filters['start_date'].isoformat())
+    if filters.get('end_date'):
+        conditions.append('order_date < ?')
+        params.append((filters['end_date'] + timedelta(days=1)).isoformat())
+
+    for name, column in CUBE_FILTER_COLUMNS.items():
+        values = list(filters.get(name) or [])
+        if values:
+            conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+
+    return ' AND '.join(conditions), params
+
+def aggregate_daily(orders, by=()):
+    """
+    Дневные итоги по DataFrame заказов в формате куба daily_agg
+
+    Используется для выборок, к которым куб неприменим, и для БД без куба.
+    """
+    keys = ['order_date'] + list(by)
+    daily = orders.assign(amount_sq=orders['amount'] ** 2).groupby(keys, observed=True).agg(
+        orders=('id', 'count'),
+        quantity=('quantity', 'sum'),
+        amount=('amount', 'sum'),
+        amount_sq=('amount_sq', 'sum'),
+    )
+    return daily.reset_index()
+
+def read_daily_agg(db_path=DB_PATH, by=(), filters=None):
+    """Дневные итоги из куба daily_agg без кеша (для БД без куба - по заказам)"""
+    filters = filters or {}
+    if missing_tables(db_path, ['daily_agg']):
+        # База еще не загружалась с версией, которая ведет куб
+        orders = query_orders(db_path, {name: filters.get(name) for name in ('start_date', 'end_date', *CUBE_FILTER_COLUMNS)})
+        daily = aggregate_daily(orders, by)
+    else:
+        where, params = build_cube_filter(filters)
+        query = DAILY_AGG_QUERY.format(
+            columns=''.join(f", {column}" for column in by),
+            where=f"WHERE {where}" if where else '',
+        )
+        with read_connection(db_path) as conn:
+            daily = pd.read_sql_query(query, conn, params=params)
+
+    daily['order_date'] = pd.to_datetime(daily['order_date']).astype('datetime64[ns]')
+    daily['orders'] = daily['orders'].astype('int64')
+    for column in ('quantity', 'amount', 'amount_sq'):
+        daily[column] = daily[column].astype(float)
+    return daily
+
+def load_daily_agg(db_path=DB_PATH, by=(), filters=None):
+    """
+    Дневные итоги заказов из куба daily_agg (кешируются до изменения версии БД)
+
+    by - разбивка по измерениям куба (CUBE_DIMENSIONS), без by - итоги за день.
+    filters - фильтры query_orders; к кубу применимы период, regions, managers
+    и categories (см. cube_supports), для остальных нужен aggregate_daily по заказам.
+    Колонки: order_date, [by], orders, quantity, amount, amount_sq (сумма квадратов сумм).
+    """
+    filters = filters or {}
+    if not cube_supports(filters):
+        raise ValueError("Фильтры по контрагентам и порогам суммы/количества к дневному кубу не применимы")
+    unknown = [column for column in by if column not in CUBE_DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Измерений нет в дневном кубе: {unknown}")
+
+    where, params = build_cube_filter(filters)
+    return cached_aggregate(
+        ('daily_agg', tuple(by), where, tuple(params)), db_path,
+        lambda path: read_daily_agg(path, by, filters)
+    )
+
+class DailyRollup:
+    """
+    Дневной ряд итогов со сверткой в недели, месяцы, кварталы и годы
+
+    Строится один раз по дневным итогам (load_daily_agg или aggregate_daily):
+    даты сортируются в массив datetime64[D], по колонкам amount, orders и quantity
+    считаются накопленные суммы, для каждого периода из ROLLUP_PERIODS - начало
+    периода у каждой даты и позиции, с которых начинается новый период.
+    Итоги периода - разность накопленных сумм на его границах, поэтому любой
+    период и любой диапазон дат считаются без группировки строк (см. totals).
+    """
+
+    COLUMNS = ('amount', 'orders', 'quantity')
+
+    def __init__(self, daily):
+        daily = daily.sort_values('order_date', kind='stable')
+        self.dates = daily['order_date'].to_numpy().astype('datetime64[D]')
+        self.size = len(self.dates)
+        # Ведущий ноль: сумма строк [i, j) = cumsum[j] - cumsum[i]
+        self.cumsums = {
+            column: np.concatenate(([0], np.cumsum(daily[column].to_numpy())))
+            for column in self.COLUMNS
+        }
+
+        days = self.dates
+        months = days.astype('datetime64[M]')
+        period_starts = {
+            'День': days,
+            # 1970-01-01 - четверг, до понедельника недели (n + 3) % 7 дней
+            'Неделя': days - (days.astype('int64') + 3) % 7,
+            'Месяц': months.astype('datetime64[D]'),
+            'Квартал': (months - months.astype('int64') % 3).astype('datetime64[D]'),
+            'Год': days.astype('datetime64[Y]').astype('datetime64[D]'),
+        }
+        self.periods = {}
+        for period, starts in period_starts.items():
+            bounds = np.flatnonzero(np.concatenate(([True], starts[1:] != starts[:-1])))
+            self.periods[period] = (starts, bounds)
+
+    def totals(self, period='День', start_date=None, end_date=None):
+        """
+        Итоги по периодам в диапазоне дат [start_date, end_date] (границы включаются)
+
+        Периоды на краях диапазона считаются только по датам внутри диапазона.
+        Возвращает DataFrame: period (начало периода), amount, orders, quantity.
+        """
+        low = 0
+        high = self.size
+        if start_date is not None:
+            low = np.searchsorted(self.dates, pd.Timestamp(start_date).to_datetime64().astype('datetime64[D]'), 'left')
+        if end_date is not None:
+            high = np.searchsorted(self.dates, pd.Timestamp(end_date).to_datetime64().astype('datetime64[D]'), 'right')
+
+        starts, bounds = self.periods[period]
+        if high > low:
+            edges = np.concatenate(([low], bounds[(bounds > low) & (bounds < high)], [high]))
+        else:
+            edges = np.array([0])
+
+        result = pd.DataFrame({'period': starts[edges[:-1]]})
+        for column, cumsum in self.cumsums.items():
+            result[column] = cumsum[edges[1:]] - cumsum[edges[:-1]]
+        return result
+
+def memoize_analysis(func):
+    """
+    Кеш результатов функции анализа func(df, *params) с вытеснением LRU
+
+    Ключ - (функция, data_key, params): data_key передается именованным аргументом
+    (обычно data_token() и сигнатура фильтров), сам DataFrame не хешируется.
+    Без data_key функция вызывается без кеша. Результаты хранятся в pickle:
+    объем кеша считается точно (не больше ANALYSIS_CACHE_BYTES, давно не
+    использованные результаты вытесняются), а изменение возвращенных графиков
+    и таблиц не портит кеш. Счетчики попаданий - analysis_cache_stats().
+    """
+    @functools.wraps(func)
+    def wrapper(df, *params, data_key=None):
+        if data_key is None:
+            return func(df, *params)
+
+        key = (func.__module__, func.__qualname__, data_key, params)
+        with _cache_lock:
+            payload = _analysis_cache.pop(key, None)
+            if payload is not None:
+                _analysis_cache[key] = payload
+                _analysis_stats['hits'] += 1
+            else:
+                _analysis_stats['misses'] += 1
+        if payload is not None:
+            return pickle.loads(payload)
+
+        result = func(df, *params)
+        try:
+            payload = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return result
+        if len(payload) > ANALYSIS_CACHE_BYTES:
+            return result
+
+        with _cache_lock:
+            previous = _analysis_cache.pop(key, None)
+            if previous is not None:
+                _analysis_stats['bytes'] -= len(previous)
+            _analysis_cache[key] = payload
+            _analysis_stats['bytes'] += len(payload)
+            while _analysis_stats['bytes'] > ANALYSIS_CACHE_BYTES:
+                oldest = next(iter(_analysis_cache))
+                _analysis_stats['bytes'] -= len(_analysis_cache.pop(oldest))
+                _analysis_stats['evictions'] += 1
+        return result
+
+    return wrapper
+
+def analysis_cache_stats():
+    """Счетчики кеша анализа: hits, misses, evictions, bytes, entries и доля попаданий hit_rate"""
+    with _cache_lock:
+        stats = dict(_analysis_stats, entries=len(_analysis_cache))
+    calls = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / calls if calls else 0.0
+    return stats
+
+def invalidate_orders_cache(db_path=None):
+    """Сброс кеша заказов (для одной БД или всех), результатов анализа и зависимых кешей Streamlit"""
+    with _cache_lock:
+        for cache in (_orders_cache, _index_cache, _filtered_cache, _aggregate_cache):
+            for key in list(cache):
+                if db_path is None or key[0] == os.path.abspath(db_path):
+                    del cache[key]
+        _analysis_cache.clear()
+        _drilldown_cache.clear()
+        _analysis_stats['bytes'] = 0
+    close_readers(db_path)
+
+    for func in _dependent_caches:
+        func.clear()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Соединения с orimex_orders.db: пул читателей и соединение писателя
+
+Дашборды читают базу через read_connection(): соединения открываются
+только на чтение (URI mode=ro), с mmap и увеличенным кешем страниц,
+и возвращаются в небольшой пул, поэтому повторные запросы не платят
+за открытие файла и разбор схемы.
+
+Загрузка данных (csv_to_db, batch_ingest) пишет через connect_writer(),
+которое переводит базу в режим WAL. В WAL читатели не блокируются
+писателем: пока загружается CSV, дашборды на всех портах видят последнюю
+зафиксированную версию данных.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'orimex_orders.db'
+
+# Настройки соединений на чтение
+READER_PRAGMAS = {
+    'mmap_size': 268435456,  # 256 МБ
+    'cache_size': -65536,  # 64 МБ
+    'temp_store': 'MEMORY',
+}
+
+# Настройки соединения писателя: WAL сохраняется в файле БД
+WRITER_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+}
+
+# Сколько секунд ждать блокировку БД
+BUSY_TIMEOUT = 30
+
+# Сколько свободных соединений на чтение хранить для одной БД
+READER_POOL_SIZE = 4
+
+# Свободные соединения на чтение: абсолютный путь к БД -> список соединений
+_reader_pool = {}
+_pool_lock = threading.Lock()
+
+def connect_reader(db_path=DB_PATH):
+    """
+    Новое соединение только на чтение (mode=ro)
+
+    Отсутствующий файл не создается: sqlite3.OperationalError.
+    Соединение можно передавать между потоками (используется пулом по одному потоку за раз).
+    """
+    uri = f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    for name, value in READER_PRAGMAS.items():
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+@contextmanager
+def read_connection(db_path=DB_PATH):
+    """
+    Соединение на чтение из пула (with read_connection(path) as conn: ...)
+
+    После блока соединение возвращается в пул; после ошибки SQLite закрывается.
+    """
+    key = os.path.abspath(db_path)
+    with _pool_lock:
+        idle = _reader_pool.get(key)
+        conn = idle.pop() if idle else None
+    if conn is None:
+        conn = connect_reader(db_path)
+
+    try:
+        yield conn
+    except sqlite3.Error:
+        conn.close()
+        raise
+    except BaseException:
+        conn.rollback()
+        _release(key, conn)
+        raise
+    else:
+        _release(key, conn)
+
+def _release(key, conn):
+    """Возврат соединения в пул (лишние закрываются)"""
+    with _pool_lock:
+        idle = _reader_pool.setdefault(key, [])
+        if len(idle) < READER_POOL_SIZE:
+            idle.append(conn)
+            return
+    conn.close()
+
+def close_readers(db_path=None):
+    """Закрытие свободных соединений на чтение (для одной БД или всех), например после замены файла БД"""
+    with _pool_lock:
+        keys = [key for key in _reader_pool if db_path is None or key == os.path.abspath(db_path)]
+        connections = [conn for key in keys for conn in _reader_pool.pop(key)]
+    for conn in connections:
+        conn.close()
+
+def connect_writer(db_path=DB_PATH):
+    """
+    Соединение писателя: режим WAL, synchronous=NORMAL и ожидание блокировки
+
+    Писатель у БД должен быть один (загрузка CSV или процесс-писатель batch_ingest).
+    """
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT)
+    for name, value in WRITER_PRAGMAS.items():
+        try:
+            conn.execute(f'PRAGMA {name} = {value}')
+        except sqlite3.Error as e:
+            logger.warning(f"Не удалось установить PRAGMA {name} = {value}: {e}")
+    return conn
@@ -6,11 +6,9 @@
 
 import streamlit as st
 import pandas as pd
-import sqlite3
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import plotly.figure_factory as ff
 from datetime import datetime, timedelta
 import numpy as np
 import warnings
@@ -21,6 +19,12 @@ warnings.filterwarnings('ignore')
 
 # Импортируем функцию для работы с CSV
 from csv_to_db import parse_csv_to_database
+from db_connections import close_readers, read_connection
+from data_access import (ROLLUP_PERIODS, DailyRollup, InteractionMatrix, PeriodComparison,
+                         aggregate_daily, analysis_cache_stats, contractor_main_categories, cube_supports,
+                         data_token, drilldown_index, filters_key, invalidate_orders_cache, load_daily_agg,
+                         memoize_analysis, missing_tables, monthly_comparison, orders_summary,
+                         query_orders, register_dependent_cache)
 
 # Настройка страницы
 st.set_page_config(
@@ -110,9 +114,8 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-@st.cache_data(ttl=300)
-def load_data():
-    """Загрузка данных из базы данных"""
+def load_summary():
+    """Проверка базы данных и сводка по заказам (период, итоги, значения фильтров)"""
     try:
         # Проверяем существование базы данных
         if not os.path.exists('orimex_orders.db'):
@@ -125,112 +128,64 @@ def load_data():
                 success = parse_csv_to_database(csv_file, 'orimex_orders.db')
                 if not success:
                     st.error("❌ Не удалось создать базу данных из исходного файла.")
-                    return pd.DataFrame()
+                    return None
             else:
                 st.error("❌ Исходный CSV файл не найден. Пожалуйста, загрузите данные через интерфейс.")
-                return pd.DataFrame()
-        
-        conn = sqlite3.connect('orimex_orders.db')
+                return None
         
         # Проверяем существование таблиц
-        cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
-        table_names = [table[0] for table in tables]
-        
-        if 'orders' not in table_names or 'contractors' not in table_names or 'products' not in table_names:
+        if missing_tables('orimex_orders.db'):
             st.error("❌ База данных не содержит необходимых таблиц. Пожалуйста, пересоздайте базу данных.")
-            conn.close()
-            return pd.DataFrame()
-        
-        query = '''
-        SELECT 
-            o.id,
-            o.order_date,
-            o.quantity,
-            o.amount,
-            c.head_contractor,
-            c.buyer,
-            c.manager,
-            c.region,
-            p.name as product_name,
-            p.characteristics,
-            p.category
-        FROM orders o
-        JOIN contractors c ON o.contractor_id = c.id
-        JOIN products p ON o.product_id = p.id
-        WHERE o.amount IS NOT NULL AND o.amount > 0
-        '''
+            return None
         
-        df = pd.read_sql_query(query, conn)
+        summary = orders_summary('orimex_orders.db')
         
-        if df.empty:
+        if summary['records'] == 0:
             st.error("❌ База данных пуста. Убедитесь, что данные были загружены.")
-            conn.close()
-            return pd.DataFrame()
+            return None
         
-        df['order_date'] = pd.to_datetime(df['order_date'])
-        df['month'] = df['order_date'].dt.to_period('M')
-        df['week'] = df['order_date'].dt.to_period('W')
-        df['day_of_week'] = df['order_date'].dt.day_name()
-        df['quarter'] = df['order_date'].dt.to_period('Q')
+        return summary
         
-        conn.close()
-        return df
+    except Exception as e:
+        st.error(f"Ошибка загрузки данных: {e}")
+        return None
+
+def load_data(filters=None):
+    """Загрузка заказов, подходящих под фильтры (отбор выполняется в базе данных)"""
+    try:
+        return query_orders('orimex_orders.db', filters, categorical=True)
         
     except Exception as e:
         st.error(f"Ошибка загрузки данных: {e}")
         return pd.DataFrame()
 
-@st.cache_data(ttl=300)
-def create_sales_dynamics_analysis(df, period_type='День', start_date=None, end_date=None):
-    """Анализ динамики продаж по выбранному периоду"""
-    
-    if df.empty:
-        return None, None, None, None
-    
-    # Фильтрация по датам если указаны
+@register_dependent_cache
+@st.cache_data(max_entries=32)
+def create_sales_dynamics_analysis(_rollup, data_key, period_type='День', start_date=None, end_date=None):
+    """
+    Анализ динамики продаж по выбранному периоду
+    
+    _rollup - дневной ряд выборки, свернутый во все периоды (DailyRollup,
+    create_sales_rollup): итоги периода берутся из накопленных сумм,
+    средний чек - выручка периода на количество заказов.
+    data_key - ключ кеша вместо хеша _rollup: токен версии данных и сигнатура фильтров.
+    """
+    if _rollup.size == 0:
+        return None, None, None, None, None, None
+    
+    # Итоги по периодам, с фильтрацией по датам если указаны
     if start_date and end_date:
-        # Преобразуем date объекты в datetime для корректного сравнения
-        start_datetime = pd.to_datetime(start_date)
-        end_datetime = pd.to_datetime(end_date) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
-        df_filtered = df[(df['order_date'] >= start_datetime) & (df['order_date'] <= end_datetime)].copy()
+        dynamics_data = _rollup.totals(period_type, start_date, end_date)
     else:
-        df_filtered = df.copy()
-    
-    # Преобразование даты
-    df_filtered['order_date'] = pd.to_datetime(df_filtered['order_date'])
-    
-    # Определение группировки по периоду
-    if period_type == 'День':
-        df_filtered['period'] = df_filtered['order_date'].dt.date
-        date_format = '%d.%m.%Y'
-    elif period_type == 'Неделя':
-        df_filtered['period'] = df_filtered['order_date'].dt.to_period('W').dt.start_time.dt.date
-        date_format = '%d.%m.%Y'
-    elif period_type == 'Месяц':
-        df_filtered['period'] = df_filtered['order_date'].dt.to_period('M').dt.start_time.dt.date
-        date_format = '%m.%Y'
-    elif period_type == 'Квартал':
-        df_filtered['period'] = df_filtered['order_date'].dt.to_period('Q').dt.start_time.dt.date
-        date_format = 'Q%q %Y'
-    else:  # Год
-        df_filtered['period'] = df_filtered['order_date'].dt.to_period('Y').dt.start_time.dt.date
-        date_format = '%Y'
-    
-    # Агрегация данных по периоду
-    dynamics_data = df_filtered.groupby('period').agg({
-        'amount': ['sum', 'mean', 'count'],
-        'quantity': 'sum'
-    }).round(2)
+        dynamics_data = _rollup.totals(period_type)
+    dynamics_data['period'] = dynamics_data['period'].dt.date
+    dynamics_data['average'] = dynamics_data['amount'] / dynamics_data['orders']
+    dynamics_data = dynamics_data.set_index('period')[['amount', 'average', 'orders', 'quantity']].round(2)
     
     # Выравнивание колонок
     dynamics_data.columns = ['Выручка', 'Средний_чек', 'Количество_заказов', 'Количество_товаров']
     dynamics_data = dynamics_data.reset_index()
     
-    # Сортировка по дате
-    dynamics_data = dynamics_data.sort_values('period')
-    
     # Расчет трендов
     dynamics_data['Выручка_тренд'] = dynamics_data['Выручка'].rolling(window=min(7, len(dynamics_data)), center=True).mean()
     dynamics_data['Заказы_тренд'] = dynamics_data['Количество_заказов'].rolling(window=min(7, len(dynamics_data)), center=True).mean()
@@ -388,11 +343,20 @@ def create_sales_dynamics_analysis(df, period_type='День', start_date=None,
     
     return fig_revenue, fig_orders, fig_avg_check, fig_combined, dynamics_data, stats
 
+@memoize_analysis
+def create_sales_rollup(daily):
+    """Свертка дневных итогов выборки сразу во все периоды динамики продаж (один проход на data_key)"""
+    return DailyRollup(daily)
+
+# Дневные итоги по заказам выборки, когда дневной куб к фильтрам неприменим
+aggregate_daily_cached = memoize_analysis(aggregate_daily)
+
+@memoize_analysis
 def create_manager_detailed_analysis(df):
     """Детальный анализ менеджеров"""
     
     # Основная статистика по менеджерам
-    manager_stats = df.groupby('manager').agg({
+    manager_stats = df.groupby('manager', observed=True).agg({
         'amount': ['sum', 'mean', 'count', 'std'],
         'buyer': 'nunique',
         'head_contractor': 'nunique',
@@ -421,7 +385,7 @@ def create_manager_detailed_analysis(df):
     manager_stats['Стабильность'] = manager_stats['Средний заказ'] / manager_stats['Стандартное отклонение'].replace(0, 1)
     
     # Динамика менеджеров по месяцам
-    manager_dynamics = df.groupby(['manager', df['order_date'].dt.to_period('M')])['amount'].sum().unstack(fill_value=0)
+    manager_dynamics = df.groupby(['manager', df['order_date'].dt.to_period('M')], observed=True)['amount'].sum().unstack(fill_value=0)
     
     # Топ-10 менеджеров для детального анализа
     top_managers = manager_stats.nlargest(10, 'Общая сумма')
@@ -473,11 +437,12 @@ def create_manager_detailed_analysis(df):
     
     return fig_manager_performance, fig_manager_dynamics, manager_stats_sorted
 
+@memoize_analysis
 def create_contractor_detailed_analysis(df):
     """Детальный анализ контрагентов"""
     
     # Анализ головных контрагентов
-    contractor_stats = df.groupby('head_contractor').agg({
+    contractor_stats = df.groupby('head_contractor', observed=True).agg({
         'amount': ['sum', 'mean', 'count', 'std'],
         'buyer': 'nunique',
         'manager': 'nunique',
@@ -506,7 +471,7 @@ def create_contractor_detailed_analysis(df):
     contractor_stats['Средний чек на покупателя'] = contractor_stats['Общая сумма'] / contractor_stats['Покупателей'].replace(0, 1)
     
     # Анализ покупателей (детальный уровень)
-    buyer_stats = df.groupby(['head_contractor', 'buyer']).agg({
+    buyer_stats = df.groupby(['head_contractor', 'buyer'], observed=True).agg({
         'amount': ['sum', 'mean', 'count'],
         'manager': 'first',
         'region': 'first',
@@ -520,7 +485,7 @@ def create_contractor_detailed_analysis(df):
     buyer_stats = buyer_stats.reset_index()
     
     # Динамика контрагентов
-    contractor_dynamics = df.groupby(['head_contractor', df['order_date'].dt.to_period('M')])['amount'].sum().unstack(fill_value=0)
+    contractor_dynamics = df.groupby(['head_contractor', df['order_date'].dt.to_period('M')], observed=True)['amount'].sum().unstack(fill_value=0)
     
     # Топ контрагенты
     top_contractors = contractor_stats.nlargest(10, 'Общая сумма')
@@ -582,30 +547,27 @@ def create_contractor_detailed_analysis(df):
     
     return fig_contractor_segments, fig_contractor_dynamics, contractor_stats, buyer_stats, all_contractors, contractor_dynamics
 
+@memoize_analysis
 def create_manager_contractor_matrix(df):
     """Матрица взаимодействия менеджер-контрагент"""
     
-    # Создаем матрицу менеджер × контрагент
-    interaction_matrix = df.groupby(['manager', 'head_contractor'])['amount'].sum().unstack(fill_value=0)
+    # Разреженная матрица менеджер × контрагент: только пары с заказами
+    interactions = InteractionMatrix(df, 'manager', 'head_contractor', 'amount', distinct='buyer')
     
     # Топ взаимодействия
-    manager_contractor_pairs = df.groupby(['manager', 'head_contractor']).agg({
-        'amount': 'sum',
-        'id': 'count',
-        'buyer': 'nunique'
-    }).reset_index()
-    
+    manager_contractor_pairs = interactions.entries().rename(columns={'count': 'id'})
     manager_contractor_pairs = manager_contractor_pairs.sort_values('amount', ascending=False)
     
     # Heatmap топ взаимодействий
-    top_pairs = manager_contractor_pairs.head(50)
+    top_pairs = interactions.top(50)
     
-    # Создаем сводную таблицу для heatmap
+    # Создаем сводную таблицу для heatmap (плотный только срез топ пар)
     heatmap_data = top_pairs.pivot_table(
         index='manager', 
         columns='head_contractor', 
         values='amount', 
-        fill_value=0
+        fill_value=0,
+        observed=True
     )
     
     fig_heatmap = go.Figure(data=go.Heatmap(
@@ -628,6 +590,7 @@ def create_manager_contractor_matrix(df):
     
     return fig_heatmap, manager_contractor_pairs
 
+@memoize_analysis
 def create_temporal_analysis(df, entity_type='manager', grouping_period='Месяцы'):
     """Временной анализ для менеджеров или контрагентов с разными периодами группировки"""
 
@@ -648,13 +611,13 @@ def create_temporal_analysis(df, entity_type='manager', grouping_period='Мес
         growth_period = 'M'
 
     # Анализ по выбранному периоду
-    period_data = df.groupby([entity_col, df['order_date'].dt.to_period(period_freq)])['amount'].sum().unstack(fill_value=0)
+    period_data = df.groupby([entity_col, df['order_date'].dt.to_period(period_freq)], observed=True)['amount'].sum().unstack(fill_value=0)
 
     # Рост по периодам
     period_growth = period_data.pct_change(axis=1) * 100
 
     # Топ-5 для детального анализа
-    top_entities = df.groupby(entity_col)['amount'].sum().nlargest(5).index
+    top_entities = df.groupby(entity_col, observed=True)['amount'].sum().nlargest(5).index
 
     # График роста по периодам
     fig_growth = go.Figure()
@@ -682,17 +645,17 @@ def create_temporal_analysis(df, entity_type='manager', grouping_period='Мес
     # Анализ паттернов (сезонный или недельный в зависимости от периода)
     if grouping_period == 'Дни':
         # Дневной паттерн по часам или дням недели
-        pattern_data = df.groupby([entity_col, df['order_date'].dt.dayofweek])['amount'].mean().unstack(fill_value=0)
+        pattern_data = df.groupby([entity_col, df['order_date'].dt.dayofweek], observed=True)['amount'].mean().unstack(fill_value=0)
         pattern_labels = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
         pattern_title = "Дневной паттерн"
     elif grouping_period == 'Недели':
         # Недельный паттерн по дням недели
-        pattern_data = df.groupby([entity_col, df['order_date'].dt.dayofweek])['amount'].mean().unstack(fill_value=0)
+        pattern_data = df.groupby([entity_col, df['order_date'].dt.dayofweek], observed=True)['amount'].mean().unstack(fill_value=0)
         pattern_labels = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
         pattern_title = "Недельный паттерн"
     else:  # Месяцы
         # Месячный паттерн
-        pattern_data = df.groupby([entity_col, df['order_date'].dt.month])['amount'].mean().unstack(fill_value=0)
+        pattern_data = df.groupby([entity_col, df['order_date'].dt.month], observed=True)['amount'].mean().unstack(fill_value=0)
         pattern_labels = ['Янв', 'Фев', 'Мар', 'Апр', 'Май', 'Июн',
                          'Июл', 'Авг', 'Сен', 'Окт', 'Ноя', 'Дек']
         pattern_title = "Месячный паттерн"
@@ -717,6 +680,7 @@ def create_temporal_analysis(df, entity_type='manager', grouping_period='Мес
 
     return fig_growth, fig_pattern
 
+@memoize_analysis
 def create_advanced_kpi_dashboard(df):
     """Расширенная панель KPI"""
     
@@ -732,21 +696,21 @@ def create_advanced_kpi_dashboard(df):
     median_order_value = df['amount'].median()
     
     # Концентрация (индекс Херфиндаля-Хиршмана)
-    manager_shares = df.groupby('manager')['amount'].sum() / total_revenue
+    manager_shares = df.groupby('manager', observed=True)['amount'].sum() / total_revenue
     hhi_managers = (manager_shares ** 2).sum() * 10000  # HHI индекс
     
-    contractor_shares = df.groupby('head_contractor')['amount'].sum() / total_revenue  
+    contractor_shares = df.groupby('head_contractor', observed=True)['amount'].sum() / total_revenue  
     hhi_contractors = (contractor_shares ** 2).sum() * 10000
     
     # Эффективность менеджеров
-    manager_efficiency = df.groupby('manager').agg({
+    manager_efficiency = df.groupby('manager', observed=True).agg({
         'amount': 'sum',
         'buyer': 'nunique'
     })
     avg_manager_efficiency = (manager_efficiency['amount'] / manager_efficiency['buyer'].replace(0, 1)).mean()
     
     # Retention rate (упрощенный)
-    customer_orders = df.groupby('buyer')['id'].count()
+    customer_orders = df.groupby('buyer', observed=True)['id'].count()
     repeat_customers = len(customer_orders[customer_orders > 1])
     retention_rate = repeat_customers / unique_customers * 100 if unique_customers > 0 else 0
     
@@ -772,11 +736,12 @@ def create_advanced_kpi_dashboard(df):
         'mom_growth': mom_growth
     }
 
+@memoize_analysis
 def create_product_detailed_analysis(df):
     """Детальный анализ товаров"""
     
     # Основная статистика по товарам
-    product_stats = df.groupby(['product_name', 'category']).agg({
+    product_stats = df.groupby(['product_name', 'category'], observed=True).agg({
         'amount': ['sum', 'mean', 'count', 'std'],
         'quantity': ['sum', 'mean'],
         'buyer': 'nunique',
@@ -822,7 +787,7 @@ def create_product_detailed_analysis(df):
     product_stats_sorted['ABC класс'] = product_stats_sorted['Накопительная доля'].apply(abc_classification)
     
     # Динамика товаров по месяцам
-    product_dynamics = df.groupby(['product_name', df['order_date'].dt.to_period('M')])['amount'].sum().unstack(fill_value=0)
+    product_dynamics = df.groupby(['product_name', df['order_date'].dt.to_period('M')], observed=True)['amount'].sum().unstack(fill_value=0)
     
     # График популярности vs прибыльности
     fig_product_matrix = px.scatter(
@@ -866,7 +831,7 @@ def create_product_detailed_analysis(df):
     )
     
     # Динамика по категориям
-    category_dynamics = df.groupby(['category', df['order_date'].dt.to_period('M')])['amount'].sum().unstack(fill_value=0)
+    category_dynamics = df.groupby(['category', df['order_date'].dt.to_period('M')], observed=True)['amount'].sum().unstack(fill_value=0)
     
     fig_category_dynamics = go.Figure()
     
@@ -896,10 +861,10 @@ def create_product_detailed_analysis(df):
         category_data = df[df['category'] == category]
         
         # Динамика товаров в этой категории
-        category_product_dynamics = category_data.groupby(['product_name', category_data['order_date'].dt.to_period('M')])['amount'].sum().unstack(fill_value=0)
+        category_product_dynamics = category_data.groupby(['product_name', category_data['order_date'].dt.to_period('M')], observed=True)['amount'].sum().unstack(fill_value=0)
         
         # Берем топ-10 товаров в категории
-        category_top_products = category_data.groupby('product_name')['amount'].sum().nlargest(10).index
+        category_top_products = category_data.groupby('product_name', observed=True)['amount'].sum().nlargest(10).index
         
         fig_category_products = go.Figure()
         
@@ -928,14 +893,19 @@ def create_product_detailed_analysis(df):
     
     return fig_product_matrix, fig_product_dynamics, product_stats_sorted, fig_category_dynamics, category_product_charts
 
-def create_contractor_product_analysis(df):
-    """Анализ связки контрагент-товар"""
+@memoize_analysis
+def create_contractor_product_analysis(df, top_pairs_count=10):
+    """
+    Анализ связки контрагент-товар
+    
+    top_pairs_count - сколько пар с наибольшей выручкой показать в динамике по месяцам.
+    """
     
     # Анализ предпочтений контрагентов по товарам
-    contractor_product_matrix = df.groupby(['head_contractor', 'product_name'])['amount'].sum().unstack(fill_value=0)
+    contractor_product_matrix = df.groupby(['head_contractor', 'product_name'], observed=True)['amount'].sum().unstack(fill_value=0)
     
     # Топ связки контрагент-товар
-    contractor_product_pairs = df.groupby(['head_contractor', 'product_name', 'category']).agg({
+    contractor_product_pairs = df.groupby(['head_contractor', 'product_name', 'category'], observed=True).agg({
         'amount': 'sum',
         'quantity': 'sum',
         'id': 'count',
@@ -945,13 +915,13 @@ def create_contractor_product_analysis(df):
     contractor_product_pairs = contractor_product_pairs.sort_values('amount', ascending=False)
     
     # Специализация контрагентов по категориям
-    contractor_category_specialization = df.groupby(['head_contractor', 'category'])['amount'].sum().unstack(fill_value=0)
+    contractor_category_specialization = df.groupby(['head_contractor', 'category'], observed=True)['amount'].sum().unstack(fill_value=0)
     contractor_category_pct = contractor_category_specialization.div(
         contractor_category_specialization.sum(axis=1), axis=0
     ) * 100
     
     # Heatmap специализации топ контрагентов
-    top_contractors_spec = df.groupby('head_contractor')['amount'].sum().nlargest(15).index
+    top_contractors_spec = df.groupby('head_contractor', observed=True)['amount'].sum().nlargest(15).index
     
     fig_contractor_specialization = go.Figure(data=go.Heatmap(
         z=contractor_category_pct.loc[top_contractors_spec].values,
@@ -972,7 +942,7 @@ def create_contractor_product_analysis(df):
     )
     
     # Анализ диверсификации товаров у контрагентов
-    contractor_diversity = df.groupby('head_contractor').agg({
+    contractor_diversity = df.groupby('head_contractor', observed=True).agg({
         'product_name': 'nunique',
         'category': 'nunique',
         'amount': 'sum',
@@ -1000,43 +970,50 @@ def create_contractor_product_analysis(df):
     )
     fig_diversity.update_layout(height=600)
     
-    # Динамика топ пар контрагент-товар
-    top_pairs = contractor_product_pairs.head(10)
-    
-    # Создаем временную динамику для топ пар
-    pairs_dynamics = []
-    for _, pair in top_pairs.iterrows():
-        pair_data = df[
-            (df['head_contractor'] == pair['head_contractor']) & 
-            (df['product_name'] == pair['product_name'])
-        ].groupby(df['order_date'].dt.to_period('M'))['amount'].sum()
-        
-        for month, amount in pair_data.items():
-            pairs_dynamics.append({
-                'Месяц': str(month),
-                'Пара': f"{pair['head_contractor'][:15]}—{pair['product_name'][:15]}",
-                'Выручка': amount,
-                'Контрагент': pair['head_contractor'],
-                'Товар': pair['product_name']
-            })
-    
-    pairs_df = pd.DataFrame(pairs_dynamics)
+    # Динамика топ пар контрагент-товар: строки топ пар отбираются одной маской
+    # по индексу пар, затем одна группировка по (контрагент, товар, месяц)
+    top_pairs = contractor_product_pairs.head(top_pairs_count)[['head_contractor', 'product_name']].reset_index(drop=True)
+    pair_index = pd.MultiIndex.from_frame(top_pairs)
+    pair_rows = df[pd.MultiIndex.from_arrays([df['head_contractor'], df['product_name']]).isin(pair_index)]
+    pairs_monthly = pair_rows.groupby(
+        ['head_contractor', 'product_name', pair_rows['order_date'].dt.to_period('M').rename('month')], observed=True
+    )['amount'].sum().reset_index()
+    
+    # Порядок как у топа пар, внутри пары - по месяцам
+    pairs_monthly = top_pairs.rename_axis('rank').reset_index().merge(
+        pairs_monthly, on=['head_contractor', 'product_name']
+    ).sort_values(['rank', 'month'], kind='stable')
+    
+    contractors = pairs_monthly['head_contractor'].astype(str)
+    products = pairs_monthly['product_name'].astype(str)
+    pairs_df = pd.DataFrame({
+        'Месяц': pairs_monthly['month'].astype(str),
+        'Пара': contractors.str[:15] + '—' + products.str[:15],
+        'Выручка': pairs_monthly['amount'],
+        'Контрагент': contractors,
+        'Товар': products
+    }).reset_index(drop=True)
     
     fig_pairs_dynamics = px.line(
         pairs_df,
         x='Месяц',
         y='Выручка',
         color='Пара',
-        title="📊 Динамика топ-10 пар контрагент-товар",
+        title=f"📊 Динамика топ-{top_pairs_count} пар контрагент-товар",
         height=500
     )
     
     return fig_contractor_specialization, fig_diversity, fig_pairs_dynamics, contractor_product_pairs, contractor_diversity
 
-def create_product_deep_dive(df, selected_product):
-    """Глубокий анализ конкретного товара"""
+@memoize_analysis
+def create_product_deep_dive(products, selected_product):
+    """
+    Глубокий анализ конкретного товара
+    
+    products - индекс строк выборки по товару (drilldown_index по product_name).
+    """
     
-    product_data = df[df['product_name'] == selected_product]
+    product_data = products.select(selected_product)
     
     if product_data.empty:
         return None, None, None
@@ -1087,7 +1064,7 @@ def create_product_deep_dive(df, selected_product):
     fig_product_trend.update_layout(height=600, showlegend=False, title_text=f"📊 Детальная динамика товара: {selected_product}")
     
     # Топ контрагенты для этого товара
-    product_contractors = product_data.groupby('head_contractor').agg({
+    product_contractors = product_data.groupby('head_contractor', observed=True).agg({
         'amount': 'sum',
         'quantity': 'sum',
         'id': 'count',
@@ -1095,17 +1072,19 @@ def create_product_deep_dive(df, selected_product):
     }).sort_values('amount', ascending=False).reset_index()
     
     # Региональное распределение товара
-    product_regions = product_data.groupby('region')['amount'].sum().sort_values(ascending=False)
+    product_regions = product_data.groupby('region', observed=True)['amount'].sum().sort_values(ascending=False)
     
     return fig_product_trend, product_contractors, product_regions
 
-def create_contractor_product_deep_dive(df, selected_contractor, selected_product):
-    """Глубокий анализ пары контрагент-товар"""
+@memoize_analysis
+def create_contractor_product_deep_dive(pairs, selected_contractor, selected_product):
+    """
+    Глубокий анализ пары контрагент-товар
     
-    pair_data = df[
-        (df['head_contractor'] == selected_contractor) & 
-        (df['product_name'] == selected_product)
-    ]
+    pairs - индекс строк выборки по паре (drilldown_index по head_contractor и product_name).
+    """
+    
+    pair_data = pairs.select(selected_contractor, selected_product)
     
     if pair_data.empty:
         return None, None
@@ -1160,45 +1139,24 @@ def create_contractor_product_deep_dive(df, selected_contractor, selected_produc
     return fig_pair_dynamics, pair_stats
 
 def create_period_comparison(df, period1_start, period1_end, period2_start, period2_end):
-    """Сравнение двух периодов"""
+    """
+    Сравнение двух периодов
     
-    # Фильтрация данных по периодам
-    period1_data = df[
-        (df['order_date'].dt.date >= period1_start) & 
-        (df['order_date'].dt.date <= period1_end)
-    ]
+    Строки периодов отбираются по отсортированным датам (PeriodComparison),
+    все метрики обоих периодов считаются одной группировкой на каждый разрез.
+    """
     
-    period2_data = df[
-        (df['order_date'].dt.date >= period2_start) & 
-        (df['order_date'].dt.date <= period2_end)
-    ]
+    comparison = PeriodComparison(df, {
+        'Период 1': (period1_start, period1_end),
+        'Период 2': (period2_start, period2_end)
+    })
     
     # Основные метрики сравнения
-    comparison_metrics = {
-        'Выручка': {
-            'Период 1': period1_data['amount'].sum(),
-            'Период 2': period2_data['amount'].sum()
-        },
-        'Заказы': {
-            'Период 1': len(period1_data),
-            'Период 2': len(period2_data)
-        },
-        'Средний чек': {
-            'Период 1': period1_data['amount'].mean(),
-            'Период 2': period2_data['amount'].mean()
-        },
-        'Клиенты': {
-            'Период 1': period1_data['buyer'].nunique(),
-            'Период 2': period2_data['buyer'].nunique()
-        },
-        'Контрагенты': {
-            'Период 1': period1_data['head_contractor'].nunique(),
-            'Период 2': period2_data['head_contractor'].nunique()
-        }
-    }
+    totals = comparison.totals().set_index('period')[['amount', 'orders', 'average', 'buyers', 'contractors']]
+    totals.columns = ['Выручка', 'Заказы', 'Средний чек', 'Клиенты', 'Контрагенты']
     
     # График сравнения основных метрик
-    metrics_df = pd.DataFrame(comparison_metrics).T
+    metrics_df = totals.rename_axis(None).T.astype(float)
     metrics_df['Изменение'] = ((metrics_df['Период 2'] - metrics_df['Период 1']) / metrics_df['Период 1'] * 100).round(1)
     
     fig_comparison = go.Figure()
@@ -1226,14 +1184,7 @@ def create_period_comparison(df, period1_start, period1_end, period2_start, peri
     )
     
     # Сравнение по категориям
-    cat1_data = period1_data.groupby('category')['amount'].sum()
-    cat2_data = period2_data.groupby('category')['amount'].sum()
-    
-    # Объединяем данные по категориям
-    cat_comparison = pd.DataFrame({
-        'Период 1': cat1_data,
-        'Период 2': cat2_data
-    }).fillna(0)
+    cat_comparison = comparison.pivot(['category']).fillna(0)
     
     cat_comparison['Изменение %'] = ((cat_comparison['Период 2'] - cat_comparison['Период 1']) / cat_comparison['Период 1'] * 100).round(1)
     cat_comparison['Изменение %'] = cat_comparison['Изменение %'].replace([np.inf, -np.inf], 0)
@@ -1262,13 +1213,10 @@ def create_period_comparison(df, period1_start, period1_end, period2_start, peri
         height=500
     )
     
-    # Сравнение топ менеджеров
-    mgr1_data = period1_data.groupby('manager')['amount'].sum().nlargest(10)
-    mgr2_data = period2_data.groupby('manager')['amount'].sum().nlargest(10)
-    
+    # Сравнение топ менеджеров (топ-10 каждого периода)
+    mgr_amounts = comparison.pivot(['manager'])
     mgr_comparison = pd.DataFrame({
-        'Период 1': mgr1_data,
-        'Период 2': mgr2_data
+        period: mgr_amounts[period].dropna().nlargest(10) for period in mgr_amounts.columns
     }).fillna(0)
     
     fig_manager_comparison = go.Figure()
@@ -1296,13 +1244,7 @@ def create_period_comparison(df, period1_start, period1_end, period2_start, peri
     )
     
     # Сравнение всех контрагентов
-    contr1_data = period1_data.groupby('head_contractor')['amount'].sum()
-    contr2_data = period2_data.groupby('head_contractor')['amount'].sum()
-    
-    contr_comparison = pd.DataFrame({
-        'Период 1': contr1_data,
-        'Период 2': contr2_data
-    }).fillna(0)
+    contr_comparison = comparison.pivot(['head_contractor']).fillna(0)
     
     fig_contractor_comparison = go.Figure()
     
@@ -1329,17 +1271,8 @@ def create_period_comparison(df, period1_start, period1_end, period2_start, peri
     )
 
     # Анализ выручки товаров по категориям между периодами
-    product1_data = period1_data.groupby(['product_name', 'category'])['amount'].sum().reset_index()
-    product2_data = period2_data.groupby(['product_name', 'category'])['amount'].sum().reset_index()
-
-    # Объединяем данные по товарам
-    product_comparison = pd.merge(
-        product1_data,
-        product2_data,
-        on=['product_name', 'category'],
-        suffixes=('_p1', '_p2'),
-        how='outer'
-    ).fillna(0)
+    product_comparison = comparison.pivot(['product_name', 'category']).fillna(0).reset_index()
+    product_comparison = product_comparison.rename(columns={'Период 1': 'amount_p1', 'Период 2': 'amount_p2'})
 
     # Рассчитываем изменение выручки
     product_comparison['Изменение выручки'] = product_comparison['amount_p2'] - product_comparison['amount_p1']
@@ -1396,21 +1329,81 @@ def create_period_comparison(df, period1_start, period1_end, period2_start, peri
     return (fig_comparison, fig_category_comparison, fig_manager_comparison,
             fig_contractor_comparison, metrics_df, cat_comparison, product_comparison_charts)
 
+def create_monthly_comparison(df, start_date, end_date, months=12, history_start=None):
+    """
+    Помесячное сравнение: каждый месяц диапазона с месяцем на months раньше
+
+    months=1 - к предыдущему месяцу (MoM), months=12 - к тому же месяцу год назад (YoY).
+    Все месяцы и их базы считаются одним PeriodComparison.
+    history_start - первая дата данных: база, начинающаяся раньше, неполная или пустая,
+    поэтому ее значения и изменение не показываются (NaN), а не считаются нулем.
+    """
+    if df.empty:
+        return None, None
+
+    periods, pairs = monthly_comparison(start_date, end_date, months)
+    table = PeriodComparison(df, periods).compare(pairs)
+    table = table[table['metric'].isin(['amount', 'orders', 'average'])].copy()
+    if history_start is not None:
+        uncovered = [name for name, (period_start, _) in periods.items() if period_start < history_start]
+        table.loc[table['base'].isin(uncovered), ['base_value', 'change']] = np.nan
+
+    wide = table.pivot(index=['period', 'base'], columns='metric', values=['value', 'base_value', 'change'])
+    amounts = wide.xs('amount', axis=1, level='metric')
+
+    fig_monthly = make_subplots(specs=[[{"secondary_y": True}]])
+    fig_monthly.add_trace(go.Bar(
+        x=amounts.index.get_level_values('period'),
+        y=amounts['base_value'],
+        name='База',
+        marker_color='lightblue'
+    ), secondary_y=False)
+    fig_monthly.add_trace(go.Bar(
+        x=amounts.index.get_level_values('period'),
+        y=amounts['value'],
+        name='Месяц',
+        marker_color='lightcoral'
+    ), secondary_y=False)
+    fig_monthly.add_trace(go.Scatter(
+        x=amounts.index.get_level_values('period'),
+        y=amounts['change'],
+        name='Изменение выручки, %',
+        mode='lines+markers',
+        line=dict(color='green', width=2)
+    ), secondary_y=True)
+    fig_monthly.update_layout(
+        title="📆 Выручка по месяцам в сравнении с базой",
+        barmode='group',
+        height=450
+    )
+    fig_monthly.update_yaxes(title_text="Выручка (руб.)", secondary_y=False)
+    fig_monthly.update_yaxes(title_text="Изменение, %", secondary_y=True)
+
+    monthly_table = pd.DataFrame({
+        'Выручка': amounts['value'],
+        'Выручка (база)': amounts['base_value'],
+        'Выручка, %': amounts['change'].round(1),
+        'Заказы': wide[('value', 'orders')],
+        'Заказы (база)': wide[('base_value', 'orders')],
+        'Заказы, %': wide[('change', 'orders')].round(1),
+        'Средний чек': wide[('value', 'average')],
+        'Средний чек, %': wide[('change', 'average')].round(1)
+    }).rename_axis(['Месяц', 'База']).reset_index()
+
+    return fig_monthly, monthly_table
+
+@memoize_analysis
 def create_cross_analysis(df):
     """Кросс-анализ менеджеров и контрагентов"""
     
-    # Анализ покрытия: какие менеджеры работают с какими контрагентами
-    coverage_matrix = df.groupby(['manager', 'head_contractor']).size().unstack(fill_value=0)
-    coverage_matrix = (coverage_matrix > 0).astype(int)  # Бинарная матрица покрытия
-    
     # Специализация менеджеров по категориям
-    manager_specialization = df.groupby(['manager', 'category'])['amount'].sum().unstack(fill_value=0)
+    manager_specialization = df.groupby(['manager', 'category'], observed=True)['amount'].sum().unstack(fill_value=0)
     
     # Нормализуем по строкам для получения долей
     manager_specialization_pct = manager_specialization.div(manager_specialization.sum(axis=1), axis=0) * 100
     
     # Топ менеджеры для анализа специализации
-    top_managers_spec = df.groupby('manager')['amount'].sum().nlargest(8).index
+    top_managers_spec = df.groupby('manager', observed=True)['amount'].sum().nlargest(8).index
     
     fig_specialization = go.Figure()
     
@@ -1429,13 +1422,11 @@ def create_cross_analysis(df):
         height=500
     )
     
-    # Анализ конкуренции между менеджерами
-    shared_customers = df.groupby('buyer')['manager'].nunique()
+    # Анализ конкуренции между менеджерами: покупатели, у которых больше одного
+    # менеджера, по покрытию столбцов разреженной матрицы менеджер × покупатель
+    shared_customers = InteractionMatrix(df, 'manager', 'buyer').column_coverage()
     competitive_customers = shared_customers[shared_customers > 1]
     
-    competition_data = df[df['buyer'].isin(competitive_customers.index)]
-    manager_competition = competition_data.groupby(['buyer', 'manager'])['amount'].sum().unstack(fill_value=0)
-    
     return fig_specialization, len(competitive_customers), manager_specialization_pct
 
 def upload_and_update_data():
@@ -1505,28 +1496,28 @@ def upload_and_update_data():
                     
                     # Проверяем содержимое базы данных
                     try:
-                        conn = sqlite3.connect("orimex_orders.db")
-                        cursor = conn.cursor()
-                        
-                        # Получаем статистику
-                        cursor.execute("SELECT COUNT(*) FROM contractors")
-                        contractors_count = cursor.fetchone()[0]
-                        
-                        cursor.execute("SELECT COUNT(*) FROM products")
-                        products_count = cursor.fetchone()[0]
-                        
-                        cursor.execute("SELECT COUNT(*) FROM orders")
-                        orders_count = cursor.fetchone()[0]
-                        
-                        cursor.execute("SELECT SUM(amount) FROM orders")
-                        total_amount = cursor.fetchone()[0] or 0
-                        
-                        cursor.execute("SELECT MIN(order_date), MAX(order_date) FROM orders")
-                        date_range = cursor.fetchone()
-                        min_date, max_date = date_range[0], date_range[1]
-                        
-                        conn.close()
-                        
+                        # Новое соединение на чтение: пул может держать соединения к прежнему файлу
+                        close_readers("orimex_orders.db")
+                        with read_connection("orimex_orders.db") as conn:
+                            cursor = conn.cursor()
+                            
+                            # Получаем статистику
+                            cursor.execute("SELECT COUNT(*) FROM contractors")
+                            contractors_count = cursor.fetchone()[0]
+                            
+                            cursor.execute("SELECT COUNT(*) FROM products")
+                            products_count = cursor.fetchone()[0]
+                            
+                            cursor.execute("SELECT COUNT(*) FROM orders")
+                            orders_count = cursor.fetchone()[0]
+                            
+                            cursor.execute("SELECT SUM(amount) FROM orders")
+                            total_amount = cursor.fetchone()[0] or 0
+                            
+                            cursor.execute("SELECT MIN(order_date), MAX(order_date) FROM orders")
+                            date_range = cursor.fetchone()
+                            min_date, max_date = date_range[0], date_range[1]
+                            
                         st.sidebar.write(f"📈 Контрагентов: {contractors_count}")
                         st.sidebar.write(f"📦 Продуктов: {products_count}")
                         st.sidebar.write(f"📋 Заказов: {orders_count}")
@@ -1536,8 +1527,7 @@ def upload_and_update_data():
                         st.sidebar.success("✅ Данные успешно добавлены к существующей БД!")
 
                         # Очищаем кеш загруженных данных, чтобы сразу отобразились новые данные
-                        load_data.clear()
-                        create_sales_dynamics_analysis.clear()
+                        invalidate_orders_cache()
 
                         # Автоматически перезагружаем дашборд через 2 секунды
                         st.sidebar.info("🔄 Перезагрузка дашборда через 2 секунды...")
@@ -1572,18 +1562,21 @@ def main():
     # Функция загрузки файла
     file_uploaded = upload_and_update_data()
     
-    # Загрузка данных
+    # Сводка по базе данных (без загрузки заказов)
     with st.spinner('📊 Загрузка и обработка данных...'):
-        df = load_data()
+        summary = load_summary()
     
     # Если файл был загружен, показываем уведомление
     if file_uploaded:
         st.success("🎉 Данные успешно обновлены! Информация в дашборде актуальна.")
     
-    if df.empty:
+    if summary is None:
         st.error("❌ Не удалось загрузить данные. Убедитесь, что база данных создана.")
         return
     
+    data_start = summary['min_date'].date()
+    data_end = summary['max_date'].date()
+    
     # Информация о текущих данных
     st.sidebar.markdown("## 📊 Информация о данных")
     
@@ -1593,12 +1586,12 @@ def main():
         db_datetime = datetime.fromtimestamp(db_time)
         st.sidebar.write(f"🕒 Обновлено: {db_datetime.strftime('%d.%m.%Y %H:%M')}")
     
-    st.sidebar.write(f"📅 Период данных: {df['order_date'].min().strftime('%d.%m.%Y')} - {df['order_date'].max().strftime('%d.%m.%Y')}")
-    st.sidebar.write(f"📊 Всего записей: {len(df):,}")
-    st.sidebar.write(f"💰 Общая выручка: {df['amount'].sum():,.0f} ₽")
-    st.sidebar.write(f"🏢 Контрагентов: {df['head_contractor'].nunique():,}")
-    st.sidebar.write(f"👨‍💼 Менеджеров: {df['manager'].nunique():,}")
-    st.sidebar.write(f"📦 Товаров: {df['product_name'].nunique():,}")
+    st.sidebar.write(f"📅 Период данных: {data_start.strftime('%d.%m.%Y')} - {data_end.strftime('%d.%m.%Y')}")
+    st.sidebar.write(f"📊 Всего записей: {summary['records']:,}")
+    st.sidebar.write(f"💰 Общая выручка: {summary['revenue']:,.0f} ₽")
+    st.sidebar.write(f"🏢 Контрагентов: {len(summary['contractors']):,}")
+    st.sidebar.write(f"👨‍💼 Менеджеров: {len(summary['managers']):,}")
+    st.sidebar.write(f"📦 Товаров: {summary['products']:,}")
     
     # Кнопка обновления данных
     if st.sidebar.button("🔄 Обновить данные", help="Перезагрузить данные из базы"):
@@ -1638,37 +1631,37 @@ def main():
     
     # Логика выбора дат
     if date_preset == "Последние 30 дней":
-        end_date = df['order_date'].max().date()
+        end_date = data_end
         start_date = end_date - timedelta(days=30)
     elif date_preset == "Последние 90 дней":
-        end_date = df['order_date'].max().date()
+        end_date = data_end
         start_date = end_date - timedelta(days=90)
     elif date_preset == "Текущий месяц":
-        end_date = df['order_date'].max().date()
+        end_date = data_end
         start_date = end_date.replace(day=1)
     elif date_preset == "Предыдущий месяц":
-        current_month = df['order_date'].max().date().replace(day=1)
+        current_month = data_end.replace(day=1)
         start_date = (current_month - timedelta(days=1)).replace(day=1)
         end_date = current_month - timedelta(days=1)
     elif date_preset == "Текущий квартал":
-        end_date = df['order_date'].max().date()
+        end_date = data_end
         quarter_start_month = ((end_date.month - 1) // 3) * 3 + 1
         start_date = end_date.replace(month=quarter_start_month, day=1)
     elif date_preset == "Весь период":
-        start_date = df['order_date'].min().date()
-        end_date = df['order_date'].max().date()
+        start_date = data_start
+        end_date = data_end
     else:
         # По умолчанию весь период
-        start_date = df['order_date'].min().date()
-        end_date = df['order_date'].max().date()
+        start_date = data_start
+        end_date = data_end
     
     # Показываем селектор дат только для пользовательского режима
     if date_preset == "Пользовательский":
         date_range = st.sidebar.date_input(
             "Точный период",
             value=(start_date, end_date),
-            min_value=df['order_date'].min().date(),
-            max_value=df['order_date'].max().date()
+            min_value=data_start,
+            max_value=data_end
         )
         
         if len(date_range) == 2:
@@ -1710,7 +1703,7 @@ def main():
         return selected
 
     # Регионы
-    regions = sorted(df['region'].unique().tolist())
+    regions = summary['regions']
     selected_regions = create_filter_with_select_all(
         "🗺️ Регионы",
         regions,
@@ -1718,7 +1711,7 @@ def main():
     )
 
     # Категории
-    categories = sorted(df['category'].unique().tolist())
+    categories = summary['categories']
     selected_categories = create_filter_with_select_all(
         "📦 Категории товаров",
         categories,
@@ -1726,7 +1719,7 @@ def main():
     )
 
     # Контрагенты
-    contractors = sorted(df['head_contractor'].unique().tolist())
+    contractors = summary['contractors']
     selected_contractors = create_filter_with_select_all(
         "🏢 Головные контрагенты",
         contractors,
@@ -1734,7 +1727,7 @@ def main():
     )
 
     # Менеджеры
-    managers = sorted(df['manager'].unique().tolist())
+    managers = summary['managers']
     selected_managers = create_filter_with_select_all(
         "👨‍💼 Менеджеры",
         managers,
@@ -1750,7 +1743,7 @@ def main():
     min_amount = st.sidebar.number_input(
         "💰 Минимальный размер заказа (руб.)",
         min_value=0,
-        max_value=int(df['amount'].max()),
+        max_value=int(summary['max_amount']),
         value=0,
         help="Минимальная сумма заказа (0 = без ограничений)"
     )
@@ -1759,52 +1752,46 @@ def main():
     min_quantity = st.sidebar.number_input(
         "📦 Минимальное количество товара",
         min_value=0,
-        max_value=int(df['quantity'].max()),
+        max_value=int(summary['max_quantity']),
         value=0,
         help="Минимальное количество товара (0 = без ограничений)"
     )
     st.sidebar.markdown('</div>', unsafe_allow_html=True)
     
-    # Применение фильтров
-    filtered_df = df.copy()
-    
-    # Фильтр по датам
-    filtered_df = filtered_df[
-        (filtered_df['order_date'].dt.date >= start_date) &
-        (filtered_df['order_date'].dt.date <= end_date)
-    ]
-    
-    # Применяем остальные фильтры (только если что-то выбрано)
-    if selected_regions:  # Если список не пустой
-        filtered_df = filtered_df[filtered_df['region'].isin(selected_regions)]
-    
-    if selected_categories:  # Если список не пустой
-        filtered_df = filtered_df[filtered_df['category'].isin(selected_categories)]
-        
-    if selected_contractors:  # Если список не пустой
-        filtered_df = filtered_df[filtered_df['head_contractor'].isin(selected_contractors)]
-        
-    if selected_managers:  # Если список не пустой
-        filtered_df = filtered_df[filtered_df['manager'].isin(selected_managers)]
-    
-    # Фильтр по сумме и количеству (только если заданы ограничения)
-    if min_amount > 0:
-        filtered_df = filtered_df[filtered_df['amount'] >= min_amount]
+    # Применение фильтров: отбор выполняется в базе данных, пустые фильтры
+    # и границы периода, совпадающие с границами данных, не передаются
+    filters = {
+        'start_date': start_date if start_date > data_start else None,
+        'end_date': end_date if end_date < data_end else None,
+        'regions': selected_regions,
+        'categories': selected_categories,
+        'contractors': selected_contractors,
+        'managers': selected_managers,
+        'min_amount': min_amount,
+        'min_quantity': min_quantity,
+    }
+    filtered_df = load_data(filters)
     
-    if min_quantity > 0:
-        filtered_df = filtered_df[filtered_df['quantity'] >= min_quantity]
+    # Ключ кеша анализов: версия данных и фильтры (сам DataFrame не хешируется)
+    data_key = (data_token('orimex_orders.db'), filters_key(filters))
     
     # Отладочная информация
     st.sidebar.markdown("### 🔍 Статистика фильтрации")
-    st.sidebar.write(f"📊 Исходных записей: {len(df):,}")
+    st.sidebar.write(f"📊 Исходных записей: {summary['records']:,}")
     st.sidebar.write(f"📊 После фильтрации: {len(filtered_df):,}")
-    st.sidebar.write(f"💰 Исходная сумма: {df['amount'].sum():,.0f} ₽")
-    st.sidebar.write(f"💰 Отфильтрованная сумма: {filtered_df['amount'].sum():,.0f} ₽")
+    st.sidebar.write(f"💰 Исходная сумма: {summary['revenue']:,.0f} ₽")
+    filtered_revenue = filtered_df['amount'].sum()
+    st.sidebar.write(f"💰 Отфильтрованная сумма: {filtered_revenue:,.0f} ₽")
 
     # Статистика покрытия
-    if len(df) > 0:
-        coverage_revenue = filtered_df['amount'].sum() / df['amount'].sum() * 100
-        coverage_records = len(filtered_df) / len(df) * 100
+    if summary['records'] > 0:
+        # Сумма pandas и SUM в SQLite расходятся в последних разрядах, поэтому
+        # совпадающие с точностью до округления суммы считаются полным покрытием
+        if np.isclose(filtered_revenue, summary['revenue']):
+            coverage_revenue = 100.0
+        else:
+            coverage_revenue = filtered_revenue / summary['revenue'] * 100
+        coverage_records = len(filtered_df) / summary['records'] * 100
 
         st.sidebar.metric("🎯 Покрытие выручки", f"{coverage_revenue:.1f}%")
         st.sidebar.metric("🎯 Покрытие записей", f"{coverage_records:.1f}%")
@@ -1814,6 +1801,9 @@ def main():
         else:
             st.sidebar.success("✅ Все данные включены")
 
+    # Эффективность кеша анализов (заполняется в конце main, после анализов вкладок)
+    cache_caption = st.sidebar.empty()
+
     # Статистика по выбранным элементам
     st.sidebar.markdown("### 🎯 Активные фильтры")
 
@@ -1858,7 +1848,7 @@ def main():
         st.sidebar.write("📦 Мин. количество: без ограничений")
     
     # Расширенные KPI
-    kpis = create_advanced_kpi_dashboard(filtered_df)
+    kpis = create_advanced_kpi_dashboard(filtered_df, data_key=data_key)
     
     # Панель KPI
     st.markdown("## 💎 Ключевые показатели эффективности")
@@ -1937,7 +1927,7 @@ def main():
                 # Выбор типа периода
                 period_type = st.selectbox(
                     "📅 Тип периода",
-                    ["День", "Неделя", "Месяц", "Квартал", "Год"],
+                    list(ROLLUP_PERIODS),
                     index=2,  # По умолчанию "Месяц"
                     help="Выберите период для группировки данных"
                 )
@@ -1981,8 +1971,14 @@ def main():
             
             # Выполнение анализа
             try:
+                # Дневные итоги берутся из куба, если фильтры к нему применимы
+                if cube_supports(filters):
+                    daily_totals = load_daily_agg('orimex_orders.db', filters=filters)
+                else:
+                    daily_totals = aggregate_daily_cached(filtered_df, data_key=data_key)
+                rollup = create_sales_rollup(daily_totals, data_key=data_key)
                 fig_revenue, fig_orders, fig_avg_check, fig_combined, dynamics_data, stats = create_sales_dynamics_analysis(
-                    filtered_df, period_type, custom_start, custom_end
+                    rollup, data_key, period_type, custom_start, custom_end
                 )
                 
                 if fig_revenue is not None:
@@ -2083,7 +2079,7 @@ def main():
         st.subheader("👨‍💼 Детальный анализ менеджеров")
         
         if not filtered_df.empty:
-            fig_manager_perf, fig_manager_dyn, manager_data = create_manager_detailed_analysis(filtered_df)
+            fig_manager_perf, fig_manager_dyn, manager_data = create_manager_detailed_analysis(filtered_df, data_key=data_key)
             
             col1, col2 = st.columns(2)
             with col1:
@@ -2138,7 +2134,7 @@ def main():
         st.subheader("🏢 Глубокий анализ контрагентов")
         
         if not filtered_df.empty:
-            fig_contr_segments, fig_contr_dyn, contractor_data, buyer_data, all_contractors, contractor_dynamics = create_contractor_detailed_analysis(filtered_df)
+            fig_contr_segments, fig_contr_dyn, contractor_data, buyer_data, all_contractors, contractor_dynamics = create_contractor_detailed_analysis(filtered_df, data_key=data_key)
             
             col1, col2 = st.columns(2)
             with col1:
@@ -2246,7 +2242,7 @@ def main():
         st.subheader("📦 Детальный анализ товаров")
         
         if not filtered_df.empty:
-            fig_product_matrix, fig_product_dynamics, product_data, fig_category_dynamics, category_charts = create_product_detailed_analysis(filtered_df)
+            fig_product_matrix, fig_product_dynamics, product_data, fig_category_dynamics, category_charts = create_product_detailed_analysis(filtered_df, data_key=data_key)
             
             # Сначала показываем динамику по категориям
             st.plotly_chart(fig_category_dynamics, width='stretch')
@@ -2368,7 +2364,10 @@ def main():
             st.session_state["selected_product"] = selected_product
             
             if selected_product:
-                fig_product_deep, product_contractors, product_regions = create_product_deep_dive(filtered_df, selected_product)
+                product_index = drilldown_index(filtered_df, ['product_name'], data_key)
+                fig_product_deep, product_contractors, product_regions = create_product_deep_dive(
+                    product_index, selected_product, data_key=data_key
+                )
                 
                 if fig_product_deep is not None:
                     st.plotly_chart(fig_product_deep, width='stretch')
@@ -2412,7 +2411,15 @@ def main():
         st.subheader("🔗 Анализ связки контрагент-товар")
         
         if not filtered_df.empty:
-            fig_contr_spec, fig_diversity, fig_pairs_dyn, pairs_data, diversity_data = create_contractor_product_analysis(filtered_df)
+            top_pairs_count = st.select_slider(
+                "Пар контрагент-товар в динамике:",
+                options=[10, 25, 50, 100, 1000],
+                value=10,
+                key="top_pairs_count"
+            )
+            fig_contr_spec, fig_diversity, fig_pairs_dyn, pairs_data, diversity_data = create_contractor_product_analysis(
+                filtered_df, top_pairs_count, data_key=data_key
+            )
             
             col1, col2 = st.columns(2)
             with col1:
@@ -2426,6 +2433,9 @@ def main():
             # Детальный анализ конкретной пары
             st.subheader("🔍 Детальный анализ пары контрагент-товар")
             
+            # Строки контрагента и пары берутся по индексу, без маски по всей выборке
+            pair_index = drilldown_index(filtered_df, ['head_contractor', 'product_name'], data_key)
+            
             col_select1, col_select2 = st.columns(2)
             
             with col_select1:
@@ -2436,7 +2446,7 @@ def main():
                 contr_col1, contr_col2 = st.columns([1, 1])
                 with contr_col1:
                     if st.button("🏆 Топ-контрагент", key="select_top_contractor", help="Выбрать контрагента с максимальной выручкой"):
-                        top_contractor = filtered_df.groupby('head_contractor')['amount'].sum().idxmax()
+                        top_contractor = filtered_df.groupby('head_contractor', observed=True)['amount'].sum().idxmax()
                         st.session_state["selected_contractor_pair"] = top_contractor
 
                 with contr_col2:
@@ -2461,19 +2471,17 @@ def main():
             with col_select2:
                 # Селектор товара (фильтруем по выбранному контрагенту)
                 if selected_contractor_pair:
-                    contractor_products = filtered_df[
-                        filtered_df['head_contractor'] == selected_contractor_pair
-                    ]['product_name'].unique()
+                    contractor_rows = pair_index.select(selected_contractor_pair)
+                    contractor_products = contractor_rows['product_name'].unique()
 
                     # Кнопка для выбора топ-товара контрагента
                     prod_pair_col1, prod_pair_col2 = st.columns([1, 1])
                     with prod_pair_col1:
                         if st.button("🏆 Топ-товар", key="select_top_product_pair", help="Выбрать самый прибыльный товар контрагента"):
                             if len(contractor_products) > 0:
-                                top_product = filtered_df[
-                                    (filtered_df['head_contractor'] == selected_contractor_pair) &
-                                    (filtered_df['product_name'].isin(contractor_products))
-                                ].groupby('product_name')['amount'].sum().idxmax()
+                                top_product = contractor_rows[
+                                    contractor_rows['product_name'].isin(contractor_products)
+                                ].groupby('product_name', observed=True)['amount'].sum().idxmax()
                                 st.session_state["selected_product_pair"] = top_product
 
                     with prod_pair_col2:
@@ -2500,7 +2508,7 @@ def main():
             # Анализ выбранной пары
             if selected_contractor_pair and selected_product_pair:
                 fig_pair_deep, pair_stats = create_contractor_product_deep_dive(
-                    filtered_df, selected_contractor_pair, selected_product_pair
+                    pair_index, selected_contractor_pair, selected_product_pair, data_key=data_key
                 )
                 
                 if fig_pair_deep is not None:
@@ -2576,9 +2584,7 @@ def main():
             with col6:
                 st.write("**📊 Средняя диверсификация по категориям:**")
                 # Объединяем с данными о категориях
-                contractor_main_category = df.groupby('head_contractor')['category'].agg(
-                    lambda x: x.value_counts().index[0]
-                ).reset_index()
+                contractor_main_category = contractor_main_categories('orimex_orders.db')
                 contractor_main_category.columns = ['head_contractor', 'Основная категория']
                 
                 diversity_with_category = diversity_data.merge(contractor_main_category, on='head_contractor')
@@ -2607,27 +2613,27 @@ def main():
             )
             
             if period1_preset == "Текущий месяц":
-                p1_end = df['order_date'].max().date()
+                p1_end = data_end
                 p1_start = p1_end.replace(day=1)
             elif period1_preset == "Предыдущий месяц":
-                current_month = df['order_date'].max().date().replace(day=1)
+                current_month = data_end.replace(day=1)
                 p1_start = (current_month - timedelta(days=1)).replace(day=1)
                 p1_end = current_month - timedelta(days=1)
             elif period1_preset == "Последние 30 дней":
-                p1_end = df['order_date'].max().date()
+                p1_end = data_end
                 p1_start = p1_end - timedelta(days=30)
             elif period1_preset == "Последние 90 дней":
-                p1_end = df['order_date'].max().date()
+                p1_end = data_end
                 p1_start = p1_end - timedelta(days=90)
             else:
-                p1_start = df['order_date'].min().date()
-                p1_end = df['order_date'].max().date()
+                p1_start = data_start
+                p1_end = data_end
             
             period1_range = st.date_input(
                 "Выберите период 1:",
                 value=(p1_start, p1_end),
-                min_value=df['order_date'].min().date(),
-                max_value=df['order_date'].max().date(),
+                min_value=data_start,
+                max_value=data_end,
                 key="period1_dates"
             )
         
@@ -2640,29 +2646,29 @@ def main():
             )
             
             if period2_preset == "Текущий месяц":
-                p2_end = df['order_date'].max().date()
+                p2_end = data_end
                 p2_start = p2_end.replace(day=1)
             elif period2_preset == "Предыдущий месяц":
-                current_month = df['order_date'].max().date().replace(day=1)
+                current_month = data_end.replace(day=1)
                 p2_start = (current_month - timedelta(days=1)).replace(day=1)
                 p2_end = current_month - timedelta(days=1)
             elif period2_preset == "Последние 30 дней":
-                p2_end = df['order_date'].max().date()
+                p2_end = data_end
                 p2_start = p2_end - timedelta(days=30)
             elif period2_preset == "Последние 90 дней":
-                p2_end = df['order_date'].max().date()
+                p2_end = data_end
                 p2_start = p2_end - timedelta(days=90)
             else:
                 # По умолчанию предыдущий месяц для сравнения
-                current_month = df['order_date'].max().date().replace(day=1)
+                current_month = data_end.replace(day=1)
                 p2_start = (current_month - timedelta(days=1)).replace(day=1)
                 p2_end = current_month - timedelta(days=1)
             
             period2_range = st.date_input(
                 "Выберите период 2:",
                 value=(p2_start, p2_end),
-                min_value=df['order_date'].min().date(),
-                max_value=df['order_date'].max().date(),
+                min_value=data_start,
+                max_value=data_end,
                 key="period2_dates"
             )
         
@@ -2674,7 +2680,8 @@ def main():
             # Создаем сравнительный анализ
             (fig_main_comparison, fig_cat_comparison, fig_mgr_comparison,
              fig_contr_comparison, metrics_comparison, cat_comparison, product_comparison_charts) = create_period_comparison(
-                df, p1_start, p1_end, p2_start, p2_end
+                load_data({'start_date': min(p1_start, p2_start), 'end_date': max(p1_end, p2_end)}),
+                p1_start, p1_end, p2_start, p2_end
             )
             
             # Отображаем результаты
@@ -2748,6 +2755,54 @@ def main():
         else:
             st.info("📅 Выберите оба периода для проведения сравнения")
         
+        # Помесячное сравнение с базой (MoM / YoY)
+        st.markdown("---")
+        st.subheader("📆 Помесячное сравнение")
+        
+        col_monthly1, col_monthly2 = st.columns(2)
+        with col_monthly1:
+            monthly_base = st.radio(
+                "База сравнения:",
+                ["Тот же месяц год назад (YoY)", "Предыдущий месяц (MoM)"],
+                horizontal=True,
+                key="monthly_base"
+            )
+        with col_monthly2:
+            monthly_range = st.date_input(
+                "Месяцы для сравнения:",
+                value=(max(data_start, (data_end - timedelta(days=365)).replace(day=1)), data_end),
+                min_value=data_start,
+                max_value=data_end,
+                key="monthly_dates"
+            )
+        
+        if len(monthly_range) == 2:
+            base_months = 12 if monthly_base.endswith("(YoY)") else 1
+            first_base = (pd.Period(monthly_range[0], freq='M') - base_months).start_time.date()
+            fig_monthly, monthly_table = create_monthly_comparison(
+                load_data({'start_date': first_base, 'end_date': monthly_range[1]}),
+                monthly_range[0], monthly_range[1], base_months, history_start=data_start
+            )
+            
+            if fig_monthly is not None:
+                st.plotly_chart(fig_monthly, width='stretch')
+                st.dataframe(
+                    monthly_table.style.format({
+                        'Выручка': '{:,.0f}',
+                        'Выручка (база)': '{:,.0f}',
+                        'Выручка, %': '{:+.1f}',
+                        'Заказы': '{:,.0f}',
+                        'Заказы (база)': '{:,.0f}',
+                        'Заказы, %': '{:+.1f}',
+                        'Средний чек': '{:,.0f}',
+                        'Средний чек, %': '{:+.1f}'
+                    }, na_rep='—'),
+                    width='stretch',
+                    hide_index=True
+                )
+            else:
+                st.info("Нет заказов за выбранные месяцы")
+        
         st.markdown('</div>', unsafe_allow_html=True)
     
     with tab6:
@@ -2755,7 +2810,7 @@ def main():
         st.subheader("🔗 Матрица взаимодействий")
         
         if not filtered_df.empty:
-            fig_heatmap, interaction_data = create_manager_contractor_matrix(filtered_df)
+            fig_heatmap, interaction_data = create_manager_contractor_matrix(filtered_df, data_key=data_key)
             st.plotly_chart(fig_heatmap, width='stretch')
             
             # Топ взаимодействия
@@ -2802,7 +2857,7 @@ def main():
             )
 
             entity_type = 'manager' if analysis_type == "👨‍💼 Менеджеры" else 'contractor'
-            fig_quarterly, fig_seasonal = create_temporal_analysis(filtered_df, entity_type, grouping_period)
+            fig_quarterly, fig_seasonal = create_temporal_analysis(filtered_df, entity_type, grouping_period, data_key=data_key)
             
             col1, col2 = st.columns(2)
             with col1:
@@ -2905,7 +2960,7 @@ def main():
         st.subheader("🎯 Кросс-анализ")
         
         if not filtered_df.empty:
-            fig_specialization, competitive_customers_count, specialization_data = create_cross_analysis(filtered_df)
+            fig_specialization, competitive_customers_count, specialization_data = create_cross_analysis(filtered_df, data_key=data_key)
             st.plotly_chart(fig_specialization, width='stretch')
             
             col1, col2 = st.columns(2)
@@ -2942,7 +2997,7 @@ def main():
         
         if not filtered_df.empty:
             # Сводный отчет по менеджерам и контрагентам
-            summary_report = filtered_df.groupby(['manager', 'head_contractor']).agg({
+            summary_report = filtered_df.groupby(['manager', 'head_contractor'], observed=True).agg({
                 'amount': ['sum', 'mean', 'count'],
                 'buyer': 'nunique',
                 'product_name': 'nunique',
@@ -3018,11 +3073,11 @@ def main():
     
     if not filtered_df.empty:
         total_filtered_revenue = filtered_df['amount'].sum()
-        total_revenue = df['amount'].sum()
+        total_revenue = summary['revenue']
         filter_coverage = total_filtered_revenue / total_revenue * 100
         
         st.sidebar.metric("🎯 Покрытие фильтром", f"{filter_coverage:.1f}%")
-        st.sidebar.metric("📊 Записей отфильтровано", f"{len(filtered_df):,} из {len(df):,}")
+        st.sidebar.metric("📊 Записей отфильтровано", f"{len(filtered_df):,} из {summary['records']:,}")
         
         # Быстрая статистика по фильтрам
         st.sidebar.write("**🔍 Активные фильтры:**")
@@ -3045,6 +3100,13 @@ def main():
         <p>🎯 Менеджеров в анализе: {filtered_df['manager'].nunique()} | 🏢 Контрагентов: {filtered_df['head_contractor'].nunique()}</p>
     </div>
     """, unsafe_allow_html=True)
+    
+    # Счетчики кеша с учетом анализов этого прогона
+    cache_stats = analysis_cache_stats()
+    cache_caption.caption(
+        f"⚡ Кеш анализов: {cache_stats['hits']:,} попаданий, {cache_stats['misses']:,} промахов "
+        f"({cache_stats['hit_rate']:.0%}), {cache_stats['bytes'] / 1024 ** 2:.1f} МБ"
+    )
 
 if __name__ == "__main__":
     main()
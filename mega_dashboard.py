@@ -6,14 +6,12 @@
 
 import streamlit as st
 import pandas as pd
-import sqlite3
+from data_access import load_orders
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import plotly.figure_factory as ff
 from datetime import datetime, timedelta
 import numpy as np
-from scipy import stats
 import json
 import base64
 from io import BytesIO
@@ -189,32 +187,11 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-@st.cache_data(ttl=300)
 def load_data():
     """Загрузка данных"""
     try:
-        conn = sqlite3.connect('orimex_orders.db')
-        
-        query = '''
-        SELECT 
-            o.id, o.order_date, o.quantity, o.amount,
-            c.head_contractor, c.buyer, c.manager, c.region,
-            p.name as product_name, p.characteristics, p.category
-        FROM orders o
-        JOIN contractors c ON o.contractor_id = c.id
-        JOIN products p ON o.product_id = p.id
-        WHERE o.amount IS NOT NULL AND o.amount > 0
-        '''
-        
-        df = pd.read_sql_query(query, conn)
-        df['order_date'] = pd.to_datetime(df['order_date'])
-        
         # Расширенные поля
-        df['month'] = df['order_date'].dt.to_period('M')
-        df['week'] = df['order_date'].dt.to_period('W')
-        df['day_of_week'] = df['order_date'].dt.day_name()
-        df['hour'] = df['order_date'].dt.hour
-        df['is_weekend'] = df['order_date'].dt.dayofweek.isin([5, 6])
+        df = load_orders()
         df['price_per_unit'] = df['amount'] / df['quantity']
         
         # Сегментация заказов
@@ -224,7 +201,6 @@ def load_data():
             labels=['🥉 Бронза', '🥈 Серебро', '🥇 Золото', '💎 Платина', '👑 Элит']
         )
         
-        conn.close()
         return df
         
     except Exception as e:
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Колоночный снимок заказов (Feather / Arrow IPC) рядом с orimex_orders.db
+
+Снимок содержит ту же денормализованную таблицу, что читают дашборды
+(заказы с суммой > 0 вместе с контрагентом и номенклатурой). Текстовые колонки
+хранятся как словари (categorical), файл пишется без сжатия и читается через mmap,
+поэтому холодный старт дашборда не выполняет JOIN по всей базе.
+
+Снимок пишется после каждой успешной загрузки (csv_to_db, batch_ingest)
+и используется, только если он новее файла базы данных.
+"""
+
+import logging
+import os
+
+import pandas as pd
+
+from db_connections import read_connection
+
+logger = logging.getLogger(__name__)
+
+# Денормализованные заказы для дашбордов
+ORDERS_QUERY = '''
+SELECT
+    o.id,
+    o.order_date,
+    o.quantity,
+    o.amount,
+    c.head_contractor,
+    c.buyer,
+    c.manager,
+    c.region,
+    p.name as product_name,
+    p.characteristics,
+    p.category
+FROM orders o
+JOIN contractors c ON o.contractor_id = c.id
+JOIN products p ON o.product_id = p.id
+WHERE o.amount IS NOT NULL AND o.amount > 0
+'''
+
+TEXT_COLUMNS = ['head_contractor', 'buyer', 'manager', 'region', 'product_name', 'characteristics', 'category']
+
+def snapshot_path(db_path='orimex_orders.db'):
+    """Путь к снимку: orimex_orders.db -> orimex_orders.feather"""
+    return os.path.splitext(db_path)[0] + '.feather'
+
+def db_modified_at(db_path):
+    """Время последнего изменения БД с учетом WAL-журнала"""
+    times = [os.path.getmtime(path) for path in (db_path, db_path + '-wal') if os.path.exists(path)]
+    return max(times) if times else None
+
+def write_snapshot(db_path='orimex_orders.db'):
+    """
+    Запись снимка заказов из БД
+
+    Файл записывается во временный и затем атомарно заменяет старый снимок.
+    Возвращает путь к снимку или None, если pyarrow не установлен.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.feather as feather
+    except ImportError:
+        logger.warning("pyarrow не установлен, снимок заказов не создается")
+        return None
+
+    with read_connection(db_path) as conn:
+        df = pd.read_sql_query(ORDERS_QUERY, conn)
+
+    df['order_date'] = pd.to_datetime(df['order_date'])
+    for column in TEXT_COLUMNS:
+        df[column] = df[column].astype('category')
+
+    path = snapshot_path(db_path)
+    temp_path = path + '.tmp'
+    feather.write_feather(pa.Table.from_pandas(df, preserve_index=False), temp_path, compression='uncompressed')
+    os.replace(temp_path, path)
+
+    logger.info(f"Снимок заказов записан: {path} ({len(df):,} строк)")
+    return path
+
+def read_snapshot(db_path='orimex_orders.db', categorical=False):
+    """
+    Чтение снимка заказов, если он новее БД
+
+    Возвращает DataFrame с колонками ORDERS_QUERY (order_date уже datetime)
+    или None, если снимка нет, он устарел или не читается.
+    categorical=False - текстовые колонки декодируются в обычные строки.
+    """
+    path = snapshot_path(db_path)
+    modified_at = db_modified_at(db_path)
+    if not os.path.exists(path) or modified_at is None or os.path.getmtime(path) < modified_at:
+        return None
+
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.feather as feather
+
+        table = feather.read_table(path, memory_map=True)
+        if not categorical:
+            for i, field in enumerate(table.schema):
+                if pa.types.is_dictionary(field.type):
+                    table = table.set_column(i, field.name, pc.cast(table.column(i), field.type.value_type))
+        return table.to_pandas()
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать снимок заказов {path}: {e}")
+        return None
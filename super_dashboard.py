@@ -6,18 +6,14 @@
 
 import streamlit as st
 import pandas as pd
-import sqlite3
+from data_access import load_daily_agg, load_orders
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import plotly.figure_factory as ff
 from datetime import datetime, timedelta
 import numpy as np
-from scipy import stats
-from sklearn.ensemble import RandomForestRegressor, IsolationForest
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
+# Модели sklearn импортируются внутри функций вкладок: импорт sklearn занимает
+# больше секунды и не должен задерживать первую отрисовку дашборда
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -101,56 +97,41 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-@st.cache_data(ttl=300)
 def load_data():
     """Загрузка данных из базы данных"""
     try:
-        conn = sqlite3.connect('orimex_orders.db')
-        
-        query = '''
-        SELECT 
-            o.id,
-            o.order_date,
-            o.quantity,
-            o.amount,
-            c.head_contractor,
-            c.buyer,
-            c.manager,
-            c.region,
-            p.name as product_name,
-            p.characteristics,
-            p.category
-        FROM orders o
-        JOIN contractors c ON o.contractor_id = c.id
-        JOIN products p ON o.product_id = p.id
-        WHERE o.amount IS NOT NULL AND o.amount > 0
-        '''
-        
-        df = pd.read_sql_query(query, conn)
-        df['order_date'] = pd.to_datetime(df['order_date'])
-        df['month'] = df['order_date'].dt.to_period('M')
-        df['week'] = df['order_date'].dt.to_period('W')
-        df['day_of_week'] = df['order_date'].dt.day_name()
-        df['quarter'] = df['order_date'].dt.to_period('Q')
-        df['hour'] = df['order_date'].dt.hour
-        
-        conn.close()
-        return df
+        return load_orders()
         
     except Exception as e:
         st.error(f"Ошибка загрузки данных: {e}")
         return pd.DataFrame()
 
-def create_ai_anomaly_detection(df):
-    """AI-детекция аномалий в заказах"""
-    
-    # Подготавливаем данные для модели
-    features_df = df.groupby('order_date').agg({
-        'amount': ['sum', 'mean', 'std', 'count'],
-        'quantity': ['sum', 'mean']
+def load_daily_data():
+    """Дневные итоги заказов из куба daily_agg для временных рядов"""
+    try:
+        return load_daily_agg()
+        
+    except Exception as e:
+        st.error(f"Ошибка загрузки дневных итогов: {e}")
+        return pd.DataFrame()
+
+def create_ai_anomaly_detection(daily):
+    """AI-детекция аномалий в заказах по дневным итогам (orders, quantity, amount, amount_sq)"""
+    from sklearn.ensemble import IsolationForest
+    
+    # Подготавливаем данные для модели: среднее и стандартное отклонение
+    # суммы заказа восстанавливаются из дневных сумм и суммы квадратов
+    orders = daily['orders']
+    variance = (daily['amount_sq'] - daily['amount'] ** 2 / orders) / (orders - 1)
+    features_df = pd.DataFrame({
+        'amount_sum': daily['amount'],
+        'amount_mean': daily['amount'] / orders,
+        'amount_std': np.sqrt(variance.clip(lower=0)).where(orders > 1),
+        'order_count': orders,
+        'quantity_sum': daily['quantity'],
+        'quantity_mean': daily['quantity'] / orders,
     }).fillna(0)
-    
-    features_df.columns = ['amount_sum', 'amount_mean', 'amount_std', 'order_count', 'quantity_sum', 'quantity_mean']
+    features_df.index = daily['order_date']
     
     # Isolation Forest для детекции аномалий
     isolation_forest = IsolationForest(contamination=0.1, random_state=42)
@@ -193,6 +174,8 @@ def create_ai_anomaly_detection(df):
 
 def create_customer_segmentation(df):
     """AI-сегментация клиентов"""
+    from sklearn.cluster import KMeans
+    from sklearn.preprocessing import StandardScaler
     
     # RFM анализ (Recency, Frequency, Monetary)
     current_date = df['order_date'].max()
@@ -255,15 +238,12 @@ def create_customer_segmentation(df):
     
     return fig, rfm
 
-def create_ml_sales_prediction(df):
-    """Машинное обучение для предсказания продаж"""
+def create_ml_sales_prediction(daily):
+    """Машинное обучение для предсказания продаж по дневным итогам"""
+    from sklearn.ensemble import RandomForestRegressor
     
     # Подготовка признаков
-    daily_data = df.groupby('order_date').agg({
-        'amount': 'sum',
-        'quantity': 'sum',
-        'id': 'count'
-    }).reset_index()
+    daily_data = daily[['order_date', 'amount', 'quantity']].assign(id=daily['orders'])
     
     # Добавляем временные признаки
     daily_data['day_of_year'] = daily_data['order_date'].dt.dayofyear
@@ -394,11 +374,11 @@ def create_network_analysis(df):
     
     return fig
 
-def create_sentiment_analysis(df):
-    """Анализ 'настроения' продаж"""
+def create_sentiment_analysis(daily):
+    """Анализ 'настроения' продаж по дневным итогам"""
     
     # Создаем индекс настроения на основе отклонений от среднего
-    daily_sales = df.groupby('order_date')['amount'].sum().reset_index()
+    daily_sales = daily[['order_date', 'amount']].copy()
     daily_sales['ma_7'] = daily_sales['amount'].rolling(window=7).mean()
     daily_sales['ma_30'] = daily_sales['amount'].rolling(window=30).mean()
     
@@ -516,6 +496,7 @@ def create_profitability_analysis(df):
 
 def create_advanced_forecasting(df):
     """Продвинутое прогнозирование с сезонностью"""
+    from sklearn.ensemble import RandomForestRegressor
     
     # Подготовка данных
     daily_sales = df.groupby('order_date')['amount'].sum().reset_index()
@@ -619,6 +600,7 @@ def main():
     # Загрузка данных
     with st.spinner('🤖 Загрузка данных и инициализация AI моделей...'):
         df = load_data()
+        daily = load_daily_data()
     
     if df.empty:
         st.error("❌ Не удалось загрузить данные. Убедитесь, что база данных создана.")
@@ -678,7 +660,7 @@ def main():
     
     with tab1:
         st.subheader("🤖 AI-детекция аномалий")
-        fig_anomaly, anomaly_count = create_ai_anomaly_detection(df)
+        fig_anomaly, anomaly_count = create_ai_anomaly_detection(daily)
         st.plotly_chart(fig_anomaly, width='stretch')
         
         if anomaly_count > 0:
@@ -708,7 +690,7 @@ def main():
     
     with tab3:
         st.subheader("🔮 Машинное обучение: прогнозирование")
-        fig_ml, fig_importance, accuracy = create_ml_sales_prediction(df)
+        fig_ml, fig_importance, accuracy = create_ml_sales_prediction(daily)
         
         col1, col2 = st.columns(2)
         with col1:
@@ -732,7 +714,7 @@ def main():
     
     with tab5:
         st.subheader("😊 Анализ настроения продаж")
-        fig_sentiment, sentiment_stats = create_sentiment_analysis(df)
+        fig_sentiment, sentiment_stats = create_sentiment_analysis(daily)
         st.plotly_chart(fig_sentiment, width='stretch')
         
         col1, col2 = st.columns(2)
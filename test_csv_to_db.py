@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Проверки загрузки выгрузок TDSheet: результат не зависит от способа и размера пачки
+
+Запуск:
+    python -m pytest -q test_csv_to_db.py
+"""
+
+import csv
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark_ingest import generate_tdsheet
+from csv_to_db import (clean_numeric_value, create_tables, file_md5, get_file_layout, normalize_frame,
+                       parse_csv_to_database, parse_numeric_array, refresh_daily_agg, repair_database)
+
+ORDERS_QUERY = '''
+SELECT c.head_contractor, c.buyer, c.manager, c.region,
+       p.name, p.characteristics, p.category,
+       o.order_date, o.quantity, o.amount
+FROM orders o
+JOIN contractors c ON o.contractor_id = c.id
+JOIN products p ON o.product_id = p.id
+'''
+
+KEY = ['head_contractor', 'buyer', 'manager', 'region', 'name', 'characteristics', 'category', 'order_date']
+
+@pytest.fixture(scope='module')
+def tdsheet(tmp_path_factory):
+    """Синтетическая выгрузка с повторами ключа заказа в разных частях файла"""
+    csv_file_path = tmp_path_factory.mktemp('tdsheet') / 'tdsheet.csv'
+    generate_tdsheet(csv_file_path, rows=3000, days=20)
+
+    # Строки заказов из начала файла повторяются в конце (перед общим итогом),
+    # чтобы повторы ключа попали в разные пачки потокового чтения
+    with open(csv_file_path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    repeated = [line for line in lines[2:300] if ',,,Покупатель' in line]
+    with open(csv_file_path, 'w', encoding='utf-8') as f:
+        f.writelines(lines[:-1] + repeated + lines[-1:])
+    return str(csv_file_path)
+
+def load_orders(db_path):
+    """Заказы БД с измерениями вместо ключей, в порядке естественного ключа"""
+    with sqlite3.connect(db_path) as conn:
+        orders = pd.read_sql_query(ORDERS_QUERY, conn)
+    return orders.sort_values(KEY).reset_index(drop=True)
+
+def load(csv_file_path, db_path, **options):
+    assert parse_csv_to_database(csv_file_path, str(db_path), **options)
+    return load_orders(db_path)
+
+def assert_same_orders(actual, expected):
+    # Суммы повторов складываются в разном порядке, поэтому сравнение с допуском
+    pd.testing.assert_frame_equal(actual, expected, check_exact=False, rtol=1e-12)
+
+NUMERIC_VALUES = [
+    '1 234,56', '"2\u00a0500,5"', '12,345', '1,234,567', '-17', '0', '3.14', ' 42 ', '1e3', 'inf',
+    '7\u2009000', ',5', 'abc', '1,2,3', '', '   ', None, float('nan'), 12.5, 'nan',
+]
+
+def test_parse_numeric_array_matches_clean_numeric_value():
+    numbers, failed = parse_numeric_array(NUMERIC_VALUES)
+    for value, number, is_failed in zip(NUMERIC_VALUES, numbers, failed):
+        expected = clean_numeric_value(value)
+        if expected is None:
+            assert np.isnan(number), value
+        else:
+            assert number == expected, value
+        # Нераспознанные - непустые значения, которые clean_numeric_value тоже не разобрал
+        assert is_failed == (expected is None and not pd.isna(value) and str(value).strip() not in ('', 'nan')), value
+
+def test_tdsheet_has_repeated_keys(tdsheet):
+    layout = get_file_layout(tdsheet)
+    df = pd.read_csv(tdsheet, header=None, skiprows=layout['header_rows'], dtype=str)
+    stats = normalize_frame(df, layout)['stats']
+    assert stats['unique_orders'] < stats['orders']
+
+@pytest.mark.parametrize('chunksize', [500, 777])
+def test_chunked_load_matches_whole_file(tdsheet, tmp_path, chunksize):
+    whole = load(tdsheet, tmp_path / 'whole.db')
+    chunked = load(tdsheet, tmp_path / 'chunked.db', chunksize=chunksize)
+    assert_same_orders(chunked, whole)
+
+def test_repeated_keys_are_summed(tdsheet, tmp_path):
+    orders = load(tdsheet, tmp_path / 'chunked.db', chunksize=500)
+
+    # Ожидаемые итоги: все ячейки файла, сгруппированные по ключу заказа
+    layout = get_file_layout(tdsheet)
+    df = pd.read_csv(tdsheet, header=None, skiprows=layout['header_rows'], dtype=str)
+    batch = normalize_frame(df, layout)
+    cells = pd.concat([
+        pd.DataFrame(batch['contractors'], columns=KEY[:4]).iloc[batch['contractor_index']].reset_index(drop=True),
+        pd.DataFrame(batch['products'], columns=KEY[4:7]).iloc[batch['product_index']].reset_index(drop=True),
+    ], axis=1)
+    cells['order_date'] = batch['order_date']
+    cells['quantity'] = batch['quantity']
+    expected = cells.fillna('').groupby(KEY, as_index=False)['quantity'].sum()
+
+    actual = orders.fillna({column: '' for column in KEY})[KEY + ['quantity']]
+    merged = actual.merge(expected, on=KEY, how='outer', suffixes=('', '_expected'), indicator=True)
+    assert (merged['_merge'] == 'both').all()
+    assert (merged['quantity'] == merged['quantity_expected']).all()
+
+def test_natural_key_migration_sums_same_file_duplicates(tmp_path):
+    db_path = tmp_path / 'legacy.db'
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        # Таблица заказов до появления естественного ключа
+        cursor.execute('''
+        CREATE TABLE orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            contractor_id INTEGER, product_id INTEGER, order_date DATE,
+            quantity REAL, amount REAL, file_hash TEXT
+        )
+        ''')
+        cursor.executemany(
+            'INSERT INTO orders (contractor_id, product_id, order_date, quantity, amount, file_hash) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            [
+                (1, 1, '2025-01-01', 5, 50.0, 'old'),
+                (1, 1, '2025-01-01', 2, 20.0, 'new'),
+                (1, 1, '2025-01-01', 3, None, 'new'),
+                (1, 2, '2025-01-01', 1, 10.0, 'old'),
+            ]
+        )
+        create_tables(cursor)
+        rows = cursor.execute(
+            'SELECT product_id, quantity, amount, file_hash, source FROM orders ORDER BY product_id'
+        ).fetchall()
+        indexes = {row[1] for row in cursor.execute('PRAGMA index_list(orders)')}
+    # Последний файл заменяет прежний, повторы внутри файла суммируются;
+    # у заказов прежних загрузок источник - общая выгрузка
+    assert rows == [(1, 5.0, 20.0, 'new', 'main'), (2, 1.0, 10.0, 'old', 'main')]
+    assert 'idx_orders_source_key' in indexes
+
+def test_natural_key_migration_adds_source_to_unique_key(tmp_path):
+    db_path = tmp_path / 'keyed.db'
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        # Заказы с уникальным ключом без источника
+        cursor.execute('''
+        CREATE TABLE orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            contractor_id INTEGER, product_id INTEGER, order_date DATE,
+            quantity REAL, amount REAL, file_hash TEXT
+        )
+        ''')
+        cursor.execute('CREATE UNIQUE INDEX idx_orders_natural_key ON orders (contractor_id, product_id, order_date)')
+        cursor.execute("INSERT INTO orders (contractor_id, product_id, order_date, quantity) VALUES (1, 1, '2025-01-01', 5)")
+        create_tables(cursor)
+        create_tables(cursor)
+        indexes = {row[1] for row in cursor.execute('PRAGMA index_list(orders)')}
+        # Тот же ключ другого источника - отдельный заказ
+        cursor.execute(
+            "INSERT INTO orders (contractor_id, product_id, order_date, quantity, source) VALUES (1, 1, '2025-01-01', 7, 'branch')"
+        )
+        rows = cursor.execute('SELECT source, quantity FROM orders ORDER BY source').fetchall()
+    assert 'idx_orders_natural_key' not in indexes and 'idx_orders_source_key' in indexes
+    assert rows == [('branch', 7.0), ('main', 5.0)]
+
+def test_shifted_products_are_repaired_only_on_request(tmp_path):
+    db_path = str(tmp_path / 'shifted.db')
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        create_tables(cursor)
+        cursor.executemany('INSERT INTO products (id, name, characteristics, category) VALUES (?, ?, ?, ?)', [
+            (1, 'Товар', 'Категория', 'Категория'),
+            (2, 'Товар', '', 'Категория'),
+            (3, 'Другой', 'Синий', 'Категория'),
+        ])
+        cursor.execute("INSERT INTO contractors (id, head_contractor, buyer) VALUES (1, 'К', 'П')")
+        cursor.executemany(
+            'INSERT INTO orders (contractor_id, product_id, order_date, quantity, amount) VALUES (1, ?, ?, ?, ?)',
+            [(1, '2025-01-01', 1, 10.0), (2, '2025-01-01', 2, 20.0), (1, '2025-01-02', 3, 30.0)]
+        )
+        # Повторное создание таблиц ничего не исправляет
+        cursor.execute('DROP TABLE file_layouts')
+        create_tables(cursor)
+        assert cursor.execute('SELECT COUNT(*) FROM products').fetchone()[0] == 3
+
+    assert repair_database(db_path, dry_run=True) == (1, 2)
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM products').fetchone()[0] == 3
+
+    assert repair_database(db_path) == (1, 2)
+    with sqlite3.connect(db_path) as conn:
+        orders = conn.execute('SELECT product_id, order_date, quantity FROM orders ORDER BY order_date').fetchall()
+        products = conn.execute('SELECT id FROM products ORDER BY id').fetchall()
+    # При совпадении ключа заказа остается более новая запись
+    assert orders == [(2, '2025-01-01', 2.0), (2, '2025-01-02', 3.0)]
+    assert products == [(2,), (3,)]
+
+def failing_register(cursor, file_hash, file_name=None):
+    raise RuntimeError("сбой перед регистрацией файла")
+
+def test_interrupted_chunked_load_is_retried_from_scratch(tdsheet, tmp_path, monkeypatch):
+    whole = load(tdsheet, tmp_path / 'whole.db')
+
+    # Сбой после зафиксированных пачек: файл не регистрируется, в orders не попадает ничего
+    db_path = tmp_path / 'retried.db'
+    with monkeypatch.context() as patch:
+        patch.setattr('csv_to_db.register_ingested_file', failing_register)
+        assert not parse_csv_to_database(tdsheet, str(db_path), chunksize=500)
+    assert len(load_orders(db_path)) == 0
+
+    assert_same_orders(load(tdsheet, db_path, chunksize=500), whole)
+
+@pytest.mark.parametrize('options', [
+    {'engine': 'rows'},
+    {'bulk_load': True},
+    {'bulk_load': True, 'rebuild_indexes': True},
+    {'bulk_load': True, 'rebuild_indexes': True, 'chunksize': 500},
+])
+def test_engines_and_bulk_load_match_default_load(tdsheet, tmp_path, options):
+    whole = load(tdsheet, tmp_path / 'whole.db')
+    assert_same_orders(load(tdsheet, tmp_path / 'other.db', **options), whole)
+
+def test_second_load_reuses_dimension_keys(tdsheet, tmp_path):
+    db_path = tmp_path / 'orders.db'
+    load(tdsheet, db_path)
+    with sqlite3.connect(db_path) as conn:
+        before = conn.execute('SELECT COUNT(*) FROM contractors').fetchone()[0], \
+            conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+
+    # Та же выгрузка с другим хешем: новых контрагентов и продуктов не появляется
+    copy_path = tmp_path / 'copy.csv'
+    with open(tdsheet, 'r', encoding='utf-8') as source, open(copy_path, 'w', encoding='utf-8') as target:
+        target.write(source.read() + '\n')
+    orders = load(str(copy_path), db_path, chunksize=500)
+    with sqlite3.connect(db_path) as conn:
+        after = conn.execute('SELECT COUNT(*) FROM contractors').fetchone()[0], \
+            conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+    assert after == before
+    # Записи прежнего файла заменяются, а не суммируются с новым файлом
+    assert_same_orders(orders, load(tdsheet, tmp_path / 'whole.db'))
+
+def write_export(csv_file_path, dates, rows):
+    """Небольшая выгрузка TDSheet: rows - (покупатель, товар, {дата: (количество, сумма)})"""
+    header = ['Головной контрагент', '', '', 'Покупатель', 'Менеджер', '', 'Регион',
+              'Номенклатура', 'Характеристика', 'Категория']
+    for date_str in dates:
+        header += [date_str, '']
+    with open(csv_file_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerow([''] * 10 + ['Количество заказов', 'Сумма заказов'] * len(dates))
+        for buyer, product, cells in rows:
+            row = ['Контрагент', '', '', buyer, 'Менеджер', '', 'Регион', product, '', 'Категория']
+            for date_str in dates:
+                row += [str(value) for value in cells[date_str]] if date_str in cells else ['', '']
+            writer.writerow(row)
+    return str(csv_file_path)
+
+def load_cells(db_path):
+    """Заказы в виде (источник, покупатель, товар, дата, количество, сумма, хеш файла)"""
+    with sqlite3.connect(db_path) as conn:
+        return sorted(conn.execute('''
+        SELECT o.source, c.buyer, p.name, o.order_date, o.quantity, o.amount, o.file_hash
+        FROM orders o
+        JOIN contractors c ON o.contractor_id = c.id
+        JOIN products p ON o.product_id = p.id
+        ''').fetchall())
+
+def assert_daily_agg_is_fresh(db_path):
+    with sqlite3.connect(db_path) as conn:
+        cube = conn.execute('SELECT * FROM daily_agg ORDER BY 1, 2, 3, 4').fetchall()
+        refresh_daily_agg(conn.cursor())
+        assert conn.execute('SELECT * FROM daily_agg ORDER BY 1, 2, 3, 4').fetchall() == cube
+
+def test_reexport_writes_only_changed_cells(tmp_path):
+    db_path = tmp_path / 'orders.db'
+    first = write_export(tmp_path / 'first.csv', ['01.01.2025', '02.01.2025'], [
+        ('П1', 'Товар 1', {'01.01.2025': (1, 10), '02.01.2025': (2, 20)}),
+        ('П2', 'Товар 2', {'01.01.2025': (5, 50), '02.01.2025': (6, 60)}),
+    ])
+    assert parse_csv_to_database(first, str(db_path))
+
+    # Новая выгрузка за 2 и 3 января: сумма изменена, ячейка очищена, добавлены день и товар
+    second = write_export(tmp_path / 'second.csv', ['02.01.2025', '03.01.2025'], [
+        ('П1', 'Товар 1', {'02.01.2025': (2, 25), '03.01.2025': (3, 30)}),
+        ('П2', 'Товар 2', {}),
+        ('П3', 'Товар 3', {'02.01.2025': (7, 70)}),
+    ])
+    assert parse_csv_to_database(second, str(db_path), chunksize=1)
+    old, new = file_md5(first), file_md5(second)
+    expected = [
+        # Неизмененные заказы и заказы вне дат новой выгрузки не переписываются
+        ('main', 'П1', 'Товар 1', '2025-01-01', 1.0, 10.0, old),
+        ('main', 'П1', 'Товар 1', '2025-01-02', 2.0, 25.0, new),
+        ('main', 'П1', 'Товар 1', '2025-01-03', 3.0, 30.0, new),
+        ('main', 'П2', 'Товар 2', '2025-01-01', 5.0, 50.0, old),
+        ('main', 'П3', 'Товар 3', '2025-01-02', 7.0, 70.0, new),
+    ]
+    assert load_cells(db_path) == expected
+    assert_daily_agg_is_fresh(db_path)
+
+    # Та же выгрузка с другим хешем ничего не меняет
+    with open(second, 'a', encoding='utf-8') as f:
+        f.write('\n')
+    assert parse_csv_to_database(second, str(db_path))
+    assert load_cells(db_path) == expected
+
+def test_exports_of_different_sources_keep_shared_keys(tmp_path):
+    db_path = tmp_path / 'orders.db'
+    dates = ['01.01.2025']
+    north = write_export(tmp_path / 'north.csv', dates, [('П1', 'Товар 1', {'01.01.2025': (1, 10)})])
+    south = write_export(tmp_path / 'south.csv', dates, [('П1', 'Товар 1', {'01.01.2025': (2, 20)})])
+    assert parse_csv_to_database(north, str(db_path), source='north')
+    assert parse_csv_to_database(south, str(db_path), source='south')
+
+    # Выгрузка севера без этого заказа удаляет только заказ севера
+    empty = write_export(tmp_path / 'north_empty.csv', dates, [('П1', 'Товар 1', {})])
+    assert parse_csv_to_database(empty, str(db_path), source='north')
+    assert load_cells(db_path) == [('south', 'П1', 'Товар 1', '2025-01-01', 2.0, 20.0, file_md5(south))]
+
+@pytest.mark.parametrize('engine', ['vectorized', 'rows'])
+def test_engines_match_in_streaming_mode(tdsheet, tmp_path, engine):
+    whole = load(tdsheet, tmp_path / 'whole.db')
+    assert_same_orders(load(tdsheet, tmp_path / f'{engine}.db', engine=engine, chunksize=500), whole)
+
+def test_rows_engine_matches_vectorized_on_numeric_formats(tmp_path):
+    # Построчный путь разбирает каждую ячейку clean_numeric_value, векторный - parse_numeric_array
+    cells = [('1\u00a0234', '12\u00a0345,67'), ('12,345', '1,234,567'), ('3.5', ''), ('abc', '10'), ('0', '5'),
+             ('-2', '5'), ('7\u2009000', ',5'), ('1e3', 'inf'), (' 42 ', 'nan'), ('"2 500,5"', '1,2,3')]
+    dates = [f'{day:02d}.01.2025' for day in range(1, len(cells) + 1)]
+    csv_file_path = write_export(tmp_path / 'formats.csv', dates, [
+        ('П1', 'Товар 1', dict(zip(dates, cells))),
+        ('П2', 'Товар 2', dict(zip(dates, reversed(cells)))),
+        ('П1', 'Товар 1', dict(zip(dates, cells))),
+    ])
+    vectorized = load(csv_file_path, tmp_path / 'vectorized.db')
+    assert len(vectorized) > 0
+    assert_same_orders(load(csv_file_path, tmp_path / 'rows.db', engine='rows'), vectorized)
+
+def test_batch_ingest_matches_whole_file(tdsheet, tmp_path):
+    from batch_ingest import ingest_files
+
+    whole = load(tdsheet, tmp_path / 'whole.db')
+    db_path = tmp_path / 'batch.db'
+    summary = ingest_files(tdsheet, str(db_path), max_workers=1, chunksize=500)
+    assert not any(stats.get('error') for stats in summary)
+    assert_same_orders(load_orders(db_path), whole)
+
+def test_batch_ingest_keeps_branch_orders_apart(tmp_path):
+    from batch_ingest import ingest_files
+
+    folder = tmp_path / 'branches'
+    folder.mkdir()
+    for branch, quantity in (('north', 1), ('south', 2)):
+        write_export(folder / f'{branch}.csv', ['01.01.2025'], [('П1', 'Товар 1', {'01.01.2025': (quantity, 10)})])
+    db_path = tmp_path / 'batch.db'
+    summary = ingest_files(str(folder), str(db_path), max_workers=2, chunksize=1)
+    assert [stats['orders_written'] for stats in summary] == [1, 1]
+    assert [cell[:5] for cell in load_cells(db_path)] == [
+        ('north', 'П1', 'Товар 1', '2025-01-01', 1.0), ('south', 'П1', 'Товар 1', '2025-01-01', 2.0),
+    ]
+
+def test_batch_ingest_drops_file_after_failed_batch(tdsheet, tmp_path, monkeypatch):
+    import batch_ingest
+    from csv_to_db import stage_order_batch
+
+    folder = tmp_path / 'branches'
+    folder.mkdir()
+    with open(tdsheet, 'r', encoding='utf-8') as source, open(folder / 'a.csv', 'w', encoding='utf-8') as target:
+        target.write(source.read())
+    write_export(folder / 'b.csv', ['01.01.2025'], [('П1', 'Товар 1', {'01.01.2025': (1, 10)})])
+
+    # Вторая пачка первого файла не записывается; вызовы пишутся в файл,
+    # так как писатель - дочерний процесс
+    calls_path = tmp_path / 'calls.txt'
+    def failing_stage(cursor, batch, file_hash, dimensions, timings=None):
+        with open(calls_path, 'a') as f:
+            f.write(file_hash + '\n')
+        if len(calls_path.read_text().split()) == 2:
+            raise RuntimeError("сбой записи пачки")
+        stage_order_batch(cursor, batch, file_hash, dimensions, timings)
+    monkeypatch.setattr(batch_ingest, 'stage_order_batch', failing_stage)
+
+    db_path = tmp_path / 'batch.db'
+    summary = batch_ingest.ingest_files(str(folder), str(db_path), max_workers=1, chunksize=500)
+    assert [bool(stats.get('error')) for stats in summary] == [True, False]
+    # Остальные пачки файла после ошибки пропускаются
+    assert calls_path.read_text().split().count(file_md5(str(folder / 'a.csv'))) == 2
+    # Пачки файла до и после ошибки в orders не попадают, другой файл загружен
+    assert [cell[:5] for cell in load_cells(db_path)] == [('b', 'П1', 'Товар 1', '2025-01-01', 1.0)]
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT file_name FROM ingested_files').fetchall() == [('b.csv',)]
+
+class BrokenWriterCache:
+    def __init__(self):
+        raise RuntimeError("сбой процесса записи")
+
+def test_batch_ingest_reports_dead_writer(tdsheet, tmp_path, monkeypatch):
+    import batch_ingest
+
+    # Писатель падает сразу, а пачек больше, чем мест в очереди
+    monkeypatch.setattr(batch_ingest, 'DimensionCache', BrokenWriterCache)
+    summary = batch_ingest.ingest_files(tdsheet, str(tmp_path / 'batch.db'), max_workers=1, chunksize=100)
+    assert len(summary) == 1
+    assert 'процесс записи' in summary[0]['error']
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Проверки общего слоя данных: индексы и свертки совпадают с прямым расчетом pandas
+
+Запуск:
+    python -m pytest -q test_data_access.py
+"""
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark_ingest import generate_tdsheet
+from csv_to_db import parse_csv_to_database
+from data_access import (ROLLUP_PERIODS, DailyRollup, DrillDownIndex, FilterIndex, InteractionMatrix,
+                         PeriodComparison, TEXT_COLUMNS, aggregate_daily, build_order_filter,
+                         invalidate_orders_cache, monthly_comparison, query_orders, read_orders)
+
+# Частота pandas для каждого периода свертки (неделя - с понедельника)
+PERIOD_FREQUENCIES = {'День': 'D', 'Неделя': 'W-SUN', 'Месяц': 'M', 'Квартал': 'Q', 'Год': 'Y'}
+
+@pytest.fixture(scope='module')
+def db_path(tmp_path_factory):
+    """БД, загруженная из синтетической выгрузки на стыке двух лет"""
+    folder = tmp_path_factory.mktemp('orders')
+    csv_file_path = folder / 'tdsheet.csv'
+    generate_tdsheet(csv_file_path, rows=1500, days=100, start=date(2024, 11, 15))
+    path = str(folder / 'orders.db')
+    assert parse_csv_to_database(str(csv_file_path), path)
+    yield path
+    invalidate_orders_cache(path)
+
+@pytest.fixture(scope='module')
+def orders(db_path):
+    return query_orders(db_path, categorical=True)
+
+def date_mask(df, start_date, end_date):
+    return (df['order_date'].dt.date >= start_date) & (df['order_date'].dt.date <= end_date)
+
+def test_snapshot_matches_database(db_path):
+    for categorical in (False, True):
+        snapshot = read_orders(db_path, categorical).sort_values('id').reset_index(drop=True)
+        database = read_orders(db_path, categorical, 'o.id > ?', (0,)).sort_values('id').reset_index(drop=True)
+        pd.testing.assert_frame_equal(snapshot, database)
+
+@pytest.mark.parametrize('filters', [
+    {'start_date': date(2024, 12, 1), 'end_date': date(2025, 1, 15)},
+    {'regions': ['Регион 1', 'Регион 3'], 'categories': ['Категория 2']},
+    {'managers': ['Менеджер 5'], 'min_amount': 100000},
+    {'contractors': ['Контрагент 2', 'Нет такого'], 'min_quantity': 500, 'end_date': date(2025, 1, 31)},
+])
+def test_filter_index_matches_boolean_mask(db_path, orders, filters):
+    mask = pd.Series(True, index=orders.index)
+    if 'start_date' in filters or 'end_date' in filters:
+        mask &= date_mask(orders, filters.get('start_date', date.min), filters.get('end_date', date.max))
+    for name, column in (('regions', 'region'), ('contractors', 'head_contractor'),
+                         ('managers', 'manager'), ('categories', 'category')):
+        if name in filters:
+            mask &= orders[column].isin(filters[name])
+    if 'min_amount' in filters:
+        mask &= orders['amount'] >= filters['min_amount']
+    if 'min_quantity' in filters:
+        mask &= orders['quantity'] >= filters['min_quantity']
+
+    expected = orders[mask].reset_index(drop=True)
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(FilterIndex(orders).select(filters), expected)
+
+    # Тот же отбор в SQLite (словари категорий у выборки свои, поэтому сравнение по строкам)
+    where, params = build_order_filter(filters)
+    database = read_orders(db_path, False, where, params).sort_values('id').reset_index(drop=True)
+    expected = expected.astype({column: str for column in TEXT_COLUMNS}).sort_values('id').reset_index(drop=True)
+    pd.testing.assert_frame_equal(database, expected)
+
+def test_filter_index_matches_unsorted_frame(orders):
+    shuffled = orders.sample(frac=1, random_state=0).reset_index(drop=True)
+    filters = {'start_date': date(2025, 1, 1), 'end_date': date(2025, 1, 31), 'regions': ['Регион 2']}
+    mask = date_mask(shuffled, date(2025, 1, 1), date(2025, 1, 31)) & (shuffled['region'] == 'Регион 2')
+    pd.testing.assert_frame_equal(FilterIndex(shuffled).select(filters), shuffled[mask].reset_index(drop=True))
+
+def test_drilldown_index_matches_boolean_mask(orders):
+    index = DrillDownIndex(orders, ['head_contractor', 'product_name'])
+    pairs = orders[['head_contractor', 'product_name']].drop_duplicates().head(20)
+    for contractor, product in pairs.itertuples(index=False):
+        expected = orders[(orders['head_contractor'] == contractor) & (orders['product_name'] == product)]
+        pd.testing.assert_frame_equal(index.select(contractor, product), expected)
+
+    # Префикс: все товары контрагента
+    for contractor in pairs['head_contractor'].unique():
+        pd.testing.assert_frame_equal(index.select(contractor), orders[orders['head_contractor'] == contractor])
+
+    assert index.select('Нет такого').empty
+    assert index.select(pairs.iloc[0, 0], 'Нет такого').empty
+
+@pytest.mark.parametrize('period', ROLLUP_PERIODS)
+def test_daily_rollup_matches_direct_grouping(orders, period):
+    daily = aggregate_daily(orders)
+    rollup = DailyRollup(daily)
+
+    for start_date, end_date in ((None, None), (date(2024, 12, 3), date(2025, 2, 10)), (date(2025, 1, 1), date(2025, 1, 1))):
+        selected = daily
+        if start_date is not None:
+            selected = daily[date_mask(daily, start_date, end_date)]
+        periods = selected['order_date'].dt.to_period(PERIOD_FREQUENCIES[period]).dt.start_time
+        expected = selected.groupby(periods)[['amount', 'orders', 'quantity']].sum()
+
+        actual = rollup.totals(period, start_date, end_date).set_index('period')
+        assert list(actual.index) == list(expected.index)
+        np.testing.assert_allclose(actual['amount'], expected['amount'], rtol=1e-9)
+        np.testing.assert_array_equal(actual['orders'], expected['orders'])
+        np.testing.assert_allclose(actual['quantity'], expected['quantity'], rtol=1e-9)
+
+def test_interaction_matrix_matches_groupby(orders):
+    matrix = InteractionMatrix(orders, 'manager', 'buyer', distinct='product_name')
+    expected = orders.groupby(['manager', 'buyer'], observed=True).agg(
+        amount=('amount', 'sum'), count=('id', 'size'), product_name=('product_name', 'nunique')
+    ).reset_index()
+
+    entries = matrix.entries()
+    for column in ('manager', 'buyer'):
+        entries[column] = entries[column].astype(str)
+        expected[column] = expected[column].astype(str)
+    pd.testing.assert_frame_equal(entries, expected, check_dtype=False)
+
+    top = matrix.top(10)
+    np.testing.assert_array_equal(top['amount'], expected['amount'].nlargest(10))
+
+    coverage = matrix.row_coverage()
+    assert coverage.to_dict() == expected.groupby('manager').size().to_dict()
+    assert matrix.column_coverage().to_dict() == expected.groupby('buyer').size().to_dict()
+
+def test_period_comparison_matches_masks(orders):
+    periods = {
+        'Декабрь': (date(2024, 12, 1), date(2024, 12, 31)),
+        'Январь': (date(2025, 1, 1), date(2025, 1, 31)),
+        'Пересечение': (date(2024, 12, 15), date(2025, 1, 15)),
+        'Пусто': (date(2023, 1, 1), date(2023, 1, 31)),
+    }
+    comparison = PeriodComparison(orders, periods)
+
+    totals = comparison.totals().set_index('period')
+    for name, (start_date, end_date) in periods.items():
+        period = orders[date_mask(orders, start_date, end_date)]
+        assert totals.loc[name, 'orders'] == len(period)
+        assert totals.loc[name, 'amount'] == pytest.approx(period['amount'].sum(), rel=1e-12)
+        assert totals.loc[name, 'buyers'] == period['buyer'].nunique()
+        assert totals.loc[name, 'contractors'] == period['head_contractor'].nunique()
+
+        expected = period.groupby('category', observed=True)['amount'].sum()
+        actual = comparison.pivot(['category'])[name].dropna()
+        np.testing.assert_allclose(actual.to_numpy(), expected.to_numpy(), rtol=1e-12)
+        assert list(actual.index) == list(expected.index)
+
+    table = comparison.compare([('Январь', 'Декабрь'), ('Январь', 'Пусто')])
+    amount = table[table['metric'] == 'amount'].set_index('base')
+    assert amount.loc['Декабрь', 'change'] == pytest.approx(
+        (totals.loc['Январь', 'amount'] / totals.loc['Декабрь', 'amount'] - 1) * 100
+    )
+    # Рост от нуля не определен
+    assert amount.loc['Пусто', 'base_value'] == 0
+    assert np.isnan(amount.loc['Пусто', 'change'])
+
+def test_monthly_comparison_pairs_months_with_bases():
+    periods, pairs = monthly_comparison(date(2025, 1, 10), date(2025, 2, 5), months=12)
+    assert pairs == [('2025-01', '2024-01'), ('2025-02', '2024-02')]
+    assert periods['2024-02'] == (date(2024, 2, 1), date(2024, 2, 29))
+    assert periods['2025-01'] == (date(2025, 1, 1), date(2025, 1, 31))
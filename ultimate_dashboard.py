@@ -6,19 +6,14 @@
 
 import streamlit as st
 import pandas as pd
-import sqlite3
+from data_access import data_token, invalidate_orders_cache, load_orders, memoize_analysis
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import plotly.figure_factory as ff
 from datetime import datetime, timedelta
 import numpy as np
-from scipy import stats
-from sklearn.ensemble import RandomForestRegressor, IsolationForest
-from sklearn.cluster import KMeans, DBSCAN
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
-from sklearn.metrics import silhouette_score
+# Модели sklearn импортируются внутри функций вкладок: импорт sklearn занимает
+# больше секунды и не должен задерживать первую отрисовку дашборда
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -172,39 +167,10 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-@st.cache_data(ttl=300)
 def load_data():
     """Загрузка данных из базы данных"""
     try:
-        conn = sqlite3.connect('orimex_orders.db')
-        
-        query = '''
-        SELECT 
-            o.id,
-            o.order_date,
-            o.quantity,
-            o.amount,
-            c.head_contractor,
-            c.buyer,
-            c.manager,
-            c.region,
-            p.name as product_name,
-            p.characteristics,
-            p.category
-        FROM orders o
-        JOIN contractors c ON o.contractor_id = c.id
-        JOIN products p ON o.product_id = p.id
-        WHERE o.amount IS NOT NULL AND o.amount > 0
-        '''
-        
-        df = pd.read_sql_query(query, conn)
-        df['order_date'] = pd.to_datetime(df['order_date'])
-        df['month'] = df['order_date'].dt.to_period('M')
-        df['week'] = df['order_date'].dt.to_period('W')
-        df['day_of_week'] = df['order_date'].dt.day_name()
-        df['quarter'] = df['order_date'].dt.to_period('Q')
-        df['hour'] = df['order_date'].dt.hour
-        df['is_weekend'] = df['order_date'].dt.dayofweek.isin([5, 6])
+        df = load_orders(time_columns=('day_of_week', 'hour', 'is_weekend'))
         
         # Добавляем расчетные поля
         df['price_per_unit'] = df['amount'] / df['quantity']
@@ -214,7 +180,6 @@ def load_data():
             labels=['Малый', 'Средний', 'Большой', 'Крупный', 'VIP']
         )
         
-        conn.close()
         return df
         
     except Exception as e:
@@ -273,6 +238,7 @@ def create_smart_insights(df):
     
     return insights
 
+@memoize_analysis
 def create_ultra_time_series(df):
     """Ультра-продвинутый анализ временных рядов"""
     
@@ -414,6 +380,7 @@ def create_ultra_time_series(df):
     
     return fig
 
+@memoize_analysis
 def create_advanced_customer_journey(df):
     """Продвинутый анализ пути клиента"""
     
@@ -478,6 +445,7 @@ def create_advanced_customer_journey(df):
     
     return fig_journey, fig_funnel, customer_lifecycle
 
+@memoize_analysis
 def create_product_intelligence(df):
     """Продуктовая аналитика"""
     
@@ -558,8 +526,10 @@ def create_product_intelligence(df):
     
     return fig_matrix, fig_network, product_lifecycle
 
+@memoize_analysis
 def create_manager_leaderboard(df):
     """Рейтинг и соревнование менеджеров"""
+    from sklearn.preprocessing import StandardScaler
     
     # Детальная аналитика по менеджерам
     manager_stats = df.groupby('manager').agg({
@@ -633,6 +603,7 @@ def create_manager_leaderboard(df):
     
     return fig_radar, manager_stats
 
+@memoize_analysis
 def create_regional_intelligence(df):
     """Региональная аналитика"""
     
@@ -702,8 +673,10 @@ def create_regional_intelligence(df):
     
     return fig_regions, fig_map, regional_stats
 
+@memoize_analysis
 def create_predictive_analytics(df):
     """Предиктивная аналитика"""
+    from sklearn.ensemble import RandomForestRegressor
     
     # Подготовка данных для ML
     daily_sales = df.groupby('order_date').agg({
@@ -865,6 +838,7 @@ def create_predictive_analytics(df):
     
     return fig_forecast, fig_importance, future_predictions.sum()
 
+@memoize_analysis
 def create_competitive_benchmarking(df):
     """Конкурентное бенчмаркирование"""
     
@@ -1048,6 +1022,12 @@ def main():
         english_weekdays = [weekday_mapping[day] for day in selected_weekdays]
         filtered_df = filtered_df[filtered_df['day_of_week'].isin(english_weekdays)]
     
+    # Ключ кеша анализов: версия данных и значения фильтров
+    data_key = (
+        data_token(),
+        tuple(selected_regions), tuple(selected_categories), order_size_filter, tuple(selected_weekdays)
+    )
+    
     # Основные вкладки
     tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
         "📊 Ультра-временные ряды",
@@ -1062,7 +1042,7 @@ def main():
         st.markdown('<div class="glass-card">', unsafe_allow_html=True)
         st.subheader("📊 Ультра-анализ временных рядов")
         if not filtered_df.empty:
-            fig_ultra_time = create_ultra_time_series(filtered_df)
+            fig_ultra_time = create_ultra_time_series(filtered_df, data_key=data_key)
             st.plotly_chart(fig_ultra_time, width='stretch')
         st.markdown('</div>', unsafe_allow_html=True)
     
@@ -1070,7 +1050,7 @@ def main():
         st.markdown('<div class="glass-card">', unsafe_allow_html=True)
         st.subheader("🗺️ Анализ путешествия клиентов")
         if not filtered_df.empty:
-            fig_journey, fig_funnel, customer_data = create_advanced_customer_journey(filtered_df)
+            fig_journey, fig_funnel, customer_data = create_advanced_customer_journey(filtered_df, data_key=data_key)
             
             col1, col2 = st.columns(2)
             with col1:
@@ -1091,7 +1071,7 @@ def main():
         st.markdown('<div class="glass-card">', unsafe_allow_html=True)
         st.subheader("🧬 ДНК товарного портфеля")
         if not filtered_df.empty:
-            fig_matrix, fig_network, product_data = create_product_intelligence(filtered_df)
+            fig_matrix, fig_network, product_data = create_product_intelligence(filtered_df, data_key=data_key)
             
             col1, col2 = st.columns(2)
             with col1:
@@ -1112,7 +1092,7 @@ def main():
         st.markdown('<div class="glass-card">', unsafe_allow_html=True)
         st.subheader("🏆 Турнир менеджеров")
         if not filtered_df.empty:
-            fig_radar, manager_data = create_manager_leaderboard(filtered_df)
+            fig_radar, manager_data = create_manager_leaderboard(filtered_df, data_key=data_key)
             st.plotly_chart(fig_radar, width='stretch')
             
             # Турнирная таблица
@@ -1141,7 +1121,7 @@ def main():
         st.markdown('<div class="glass-card">', unsafe_allow_html=True)
         st.subheader("🌍 Региональная разведка")
         if not filtered_df.empty:
-            fig_regions, fig_map, regional_data = create_regional_intelligence(filtered_df)
+            fig_regions, fig_map, regional_data = create_regional_intelligence(filtered_df, data_key=data_key)
             
             col1, col2 = st.columns(2)
             with col1:
@@ -1169,7 +1149,7 @@ def main():
         st.markdown('<div class="glass-card">', unsafe_allow_html=True)
         st.subheader("🔮 Предиктивная магия")
         if not filtered_df.empty:
-            fig_forecast, fig_importance, forecast_total = create_predictive_analytics(filtered_df)
+            fig_forecast, fig_importance, forecast_total = create_predictive_analytics(filtered_df, data_key=data_key)
             
             col1, col2 = st.columns(2)
             with col1:
@@ -1187,7 +1167,7 @@ def main():
             """, unsafe_allow_html=True)
             
             # Конкурентное бенчмаркирование
-            fig_benchmark, fig_regional_rank, cat_data, reg_data = create_competitive_benchmarking(filtered_df)
+            fig_benchmark, fig_regional_rank, cat_data, reg_data = create_competitive_benchmarking(filtered_df, data_key=data_key)
             
             col3, col4 = st.columns(2)
             with col3:
@@ -1233,6 +1213,7 @@ def main():
     
     with control_col1:
         if st.button("🔄 Обновить данные", help="Перезагрузить данные из БД"):
+            invalidate_orders_cache()
             st.cache_data.clear()
             st.rerun()
     